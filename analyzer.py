@@ -1,15 +1,22 @@
 #!/usr/bin/python
 
 import argparse
-import json
+import glob
+import multiprocessing
 import os
 import sys
+import traceback
 from neutmon import analysis
+from neutmon import batchstats
+from neutmon import cache
 
+PARAMETERS_FILE = "parameters.dat"
+STRATIFY_COLUMNS = ["mode", "operator", "cell"]
 
-def traceroute_analyzer(bt_traceroute_dict, ct_traceroute_dict):
-    bt_traceroute = analysis.order_dict(bt_traceroute_dict, analysis.TRACEROUTE)
-    ct_traceroute = analysis.order_dict(ct_traceroute_dict, analysis.TRACEROUTE)
+worker_cache = None
+
+
+def traceroute_analyzer(bt_traceroute, ct_traceroute):
     bt_trace_length = len(bt_traceroute)
     ct_trace_length = len(ct_traceroute)
     max_length = max(bt_trace_length, ct_trace_length)
@@ -39,197 +46,308 @@ def traceroute_analyzer(bt_traceroute_dict, ct_traceroute_dict):
     return output_string
 
 
-def main(argv):
-    parser = argparse.ArgumentParser(description="NeutMon data analyzer. Produces plots from Neutmon output file")
-    parser.add_argument("-i", "--interval", type=float, help="minimum interval for throughput calculation")
-    parser.add_argument("-o", "--operator", help="name of operator for extracting relevant metadata")
-    parser.add_argument("-s", "--significance", type=float, default=0.05, help="significance level of KS test")
-    parser.add_argument("neutmon_file", metavar="FILE", type=str, nargs=1, help="Neutmon output file")
-    args = parser.parse_args()
-    if args.interval:
-        min_interval = args.interval
-    else:
-        min_interval = 0
-    if args.operator:
-        operator = args.operator
-    else:
-        operator = ""
-    #     print "Operator not specified. Exiting."
-    #     sys.exit(0)
-    dir_name = args.neutmon_file[0].replace(".json", "")
+def analyze_file(file_name, min_interval, operator, significance, max_points, cache=None):
+    dir_name = file_name.replace(".json", "")
     try:
         os.mkdir(dir_name)
     except OSError as ose:
         if ose.errno != 17:
             raise ose
-    with open(args.neutmon_file[0], "r") as json_file:
-        json_data = json.loads(json_file.read())
-    if "error" in json_data:
-        print "Test failed. Error: %s" % json_data["error"]["message"]
-        sys.exit(0)
-    if json_data["results"][0]["finished"]:
+    parsed = analysis.load_result(file_name, cache)
+    if "error" in parsed:
+        print "%s Test failed. Error: %s" % (file_name, parsed["error"])
+        return None
+    if parsed["results"][0]["finished"]:
         results_index = 0
-    elif json_data["results"][1]["finished"]:
-        print "Test failed on port %i" % json_data["results"][0]["port"]
+    elif parsed["results"][1]["finished"]:
+        print "%s Test failed on port %i" % (file_name, parsed["results"][0]["port"])
         results_index = 1
     else:
-        print argv[1], "Test failed on port %i" % json_data["results"][1]["port"]
-        sys.exit(0)
+        print "%s Test failed on port %i" % (file_name, parsed["results"][1]["port"])
+        return None
+    samples = parsed["results"][results_index]["speedtests"]
+    traceroutes = parsed["results"][results_index]["traceroutes"]
 
     # plot cumulatives and write mean throughputs
     with open(dir_name + "/mean_throughput.dat", "w") as f:
         kwargs = dict()
         f.write("\tbt\tct\ttt\tht\n")
         # plot uplink transfer cumulative
-        bt_x, bt_y, bt_mean = analysis.transfer_cumulative(
-            json_data["results"][results_index]["uplink"]["bt"]["speedtest"])
+        bt_x, bt_y, bt_mean = analysis.transfer_cumulative(samples["uplink", "bt"])
         kwargs["BT"] = (bt_x, bt_y)
-        ct_x, ct_y, ct_mean = analysis.transfer_cumulative(
-            json_data["results"][results_index]["uplink"]["ct"]["speedtest"])
+        ct_x, ct_y, ct_mean = analysis.transfer_cumulative(samples["uplink", "ct"])
         kwargs["CT"] = (ct_x, ct_y)
-        if "third" in json_data["results"][results_index]["uplink"]:
-            tt_x, tt_y, tt_mean = analysis.transfer_cumulative(
-                json_data["results"][results_index]["uplink"]["third"]["speedtest"])
+        if ("uplink", "third") in samples:
+            tt_x, tt_y, tt_mean = analysis.transfer_cumulative(samples["uplink", "third"])
             kwargs["TT"] = (tt_x, tt_y)
-        analysis.plot_cumulative(dir_name + "/uplink_cumulative.pdf", **kwargs)
-        if "third" in json_data["results"][results_index]["uplink"]:
+        analysis.plot_cumulative(dir_name + "/uplink_cumulative.pdf", max_points, **kwargs)
+        if ("uplink", "third") in samples:
             f.write("uplink\t%f\t%f\t%f\t-\n" % (bt_mean, ct_mean, tt_mean))
         else:
             f.write("uplink\t%f\t%f\t-\t-\n" % (bt_mean, ct_mean))
         # plot downlink transfer cumulative
         kwargs = dict()
-        bt_x, bt_y, bt_mean = analysis.transfer_cumulative(
-            json_data["results"][results_index]["downlink"]["bt"]["speedtest"])
+        bt_x, bt_y, bt_mean = analysis.transfer_cumulative(samples["downlink", "bt"])
         kwargs["BT"] = (bt_x, bt_y)
-        ct_x, ct_y, ct_mean = analysis.transfer_cumulative(
-            json_data["results"][results_index]["downlink"]["ct"]["speedtest"])
+        ct_x, ct_y, ct_mean = analysis.transfer_cumulative(samples["downlink", "ct"])
         kwargs["CT"] = (ct_x, ct_y)
-        if "third" in json_data["results"][results_index]["downlink"]:
-            tt_x, tt_y, tt_mean = analysis.transfer_cumulative(
-                json_data["results"][results_index]["downlink"]["third"]["speedtest"])
+        if ("downlink", "third") in samples:
+            tt_x, tt_y, tt_mean = analysis.transfer_cumulative(samples["downlink", "third"])
             kwargs["TT"] = (tt_x, tt_y)
-        if "meta_data" in json_data and "client_meta" in json_data["meta_data"]\
-                and "http_test" in json_data["meta_data"]["client_meta"]\
-                and len(json_data["meta_data"]["client_meta"]["http_test"]) > 0:
-            speedtest = json_data["meta_data"]["client_meta"].pop("http_test", None)
-            if speedtest is not None:
-                json_data["meta_data"]["client_meta"]["http_test"] = dict()
-                json_data["meta_data"]["client_meta"]["http_test"]["speedtest"] = speedtest
-                error = json_data["meta_data"]["client_meta"]["http_test"]["speedtest"].pop("error", None)
-                if error is not None:
-                    json_data["meta_data"]["client_meta"]["http_test"]["error"] = error
-            ht_x, ht_y, ht_mean = analysis.transfer_cumulative(
-                json_data["meta_data"]["client_meta"]["http_test"]["speedtest"])
+        if "http_test" in parsed:
+            ht_x, ht_y, ht_mean = analysis.transfer_cumulative(parsed["http_test"])
             kwargs["HT"] = (ht_x, ht_y)
-            if "third" in json_data["results"][results_index]["downlink"]:
+            if ("downlink", "third") in samples:
                 f.write("downlink\t%f\t%f\t%f\t%f\n" % (bt_mean, ct_mean, tt_mean, ht_mean))
             else:
                 f.write("downlink\t%f\t%f\t-\t%f\n" % (bt_mean, ct_mean, ht_mean))
         else:
-            if "third" in json_data["results"][results_index]["downlink"]:
+            if ("downlink", "third") in samples:
                 f.write("downlink\t%f\t%f\t%f\t-\n" % (bt_mean, ct_mean, tt_mean))
             else:
-                f.write("uplink\t%f\t%f\t-\t-\n" % (bt_mean, ct_mean))
-        analysis.plot_cumulative(dir_name + "/downlink_cumulative.pdf", **kwargs)
+                f.write("downlink\t%f\t%f\t-\t-\n" % (bt_mean, ct_mean))
+        analysis.plot_cumulative(dir_name + "/downlink_cumulative.pdf", max_points, **kwargs)
 
     # metadata
     if operator != "":
-        d = analysis.order_dict(json_data["meta_data"]["client_meta"]["interface"], analysis.METADATA)
-        fd = analysis.filter_by_operator(d, operator)
-        btd = analysis.order_dict(json_data["results"][results_index]["downlink"]["bt"]["speedtest"],
-                                  analysis.SPEEDTEST)
-        ctd = analysis.order_dict(json_data["results"][results_index]["downlink"]["ct"]["speedtest"],
-                                  analysis.SPEEDTEST)
-        btu = analysis.order_dict(json_data["results"][results_index]["uplink"]["bt"]["speedtest"],
-                                  analysis.SPEEDTEST)
-        ctu = analysis.order_dict(json_data["results"][results_index]["uplink"]["ct"]["speedtest"],
-                                  analysis.SPEEDTEST)
-        if "third" in json_data["results"][results_index]["downlink"]:
-            ttd = analysis.order_dict(json_data["results"][results_index]["downlink"]["third"]["speedtest"],
-                                      analysis.SPEEDTEST)
-        if "third" in json_data["results"][results_index]["uplink"]:
-            ttu = analysis.order_dict(json_data["results"][results_index]["uplink"]["third"]["speedtest"],
-                                      analysis.SPEEDTEST)
-        tempi = fd.keys()
-        mode = []
-        rssi = []
-        for t in tempi:
-            mode.append(fd[t]["DeviceMode"])
-            rssi.append(fd[t]["RSSI"])
+        radio = parsed.get("radio", analysis.metadata_arrays(dict(), analysis.RADIO_FIELDS))
+        operator_rows = radio["operator"] == operator
+        tempi = radio["time"][operator_rows]
+        mode = radio["mode"][operator_rows]
+        rssi = radio["rssi"][operator_rows]
         # min_time = min(tempi)
         # tempi = [x - min_time for x in tempi]
         kwargs = dict()
-        kwargs["BT Uplink"] = btu
-        kwargs["BT Downlink"] = btd
-        kwargs["CT Uplink"] = ctu
-        kwargs["CT Downlink"] = ctd
-        if "third" in json_data["results"][results_index]["uplink"]:
-            kwargs["TT Uplink"] = ttu
-        if "third" in json_data["results"][results_index]["downlink"]:
-            kwargs["TT Downlink"] = ttd
-        if "meta_data" in json_data and "client_meta" in json_data["meta_data"] \
-                and "http_test" in json_data["meta_data"]["client_meta"]\
-                and len(json_data["meta_data"]["client_meta"]["http_test"]) > 0:
-            htd = analysis.order_dict(json_data["meta_data"]["client_meta"]["http_test"]["speedtest"],
-                                      analysis.SPEEDTEST)
-            kwargs["HTTP Downlink"] = htd
-        analysis.plot_metadata(dir_name + "/metadata.pdf", tempi, mode, rssi, **kwargs)
+        kwargs["BT Uplink"] = samples["uplink", "bt"]
+        kwargs["BT Downlink"] = samples["downlink", "bt"]
+        kwargs["CT Uplink"] = samples["uplink", "ct"]
+        kwargs["CT Downlink"] = samples["downlink", "ct"]
+        if ("uplink", "third") in samples:
+            kwargs["TT Uplink"] = samples["uplink", "third"]
+        if ("downlink", "third") in samples:
+            kwargs["TT Downlink"] = samples["downlink", "third"]
+        if "http_test" in parsed:
+            kwargs["HTTP Downlink"] = parsed["http_test"]
+        analysis.plot_metadata(dir_name + "/metadata.pdf", tempi, mode, rssi, max_points, **kwargs)
 
     # plot uplink throughput cdf
     kwargs = dict()
-    bt_x, bt_y = analysis.throughput_cdf(json_data["results"][results_index]["uplink"]["bt"]["speedtest"], min_interval)
+    bt_x, bt_y = analysis.throughput_cdf(samples["uplink", "bt"], min_interval)
     kwargs["BT"] = (bt_x, bt_y)
-    ct_x, ct_y = analysis.throughput_cdf(json_data["results"][results_index]["uplink"]["ct"]["speedtest"], min_interval)
+    ct_x, ct_y = analysis.throughput_cdf(samples["uplink", "ct"], min_interval)
     kwargs["CT"] = (ct_x, ct_y)
-    if "third" in json_data["results"][results_index]["uplink"]:
-        tt_x, tt_y = analysis.throughput_cdf(json_data["results"][results_index]["uplink"]["third"]["speedtest"],
-                                             min_interval)
+    if ("uplink", "third") in samples:
+        tt_x, tt_y = analysis.throughput_cdf(samples["uplink", "third"], min_interval)
         kwargs["TT"] = (tt_x, tt_y)
-    analysis.plot_cdf(dir_name + "/uplink_throughput_cdf.pdf", **kwargs)
-    
+    analysis.plot_cdf(dir_name + "/uplink_throughput_cdf.pdf", max_points, **kwargs)
+
     # compute statistics
-    analysis.compute_ks(dir_name + "/uplink_statistics_btct.txt", bt_x, ct_x, args.significance)
-    if "third" in json_data["results"][results_index]["uplink"]:
-        analysis.compute_ks(dir_name + "/uplink_statistics_bttt.txt", bt_x, tt_x, args.significance)
+    analysis.compute_ks(dir_name + "/uplink_statistics_btct.txt", bt_x, ct_x, significance)
+    if ("uplink", "third") in samples:
+        analysis.compute_ks(dir_name + "/uplink_statistics_bttt.txt", bt_x, tt_x, significance)
 
     # plot downlink throughput cdf
     kwargs = dict()
-    bt_x, bt_y = analysis.throughput_cdf(json_data["results"][results_index]["downlink"]["bt"]["speedtest"],
-                                         min_interval)
+    bt_x, bt_y = analysis.throughput_cdf(samples["downlink", "bt"], min_interval)
     kwargs["BT"] = (bt_x, bt_y)
-    ct_x, ct_y = analysis.throughput_cdf(json_data["results"][results_index]["downlink"]["ct"]["speedtest"],
-                                         min_interval)
+    ct_x, ct_y = analysis.throughput_cdf(samples["downlink", "ct"], min_interval)
     kwargs["CT"] = (ct_x, ct_y)
-    if "third" in json_data["results"][results_index]["downlink"]:
-        tt_x, tt_y = analysis.throughput_cdf(json_data["results"][results_index]["downlink"]["third"]["speedtest"],
-                                             min_interval)
+    if ("downlink", "third") in samples:
+        tt_x, tt_y = analysis.throughput_cdf(samples["downlink", "third"], min_interval)
         kwargs["TT"] = (tt_x, tt_y)
-    if "meta_data" in json_data and "client_meta" in json_data["meta_data"] \
-            and "http_test" in json_data["meta_data"]["client_meta"]\
-            and len(json_data["meta_data"]["client_meta"]["http_test"]) > 0:
-        ht_x, ht_y = analysis.throughput_cdf(json_data["meta_data"]["client_meta"]["http_test"]["speedtest"],
-                                             min_interval)
+    if "http_test" in parsed:
+        ht_x, ht_y = analysis.throughput_cdf(parsed["http_test"], min_interval)
         kwargs["HT"] = (ht_x, ht_y)
-    analysis.plot_cdf(dir_name + "/downlink_throughput_cdf.pdf", **kwargs)
+    analysis.plot_cdf(dir_name + "/downlink_throughput_cdf.pdf", max_points, **kwargs)
 
     # compute statistics
-    analysis.compute_ks(dir_name + "/downlink_statistics_btct.txt", bt_x, ct_x, args.significance)
-    if "third" in json_data["results"][results_index]["downlink"]:
-        analysis.compute_ks(dir_name + "/downlink_statistics_bttt.txt", bt_x, tt_x, args.significance)
+    analysis.compute_ks(dir_name + "/downlink_statistics_btct.txt", bt_x, ct_x, significance)
+    if ("downlink", "third") in samples:
+        analysis.compute_ks(dir_name + "/downlink_statistics_bttt.txt", bt_x, tt_x, significance)
     if "HT" in kwargs:
-        analysis.compute_ks(dir_name + "/downlink_statistics_btht.txt", bt_x, ht_x, args.significance)
+        analysis.compute_ks(dir_name + "/downlink_statistics_btht.txt", bt_x, ht_x, significance)
 
     # write traceroute analysis downlink
-    to_write = traceroute_analyzer(json_data["results"][results_index]["downlink"]["bt"]["traceroute"],
-                                   json_data["results"][results_index]["downlink"]["ct"]["traceroute"])
+    to_write = traceroute_analyzer(traceroutes["downlink", "bt"], traceroutes["downlink", "ct"])
     with open(dir_name + "/downlink_traceroute.dat", "w") as f:
         f.write(to_write)
     # write traceroute analysis uplink
-    to_write = traceroute_analyzer(json_data["results"][results_index]["uplink"]["bt"]["traceroute"],
-                                   json_data["results"][results_index]["uplink"]["ct"]["traceroute"])
+    to_write = traceroute_analyzer(traceroutes["uplink", "bt"], traceroutes["uplink", "ct"])
     with open(dir_name + "/uplink_traceroute.dat", "w") as f:
         f.write(to_write)
 
+    # written last, marks the outputs as complete for these parameters
+    with open(dir_name + "/" + PARAMETERS_FILE, "w") as f:
+        f.write(parameters_string(min_interval, operator, significance, max_points))
+    return dir_name
+
+
+def parameters_string(min_interval, operator, significance, max_points):
+    return "interval\t%r\noperator\t%s\nsignificance\t%r\npoints\t%i\n" % (min_interval, operator, significance,
+                                                                               max_points)
+
+
+def up_to_date(file_name, min_interval, operator, significance, max_points):
+    parameters_file = file_name.replace(".json", "") + "/" + PARAMETERS_FILE
+    try:
+        if os.path.getmtime(parameters_file) < os.path.getmtime(file_name):
+            return False
+        with open(parameters_file, "r") as f:
+            return f.read() == parameters_string(min_interval, operator, significance, max_points)
+    except (IOError, OSError):
+        return False
+
+
+def read_summary(dir_name):
+    rows = []
+    with open(dir_name + "/mean_throughput.dat", "r") as f:
+        lines = f.read().splitlines()[1:]
+    for direction, line in zip(["uplink", "downlink"], lines):
+        row = [dir_name, direction] + line.split("\t")[1:]
+        for pair in ["btct", "bttt", "btht"]:
+            try:
+                with open(dir_name + "/%s_statistics_%s.txt" % (direction, pair), "r") as f:
+                    fields = f.read().split("\t")
+                row += [fields[0], fields[3].strip()]
+            except IOError:
+                row += ["-", "-"]
+        rows.append(row)
+    return rows
+
+
+def comparison_pairs(file_name, min_interval, result_cache, operator="", stratify=None):
+    # Throughput samples of the comparisons of compute_ks, labelled as their statistics files, or of the BT and CT
+    # throughput bins split by the radio state joined with them
+    parsed = analysis.load_result(file_name, result_cache)
+    finished = [i for i, result in enumerate(parsed.get("results", [])) if result["finished"]]
+    if len(finished) == 0:
+        return []
+    if stratify is not None:
+        joined = analysis.join_metadata(parsed, finished[0], min_interval, operator)
+        return [("%s/%s_btct_%s=%s" % (file_name.replace(".json", ""), direction, stratify, stratum), (bt_x, ct_x))
+                for direction, stratum, bt_x, ct_x in analysis.stratified_pairs(joined, stratify)]
+    finished = [parsed["results"][i] for i in finished]
+    samples = finished[0]["speedtests"]
+    pairs = []
+    for direction in ["uplink", "downlink"]:
+        others = [("ct", samples[direction, "ct"]), ("tt", samples.get((direction, "third")))]
+        if direction == "downlink":
+            others.append(("ht", parsed.get("http_test")))
+        bt_x = analysis.throughput_cdf(samples[direction, "bt"], min_interval)[0]
+        for name, other in others:
+            if other is not None:
+                label = "%s/%s_bt%s" % (file_name.replace(".json", ""), direction, name)
+                pairs.append((label, (bt_x, analysis.throughput_cdf(other, min_interval)[0])))
+    return pairs
+
+
+def init_worker(cache_directory, cache_size):
+    global worker_cache
+    if cache_directory is not None:
+        worker_cache = cache.ResultCache(cache_directory, cache_size)
+
+
+def batch_worker(job):
+    # A failed file does not stop a batch, the error of a single file is raised
+    file_name, min_interval, operator, significance, max_points, force, batch = job
+    try:
+        if not force and up_to_date(file_name, min_interval, operator, significance, max_points):
+            return file_name, file_name.replace(".json", ""), True
+        dir_name = analyze_file(file_name, min_interval, operator, significance, max_points, worker_cache)
+        return file_name, dir_name, False
+    except Exception as e:
+        sys.stderr.write("%s Analysis failed. Error: %s\n" % (file_name, e))
+        if not batch:
+            raise
+        sys.stderr.write(traceback.format_exc())
+        return file_name, None, False
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="NeutMon data analyzer. Produces plots from Neutmon output file")
+    parser.add_argument("-i", "--interval", type=float, help="minimum interval for throughput calculation")
+    parser.add_argument("-o", "--operator", help="name of operator for extracting relevant metadata")
+    parser.add_argument("-s", "--significance", type=float, default=0.05, help="significance level of KS test")
+    parser.add_argument("-p", "--points", type=int, default=analysis.DEFAULT_PLOT_POINTS,
+                        help="maximum number of points of each plotted line, longer ones are downsampled")
+    parser.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="number of files analyzed in parallel")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="analyze also files whose outputs are newer than the file")
+    parser.add_argument("-c", "--cache", default=cache.DEFAULT_CACHE_DIRECTORY,
+                        help="directory of the cache of parsed files")
+    parser.add_argument("-C", "--cache_size", type=int, default=cache.DEFAULT_CACHE_SIZE,
+                        help="maximum size of the cache of parsed files in MB")
+    parser.add_argument("-n", "--no_cache", action="store_true", help="do not cache parsed files")
+    parser.add_argument("-S", "--statistics",
+                        help="file where to write the statistics table of all the comparisons of all the files")
+    parser.add_argument("-R", "--resamples", type=int, default=batchstats.DEFAULT_RESAMPLES,
+                        help="bootstrap resamples of the confidence intervals of the statistics table")
+    parser.add_argument("-m", "--correction", choices=batchstats.CORRECTIONS, default="bh",
+                        help="multiple comparison correction of the statistics table p-values")
+    parser.add_argument("-M", "--stratify", choices=STRATIFY_COLUMNS,
+                        help="split the comparisons of the statistics table by this radio field")
+    parser.add_argument("-t", "--summary", help="file where to write the summary table of all the analyzed files")
+    parser.add_argument("neutmon_file", metavar="FILE", type=str, nargs="+",
+                        help="Neutmon output file or glob pattern of Neutmon output files")
+    args = parser.parse_args()
+    if args.interval:
+        min_interval = args.interval
+    else:
+        min_interval = 0
+    if args.operator:
+        operator = args.operator
+    else:
+        operator = ""
+    #     print "Operator not specified. Exiting."
+    #     sys.exit(0)
+    file_names = []
+    for pattern in args.neutmon_file:
+        file_names += sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+    cache_directory = None if args.no_cache else args.cache
+    jobs = [(file_name, min_interval, operator, args.significance, args.points, args.force, len(file_names) > 1)
+            for file_name in file_names]
+    if args.workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(args.workers, len(jobs)), init_worker, (cache_directory, args.cache_size))
+        results = pool.imap(batch_worker, jobs)
+    else:
+        pool = None
+        init_worker(cache_directory, args.cache_size)
+        results = (batch_worker(job) for job in jobs)
+    rows = []
+    analyzed_files = []
+    skipped = 0
+    failed = 0
+    for file_name, dir_name, skip in results:
+        if dir_name is None:
+            failed += 1
+            continue
+        skipped += skip
+        rows += read_summary(dir_name)
+        analyzed_files.append(file_name)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if len(jobs) > 1:
+        print "%i files: %i analyzed, %i up to date, %i failed" % (len(jobs), len(jobs) - skipped - failed, skipped,
+                                                                   failed)
+    if args.statistics:
+        result_cache = None if cache_directory is None else cache.ResultCache(cache_directory, args.cache_size)
+        pairs = []
+        for file_name in analyzed_files:
+            pairs += comparison_pairs(file_name, min_interval, result_cache, operator, args.stratify)
+        statistics = batchstats.compare_pairs([pair for label, pair in pairs], [label for label, pair in pairs],
+                                              args.significance, args.resamples, correction=args.correction)
+        batchstats.write_table(args.statistics, statistics)
+    if args.summary or len(jobs) > 1:
+        summary = "file\tdirection\tbt\tct\ttt\tht\tbtct\tbtct_p\tbttt\tbttt_p\tbtht\tbtht_p\n"
+        summary += "".join("\t".join(row) + "\n" for row in rows)
+        if args.summary:
+            with open(args.summary, "w") as f:
+                f.write(summary)
+        else:
+            sys.stdout.write(summary)
+
 
 if __name__ == '__main__':
     main(sys.argv)
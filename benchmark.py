@@ -0,0 +1,325 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import logging
+import multiprocessing
+import Queue
+import resource
+import sys
+import time
+import traceback
+import uuid
+
+import client
+import server
+from neutmon import analysis
+from neutmon import handlers
+from neutmon import test
+
+DEFAULT_BENCHMARK_RUNS = 3
+DEFAULT_BENCHMARK_ADDRESS = "127.0.0.1"
+# The HTTP port of the server needs privileges
+DEFAULT_BENCHMARK_HTTP_PORT = 8080
+BENCHMARK_HTTP_FILE = "benchmark"
+BENCHMARK_SETUP_TIMEOUT = 60  # seconds
+BENCHMARK_RESULT_TIMEOUT = 60  # seconds, after the end of the client session
+
+
+class SpeedtestBTTest(test.TCPBTTest):
+    # The traceroutes need a raw ICMP socket and run for tens of seconds on loopback, the benchmark skips them
+    def uplink_traceroute(self, send_socket, icmp_socket, traceroute, stop_interfaces):
+        pass
+
+    def downlink_traceroute(self, receive_socket):
+        pass
+
+
+class SpeedtestRandomTest(test.TCPRandomTest):
+    def uplink_traceroute(self, send_socket, icmp_socket, traceroute, stop_interfaces):
+        pass
+
+    def downlink_traceroute(self, receive_socket):
+        pass
+
+
+class CountingSocket(object):
+    # Control socket counting the bytes of the control protocol, both directions
+    def __init__(self, control_socket):
+        self.control_socket = control_socket
+        self.sent = 0
+        self.received = 0
+
+    def send(self, data):
+        sent = self.control_socket.send(data)
+        self.sent += sent
+        return sent
+
+    def recv(self, length):
+        data = self.control_socket.recv(length)
+        self.received += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.control_socket, name)
+
+
+def cpu_time():
+    # User and system time of the process, all its threads included
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def session_tests(traceroutes):
+    if traceroutes:
+        return test.TCPBTTest(), test.TCPRandomTest()
+    return SpeedtestBTTest(), SpeedtestRandomTest()
+
+
+def benchmark_server(args, ready, results_queue):
+    # Server side of a session, in its own process so that its CPU time is apart from the client one
+    logger = logging.getLogger("neutmon")
+    output = {"cpu": 0.0}
+    http_responder = None
+    listener = None
+    pool = handlers.TesterPool(address=args.bind_address)
+    try:
+        listener = handlers.Listener(address=args.bind_address)
+        http_responder = handlers.HTTPResponder(args.http_port, args.http_size, address=args.bind_address)
+        http_responder.start()
+        bt_test, ct_test = session_tests(args.traceroutes)
+        start = cpu_time()
+        ready.set()
+        client_socket, address = listener.accept_connection()
+        client_socket.settimeout(30)
+        control_socket = CountingSocket(client_socket)
+        session_client = server.Client(control_socket, address, str(uuid.uuid4()))
+        meta_data = {"client_id": session_client.id, "client_ip": address, "start": time.time()}
+        results = []
+        error = dict()
+        server.client_handler(session_client, meta_data, results, error, logger, args.three_way_test, args.duration,
+                              pipelined=args.pipelined, pool=pool, bt_test=bt_test, ct_test=ct_test)
+        meta_data["stop"] = time.time()
+        output["cpu"] = cpu_time() - start
+        output["control"] = {"sent": control_socket.sent, "received": control_socket.received}
+        output["result"] = {"meta_data": meta_data, "results": results}
+        if error:
+            output["result"]["error"] = error
+    except Exception as e:
+        logger.error("B: Server failed: %s" % e)
+        logger.error(traceback.format_exc())
+        output["error"] = "%s: %s" % (type(e).__name__, e)
+    finally:
+        if http_responder is not None:
+            http_responder.stop()
+        if listener is not None:
+            listener.close_socket()
+        pool.close()
+        ready.set()
+    results_queue.put(output)
+
+
+def transfer_statistics(speedtest):
+    # Bytes, seconds and mean throughput (Mbps) of a speedtest, None with less than two samples
+    times, sizes = speedtest
+    if len(times) < 2 or times[-1] == times[0]:
+        return None
+    return int(sizes.sum()), float(times[-1] - times[0]), analysis.transfer_cumulative(speedtest)[2]
+
+
+def run_statistics(parsed, session_time, server_cpu, client_cpu, control):
+    # Metrics of a session: throughput of each class, CPU seconds per GB of test traffic of each side and control
+    # bytes per test byte. The control time is the session time outside of the speedtests: control exchanges,
+    # result uploads and the waits between the phases.
+    throughput = {"uplink": dict(), "downlink": dict()}
+    test_bytes = 0
+    test_time = 0.0
+    speedtests = dict()
+    for result in parsed.get("results", []):
+        if result["finished"]:
+            speedtests.update(result["speedtests"])
+    if "http_test" in parsed:
+        speedtests["downlink", "http"] = parsed["http_test"]
+    for (direction, test_index), speedtest in sorted(speedtests.items()):
+        statistics = transfer_statistics(speedtest)
+        if statistics is None:
+            continue
+        test_bytes += statistics[0]
+        test_time += statistics[1]
+        throughput[direction][test_index] = statistics[2]
+    gigabytes = test_bytes / 1e9
+    control_bytes = control["sent"] + control["received"]
+    return {"session_time": session_time, "test_time": test_time, "control_time": session_time - test_time,
+            "test_bytes": test_bytes, "throughput": throughput,
+            "cpu": {"server": server_cpu, "client": client_cpu},
+            "cpu_per_gb": {"server": server_cpu / gigabytes if gigabytes > 0 else None,
+                           "client": client_cpu / gigabytes if gigabytes > 0 else None},
+            # control bytes are counted by the server, sent and received are the ones of the client
+            "control": {"sent": control["received"], "received": control["sent"], "bytes": control_bytes,
+                        "overhead": float(control_bytes) / test_bytes if test_bytes > 0 else None}}
+
+
+def loopback_session(args, execution):
+    # Report of the client session, output of the server side and client CPU time of a session
+    ready = multiprocessing.Event()
+    results_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=benchmark_server, args=(args, ready, results_queue))
+    server_process.start()
+    try:
+        if not ready.wait(BENCHMARK_SETUP_TIMEOUT):
+            raise RuntimeError("Server not ready after %i seconds" % BENCHMARK_SETUP_TIMEOUT)
+        bt_test, ct_test = session_tests(args.traceroutes)
+        start = cpu_time()
+        report = client.interface_session("", args.server_address, handlers.SERVER_PORT, args.duration, [],
+                                          BENCHMARK_HTTP_FILE, False, execution, 0, http_port=args.http_port,
+                                          http_size=args.http_size, bt_test=bt_test, ct_test=ct_test)
+        client_cpu = cpu_time() - start
+        try:
+            output = results_queue.get(timeout=BENCHMARK_RESULT_TIMEOUT)
+        except Queue.Empty:
+            raise RuntimeError("No result from the server")
+    finally:
+        server_process.join(BENCHMARK_RESULT_TIMEOUT)
+        if server_process.is_alive():
+            server_process.terminate()
+    if "error" in output:
+        raise RuntimeError("Server failed: %s" % output["error"])
+    if report["outcome"] != client.SESSION_FINISHED:
+        raise RuntimeError("Client session %s" % report["outcome"])
+    return report, output, client_cpu
+
+
+def run_session(args, execution):
+    logger = logging.getLogger("neutmon")
+    report, output, client_cpu = loopback_session(args, execution)
+    parsed = analysis.parse_result(output["result"])
+    if "error" in parsed:
+        raise RuntimeError("Session failed: %s" % parsed["error"])
+    statistics = run_statistics(parsed, report["end"] - report["start"], output["cpu"], client_cpu,
+                                output["control"])
+    statistics["failed_tests"] = report["failed_tests"]
+    logger.info("B: Run %i: %s" % (execution, json.dumps(statistics)))
+    return statistics
+
+
+def flatten(statistics, prefix=""):
+    # Nested metrics as {"a.b": value}, for the summary and the comparisons
+    flat = dict()
+    for key, value in statistics.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def summarize(runs):
+    # Median of every metric over the runs
+    values = dict()
+    for run in runs:
+        for key, value in flatten(run).items():
+            values.setdefault(key, []).append(value)
+    summary = dict()
+    for key, run_values in values.items():
+        run_values.sort()
+        middle = len(run_values) // 2
+        if len(run_values) % 2 == 1:
+            summary[key] = run_values[middle]
+        else:
+            summary[key] = (run_values[middle - 1] + run_values[middle]) / 2.0
+    return summary
+
+
+def compare(summary, baseline_summary):
+    # Rows of metric, baseline value, current value and relative change of the metrics of both summaries
+    rows = []
+    for key in sorted(set(summary) & set(baseline_summary)):
+        baseline = baseline_summary[key]
+        change = (summary[key] - baseline) / float(baseline) if baseline != 0 else None
+        rows.append((key, baseline, summary[key], change))
+    return rows
+
+
+def print_summary(summary, rows=None):
+    if rows is None:
+        for key in sorted(summary):
+            print "%s\t%f" % (key, summary[key])
+        return
+    print "metric\tbaseline\tcurrent\tchange"
+    for key, baseline, current, change in rows:
+        print "%s\t%f\t%f\t%s" % (key, baseline, current, "-" if change is None else "%+.1f%%" % (change * 100))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="NeutMon benchmark. Runs complete sessions between a server and a "
+                                                 "client over loopback and measures the throughput of every test "
+                                                 "class, the CPU time per GB of test traffic of both sides, the "
+                                                 "control protocol overhead and the session time.")
+    parser.add_argument("-d", "--duration", type=int, default=test.DEFAULT_TEST_DURATION,
+                        help="speedtest duration (in seconds). the default value is %i" % test.DEFAULT_TEST_DURATION)
+    parser.add_argument("-n", "--runs", type=int, default=DEFAULT_BENCHMARK_RUNS,
+                        help="number of sessions, the summary is the median of their metrics. the default value is "
+                             "%i" % DEFAULT_BENCHMARK_RUNS)
+    parser.add_argument("-t", "--three_way_test", action="store_true", help="enable three way testing")
+    parser.add_argument("-x", "--pipelined", action="store_true",
+                        help="upload results of a phase while the next one is set up")
+    parser.add_argument("-r", "--traceroutes", action="store_true",
+                        help="run the traceroutes of the tests too, which needs root privileges")
+    parser.add_argument("-a", "--server_address", default=DEFAULT_BENCHMARK_ADDRESS,
+                        help="address the client connects to. the default value is %s" % DEFAULT_BENCHMARK_ADDRESS)
+    parser.add_argument("-b", "--bind_address", default=handlers.SERVER_BINDING_ADDRESS,
+                        help="address of the listeners of the server. the default value is %s"
+                             % handlers.SERVER_BINDING_ADDRESS)
+    parser.add_argument("--http_port", type=int, default=DEFAULT_BENCHMARK_HTTP_PORT,
+                        help="port of the HTTP test. the default value is %i" % DEFAULT_BENCHMARK_HTTP_PORT)
+    parser.add_argument("-z", "--http_size", type=int, default=handlers.DEFAULT_HTTP_OBJECT_SIZE,
+                        help="size in bytes of the HTTP test object. the default value is %i"
+                             % handlers.DEFAULT_HTTP_OBJECT_SIZE)
+    parser.add_argument("-o", "--output", default="neutmon_benchmark.json",
+                        help="output file of the runs and of their summary. the default value is "
+                             "neutmon_benchmark.json")
+    parser.add_argument("-c", "--compare", metavar="BASELINE",
+                        help="output file of a previous benchmark, the summary is printed with the relative change "
+                             "of every metric")
+    parser.add_argument("-l", "--log", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                        help="set the logging level. the default value is WARNING")
+    parser.add_argument("-g", "--logfile", default="neutmon_benchmark.log",
+                        help="set the output file for logs. the default value is neutmon_benchmark.log")
+    args = parser.parse_args(argv[1:])
+    if args.runs < 1:
+        parser.error("at least one run is needed")
+    baseline = None
+    if args.compare:
+        try:
+            with open(args.compare, "r") as f:
+                baseline = json.load(f)["summary"]
+        except (IOError, ValueError, KeyError) as e:
+            parser.error("cannot read the baseline: %s" % e)
+    logger = logging.getLogger("neutmon")
+    logger.setLevel(getattr(logging, args.log))
+    file_handler = logging.FileHandler(args.logfile)
+    file_handler.setFormatter(logging.Formatter('[%(asctime)s] [%(name)s] [%(levelname)s] \t%(message)s'))
+    logger.addHandler(file_handler)
+    start = time.time()
+    runs = []
+    failures = []
+    for execution in range(args.runs):
+        try:
+            runs.append(run_session(args, execution))
+        except (RuntimeError, handlers.ListenerException) as e:
+            logger.error("B: Run %i failed: %s" % (execution, e))
+            failures.append({"run": execution, "error": str(e)})
+            sys.stderr.write("Run %i failed: %s\n" % (execution, e))
+    summary = summarize(runs)
+    parameters = {"duration": args.duration, "runs": args.runs, "three_way_test": args.three_way_test,
+                  "pipelined": args.pipelined, "traceroutes": args.traceroutes, "http_size": args.http_size}
+    with open(args.output, "w") as f:
+        json.dump({"start": start, "end": time.time(), "parameters": parameters, "runs": runs, "failures": failures,
+                   "summary": summary}, f, indent=4)
+    print_summary(summary, None if baseline is None else compare(summary, baseline))
+    if not runs:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
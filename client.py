@@ -3,56 +3,119 @@
 import argparse
 import json
 import logging
+import collections
 import multiprocessing
-import Queue
 import sys
+import threading
 import time
 import zmq
 
 from neutmon import handlers
+from neutmon import pathprobes
+from neutmon import sweep
 from neutmon import test
+from neutmon import traces
+
+# Outcomes of the session on an interface
+SESSION_FINISHED = "finished"
+SESSION_ABORTED = "aborted"
+SESSION_BUSY = "server busy"
+SESSION_UNREACHABLE = "server unreachable"
+SESSION_CONTROLLER_ERROR = "controller error"
+SESSION_FAILED = "failed"
+
+DEFAULT_METADATA_ADDRESS = "tcp://172.17.0.1:5556"
+# Metadata kept for each kind of topic, the kinds are matched in the topic name
+METADATA_TOPICS = {"MODEM": "interface", "GPS": "gps"}
+DEFAULT_METADATA_BUFFER_SIZE = 3600
+DEFAULT_METADATA_INTERVALS = {"MODEM": 1.0, "GPS": 1.0}  # seconds
+METADATA_STOP_COMMAND = 0
+METADATA_COLLECT_COMMAND = 1
 
 
 class MetadataProducer(multiprocessing.Process):
-    def __init__(self, interface, execution, commands_queue, results_queue):
+    # Collects the MONROE metadata until stopped. For each kind of topic a bounded ring buffer keeps the messages of
+    # a topic at least its interval apart. The parent stops the producer, and gets the metadata, through a pipe.
+    def __init__(self, interface, execution, buffer_size=DEFAULT_METADATA_BUFFER_SIZE, intervals=None,
+                 address=DEFAULT_METADATA_ADDRESS):
         multiprocessing.Process.__init__(self)
         self.interface = interface
         self.execution = execution
-        self.commands = commands_queue
-        self.results = results_queue
+        self.buffer_size = buffer_size
+        self.intervals = dict(DEFAULT_METADATA_INTERVALS)
+        if intervals is not None:
+            self.intervals.update(intervals)
+        self.address = address
+        self.control, self.producer_control = multiprocessing.Pipe()
+
+    def start(self):
+        multiprocessing.Process.start(self)
+        # Only the producer keeps its end open, so collect gets EOF instead of blocking if the producer died
+        self.producer_control.close()
+
+    def stop(self):
+        # Ends the collection discarding the metadata
+        try:
+            self.control.send(METADATA_STOP_COMMAND)
+        except IOError:
+            pass
+
+    def collect(self):
+        # Ends the collection and returns the metadata
+        try:
+            self.control.send(METADATA_COLLECT_COMMAND)
+            return self.control.recv()
+        except (IOError, EOFError):
+            return dict()
 
     def run(self):
+        self.control.close()
         context = zmq.Context()
         socket = context.socket(zmq.SUB)
-        socket.connect("tcp://172.17.0.1:5556")
+        socket.connect(self.address)
         topic_filter = ""  # ""MONROE.META.DEVICE.MODEM"
         socket.setsockopt(zmq.SUBSCRIBE, topic_filter)
-        socket.setsockopt(zmq.RCVTIMEO, 1000)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self.producer_control.fileno(), zmq.POLLIN)
+        buffers = dict((key, collections.deque(maxlen=self.buffer_size)) for key in METADATA_TOPICS.values())
+        last_kept = dict()
+        command = None
+        while command is None:
+            events = dict(poller.poll())
+            if socket in events:
+                while True:
+                    try:
+                        msg = socket.recv(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    msg = msg.split(None, 1)
+                    if len(msg) != 2:
+                        continue
+                    kinds = [kind for kind in METADATA_TOPICS if kind in msg[0]]
+                    if not kinds or kinds[0] == "MODEM" and "InternalInterface" not in msg[1]:
+                        continue
+                    now = time.time()
+                    if now - last_kept.get(msg[0], 0) < self.intervals[kinds[0]]:
+                        continue
+                    last_kept[msg[0]] = now
+                    # Messages are decoded only when handed off, on long runs most of them are dropped by then
+                    buffers[METADATA_TOPICS[kinds[0]]].append((now, msg[1]))
+            if self.producer_control.fileno() in events:
+                command = self.producer_control.recv()
+        socket.close(0)
+        context.term()
+        if command != METADATA_COLLECT_COMMAND:
+            self.producer_control.close()
+            return
         meta_data = dict()
-        interface_meta = dict()
-        gps_meta = dict()
-        while True:
-            msg = ""
-            try:
-                msg = socket.recv()
-            except Exception as e:
-                print e.message
-            msg = msg.split(None, 1)
-            if len(msg) == 2:
-                if "MODEM" in msg[0]:
-                    interface = json.loads(msg[1])
-                    if "InternalInterface" in interface:
-                        interface_meta[time.time()] = interface
-                elif "GPS" in msg[0]:
-                    gps_meta[time.time()] = json.loads(msg[1])
-            try:
-                command = self.commands.get(False)
-                if command:
-                    break
-            except Queue.Empty:
-                pass
-        meta_data["interface"] = interface_meta
-        meta_data["gps"] = gps_meta
+        for key, buffered in buffers.items():
+            meta_data[key] = dict()
+            for t, payload in buffered:
+                try:
+                    meta_data[key][t] = json.loads(payload)
+                except ValueError:
+                    pass
         try:
             with open("/tmp/paris_" + self.interface + "_" + str(self.execution) + ".txt", "r") as f:
                 paris = f.read()
@@ -71,7 +134,446 @@ class MetadataProducer(multiprocessing.Process):
                 meta_data["tracebox_53674"] = json.loads(tracebox)
         except IOError, ioe:
             print ioe.message
-        self.results.put(meta_data)
+        self.producer_control.send(meta_data)
+        self.producer_control.close()
+
+
+def send_result(controller, uploader, spool, status, command, port, result=None):
+    # The result is spooled before it is sent, it is not lost if the control connection drops
+    if spool is not None:
+        spool.store(command, port, status, result)
+    if uploader is None:
+        controller.send_control_msg(status, result)
+    else:
+        # Pipelined session: the status unblocks the server, the result follows while the next phase starts
+        controller.send_control_msg(status)
+        if result is not None:
+            uploader.upload(command, port, result)
+
+
+def sweep_burst(port, server_address, interface, phase, duration, entry, logger):
+    # Tester errors share the codes of the client statuses
+    result = dict()
+    tester = None
+    try:
+        tester = handlers.Tester(port, handlers.ROLE_CLIENT, interface=interface)
+        tester.connect(server_address, interface=interface, timeout=sweep.SWEEP_CONNECT_TIMEOUT)
+        tester.do_test(test.TCPBTTest(), phase, handlers.TEST_SPEEDTEST_TYPE, result, [], duration)
+        entry["status"] = handlers.CONTROLLER_OK_MSG
+    except handlers.TesterException as te:
+        logger.info("Sweep burst on port %i failed: %s, %i" % (port, te.message, te.error))
+        entry["status"] = te.error
+    finally:
+        if tester is not None:
+            tester.close_test_connection()
+    if phase == handlers.TEST_DOWNLINK_PHASE:
+        entry["speedtest"] = result
+
+
+def sweep_batch(ports, server_address, interface, phase, duration, logger):
+    # Bursts on all the ports of a batch at the same time, the server bounds the size of batches
+    entries = dict((str(port), dict()) for port in ports)
+    threads = [threading.Thread(target=sweep_burst, args=(port, server_address, interface, phase, duration,
+                                                          entries[str(port)], logger)) for port in ports]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return entries
+
+
+def upload_spooled_sessions(controller, spool, logger):
+    # Sessions spooled by previous runs are uploaded one at a time, each removed once the server acknowledges it.
+    # A session refused by the server is kept, its measurements are not dropped.
+    uploaded = 0
+    for spooled in spool.pending():
+        logger.info("Uploading spooled session %s, %i results" % (spooled["session"], len(spooled["phases"])))
+        controller.send_control_msg(handlers.CONTROLLER_SPOOL_MSG, spooled)
+        msg, extra = controller.recv_control_msg()
+        if msg == handlers.CONTROLLER_SPOOL_REJECT_MSG:
+            logger.error("Spooled session %s refused by the server, kept in the spool: %s" %
+                         (spooled["session"], extra))
+            continue
+        if msg != handlers.CONTROLLER_SPOOL_ACK_MSG or extra != spooled["session"]:
+            raise handlers.ControllerException("Spooled session %s not acknowledged" % spooled["session"])
+        spool.remove(extra)
+        uploaded += 1
+    return uploaded
+
+
+def control_session(controller, interface, server_address, bt_test, ct_test, http_result, stop_interfaces, duration,
+                    logger, monroe=False, producer=None, report=None, probes=None, spool=None, udp_bt_test=None,
+                    udp_ct_test=None, sweep_burst_duration=sweep.DEFAULT_SWEEP_BURST, third_test=None):
+    uploader = None
+    if udp_bt_test is None:
+        udp_bt_test = test.UDPBTTest()
+    if udp_ct_test is None:
+        udp_ct_test = test.UDPTest()
+    # The trace of the third test is replayed only once the server has the same, otherwise the server runs the
+    # control test or no third test
+    trace_test = third_test
+    third_test = ct_test
+    retry_after = None
+    if report is None:
+        report = dict()
+    report["outcome"] = SESSION_CONTROLLER_ERROR
+    while True:
+        try:
+            msg, port = controller.recv_control_msg()
+        except handlers.ControllerException as ce:
+            logger.critical(" Controller error, exiting: %s" % ce.message)
+            if monroe:
+                producer.stop()
+            break
+        if msg == handlers.CONTROLLER_ABORT_MEASURE_MSG:
+            logger.info("Received abort measure message")
+            report["outcome"] = SESSION_ABORTED
+            if monroe:
+                producer.stop()
+            break
+        elif msg == handlers.CONTROLLER_FINISH_MEASURE_MSG:
+            logger.info("Received finish measure message")
+            report["outcome"] = SESSION_FINISHED
+            if spool is not None:
+                spool.close_session(delivered=True)
+            if monroe:
+                producer.stop()
+            break
+        elif msg == handlers.CONTROLLER_RETRY_AFTER_MSG:
+            logger.info("Received retry after message, %i seconds" % port)
+            report["outcome"] = SESSION_BUSY
+            retry_after = port
+            break
+        elif msg == handlers.CONTROLLER_SESSION_MSG:
+            logger.info("Received session id %s" % port)
+            try:
+                if spool is not None:
+                    spool.open_session(port)
+                    report["spool_uploads"] = report.get("spool_uploads", 0) + \
+                        upload_spooled_sessions(controller, spool, logger)
+                controller.send_control_msg(handlers.CONTROLLER_OK_MSG)
+            except handlers.ControllerException as ce:
+                logger.critical(" Controller error, exiting: %s" % ce.message)
+                if monroe:
+                    producer.stop()
+                break
+            continue
+        elif msg == handlers.CONTROLLER_TRACE_MSG:
+            digest = None if trace_test is None else trace_test.trace.digest()
+            report["trace_replayed"] = digest == port
+            if report["trace_replayed"]:
+                logger.info("Received trace digest %s, replaying it in the third test" % port)
+                third_test = trace_test
+            else:
+                logger.error("Received trace digest %s, the client trace is %s, no third test" % (port, digest))
+            try:
+                controller.send_control_msg(handlers.CONTROLLER_OK_MSG, {"trace": digest})
+            except handlers.ControllerException as ce:
+                logger.critical(" Controller error, exiting: %s" % ce.message)
+                if monroe:
+                    producer.stop()
+                break
+            continue
+        elif msg == handlers.CONTROLLER_PIPELINE_MSG:
+            logger.info("Received message pipeline")
+            if uploader is None:
+                uploader = handlers.ResultUploader(controller)
+                uploader.start()
+            continue
+        elif msg == handlers.CONTROLLER_START_UB_MSG:
+            if port is None:
+                logger.error("Error: port is None")
+                continue
+            logger.info("Received message start UB, port %i" % port)
+            test_var = bt_test
+            phase = handlers.TEST_UPLINK_PHASE
+        elif msg == handlers.CONTROLLER_START_UC_MSG:
+            if port is None:
+                logger.error("Error: port is None")
+                continue
+            logger.info("Received message start UC, port %i" % port)
+            test_var = ct_test
+            phase = handlers.TEST_UPLINK_PHASE
+        elif msg == handlers.CONTROLLER_START_DB_MSG:
+            if port is None:
+                logger.error("Error: port is None")
+                continue
+            logger.info("Received message start DB, port %i" % port)
+            test_var = bt_test
+            phase = handlers.TEST_DOWNLINK_PHASE
+        elif msg == handlers.CONTROLLER_START_DC_MSG:
+            if port is None:
+                logger.error("Error: port is None")
+                continue
+            logger.info("Received message start DC, port %i" % port)
+            test_var = ct_test
+            phase = handlers.TEST_DOWNLINK_PHASE
+        elif msg == handlers.CONTROLLER_START_UT_MSG:
+            if port is None:
+                logger.error("Error: port is None")
+                continue
+            logger.info("Received message start UT, port %i" % port)
+            test_var = third_test
+            phase = handlers.TEST_UPLINK_PHASE
+        elif msg == handlers.CONTROLLER_START_DT_MSG:
+            if port is None:
+                logger.error("Error: port is None")
+                continue
+            logger.info("Received message start DT, port %i" % port)
+            test_var = third_test
+            phase = handlers.TEST_DOWNLINK_PHASE
+        elif msg in handlers.UDP_START_MESSAGES:
+            if port is None:
+                logger.error("Error: port is None")
+                continue
+            logger.info("Received message start UDP phase %i, port %i" % (msg, port))
+            if msg in [handlers.CONTROLLER_START_UUB_MSG, handlers.CONTROLLER_START_UDB_MSG]:
+                test_var = udp_bt_test
+            else:
+                test_var = udp_ct_test
+            if msg in [handlers.CONTROLLER_START_UUB_MSG, handlers.CONTROLLER_START_UUC_MSG]:
+                phase = handlers.TEST_UPLINK_PHASE
+            else:
+                phase = handlers.TEST_DOWNLINK_PHASE
+        elif msg in handlers.SWEEP_MESSAGES:
+            logger.info("Received message start sweep %i, ports %s" % (msg, ",".join(str(p) for p in port)))
+            if msg == handlers.CONTROLLER_START_USWEEP_MSG:
+                phase = handlers.TEST_UPLINK_PHASE
+            else:
+                phase = handlers.TEST_DOWNLINK_PHASE
+            heartbeat = handlers.Heartbeat(controller)
+            heartbeat.start()
+            try:
+                entries = sweep_batch(port, server_address, interface, phase, sweep_burst_duration, logger)
+            finally:
+                heartbeat.stop()
+            report["sweep_bursts"] = report.get("sweep_bursts", 0) + len(entries)
+            try:
+                # The server needs the results of a batch to choose the next one, they are neither spooled nor
+                # pipelined
+                controller.send_control_msg(handlers.CONTROLLER_OK_MSG, entries)
+            except handlers.ControllerException as ce:
+                logger.critical(" Controller error, exiting: %s" % ce.message)
+                if monroe:
+                    producer.stop()
+                break
+            continue
+        elif msg == handlers.CONTROLLER_SEND_META_DATA_MSG:
+            logger.info("Received message send meta data")
+            if monroe:
+                heartbeat = handlers.Heartbeat(controller)
+                heartbeat.start()
+                try:
+                    meta_data = producer.collect()
+                finally:
+                    heartbeat.stop()
+            else:
+                meta_data = dict()
+            if probes is not None:
+                # The outputs of the built-in probes replace the ones found by the metadata producer
+                heartbeat = handlers.Heartbeat(controller)
+                heartbeat.start()
+                try:
+                    meta_data.update(probes.results())
+                finally:
+                    heartbeat.stop()
+            meta_data["http_test"] = http_result
+            logger.info("Metadata: %s" % meta_data)
+            if spool is not None:
+                spool.store_meta_data(meta_data)
+            if uploader is not None:
+                logger.info("Waiting for pending result uploads")
+                try:
+                    uploader.flush()
+                except handlers.ControllerException as ce:
+                    logger.critical(" Controller error, exiting: %s" % ce.message)
+                    if monroe:
+                        producer.stop()
+                    break
+            logger.info("Sending data to server")
+            controller.send_control_msg(handlers.CONTROLLER_OK_MSG, meta_data)
+            continue
+        try:
+            result = dict()
+            if probes is not None:
+                logger.info("Waiting for tracebox probes")
+                probes.wait_port_probes()
+            logger.info("Instantiate tester")
+            tester = handlers.Tester(port, handlers.ROLE_CLIENT, interface=interface,
+                                     datagram=msg in handlers.UDP_START_MESSAGES)
+            try:
+                logger.info("Connecting tester to server")
+                tester.connect(server_address, interface=interface)
+                if uploader is not None:
+                    # The server starts the test once the uploads of the previous phases are over
+                    logger.info("Waiting for pending result uploads")
+                    uploader.flush()
+                    controller.send_control_msg(handlers.CONTROLLER_PIPELINE_MSG)
+                logger.info("Starting test")
+                # Let the server know we are alive while it is not reading the control connection
+                heartbeat = handlers.Heartbeat(controller)
+                heartbeat.start()
+                try:
+                    for test_type in [handlers.TEST_SPEEDTEST_TYPE, handlers.TEST_TRACEROUTE_TYPE]:
+                        logger.info("Starting test %i" % test_type)
+                        tester.do_test(test_var, phase, test_type, result, stop_interfaces, duration)
+                        if phase == handlers.TEST_UPLINK_PHASE and test_type == handlers.TEST_SPEEDTEST_TYPE:
+                            logger.info("Sleeping")
+                            time.sleep(10)
+                        if msg == handlers.CONTROLLER_START_UT_MSG or msg == handlers.CONTROLLER_START_DT_MSG or \
+                                msg in handlers.UDP_START_MESSAGES:
+                            break
+                finally:
+                    heartbeat.stop()
+                if msg in handlers.UDP_START_MESSAGES and phase == handlers.TEST_DOWNLINK_PHASE:
+                    # the datagram statistics are sent next to the samples
+                    result = {"speedtest": result, "udp": test_var.statistics}
+                logger.info("Sending result to server")
+                send_result(controller, uploader, spool, handlers.CONTROLLER_OK_MSG, msg, port, result)
+                report["tests"] = report.get("tests", 0) + 1
+            except handlers.TesterException as test_exc:
+                report["failed_tests"] = report.get("failed_tests", 0) + 1
+                if test_exc.errno is None:
+                    logger.error("Test failed %s, %i" % (test_exc.message, test_exc.error))
+                else:
+                    logger.error("Test failed %s, %i, %i" % (test_exc.message, test_exc.error, test_exc.errno))
+                if test_exc.error == handlers.TESTER_CONNECT_TIMEOUT_ERROR:
+                    send_result(controller, uploader, spool, handlers.CONTROLLER_CLIENT_CONNECT_TIMEOUT_ERROR, msg,
+                                port)
+                elif test_exc.error == handlers.TESTER_CONNECT_REFUSED_ERROR:
+                    send_result(controller, uploader, spool, handlers.CONTROLLER_CLIENT_CONNECT_REFUSED_ERROR, msg,
+                                port)
+                elif test_exc.error == handlers.TESTER_CONNECT_GENERIC_ERROR:
+                    send_result(controller, uploader, spool, handlers.CONTROLLER_CLIENT_CONNECT_GENERIC_ERROR, msg,
+                                port)
+                elif test_exc.error == handlers.TESTER_TEST_RESET_ERROR:
+                    send_result(controller, uploader, spool, handlers.CONTROLLER_CLIENT_TEST_RESET_ERROR, msg, port,
+                                result)
+                elif test_exc.error == handlers.TESTER_TEST_ABORT_ERROR:
+                    send_result(controller, uploader, spool, handlers.CONTROLLER_CLIENT_TEST_ABORT_ERROR, msg, port,
+                                result)
+                elif test_exc.error == handlers.TESTER_TEST_TIMEOUT_ERROR:
+                    send_result(controller, uploader, spool, handlers.CONTROLLER_CLIENT_TEST_TIMEOUT_ERROR, msg, port,
+                                result)
+                elif test_exc.error == handlers.TESTER_TEST_GENERIC_ERROR:
+                    send_result(controller, uploader, spool, handlers.CONTROLLER_CLIENT_TEST_GENERIC_ERROR, msg, port,
+                                result)
+            finally:
+                logger.info("Closing test connection")
+                tester.close_test_connection()
+        except handlers.TesterException as te:
+            if te.errno is None:
+                logger.error("Test failed %s, %i" % (te.message, te.error))
+            else:
+                logger.error("Test failed %s, %i, %i" % (te.message, te.error, te.errno))
+            report["failed_tests"] = report.get("failed_tests", 0) + 1
+            if te.error == handlers.TESTER_INIT_CLIENT_ERROR:
+                controller.send_control_msg(handlers.CONTROLLER_CLIENT_TEST_INIT_ERROR)
+    if uploader is not None:
+        uploader.stop()
+    if spool is not None:
+        spool.close_session()
+    return retry_after
+
+
+def interface_session(interface, server_address, server_port, duration, stop_interfaces, http_file, monroe,
+                      execution, retries, metadata_buffer=DEFAULT_METADATA_BUFFER_SIZE, metadata_intervals=None,
+                      probe_options=None, spool_directory=None, http_port=handlers.HTTP_PORT, http_size=None,
+                      udp_rate=test.DEFAULT_UDP_RATE, sweep_burst_duration=sweep.DEFAULT_SWEEP_BURST, trace=None,
+                      trace_full_speed=False, bt_test=None, ct_test=None):
+    # Full NeutMon session on an interface: metadata collection, HTTP test and control session, retried while the
+    # server is busy or unreachable. Returns the report of the session.
+    logger = logging.getLogger("neutmon")
+    if interface != "":
+        logger = logger.getChild(interface)
+    report = {"interface": interface, "start": time.time(), "attempts": 0, "tests": 0, "failed_tests": 0,
+              "http_error": None}
+    if bt_test is None:
+        bt_test = test.TCPBTTest()
+    if ct_test is None:
+        ct_test = test.TCPRandomTest()
+    udp_bt_test = test.UDPBTTest(udp_rate)
+    udp_ct_test = test.UDPTest(udp_rate)
+    third_test = None if trace is None else test.TCPTraceTest(trace, trace_full_speed)
+    producer = None
+    if monroe:
+        producer = MetadataProducer(interface, execution, metadata_buffer, metadata_intervals)
+        producer.start()
+    probes = None
+    if probe_options is not None:
+        logger.info("Starting path probes")
+        probes = pathprobes.PathProbes(server_address, interface, **probe_options)
+        probes.start()
+    spool = None
+    if spool_directory is not None:
+        spool = handlers.ResultSpool(spool_directory)
+    http_result = dict()
+    if http_file is not None:
+        http_test = test.TCPHTTPTest(server_address, http_file, object_size=http_size)
+        try:
+            logger.info("Instantiate HTTP tester")
+            tester = handlers.Tester(http_port, handlers.ROLE_CLIENT, interface=interface)
+            logger.info("Connecting tester to server")
+            tester.connect(server_address, interface=interface)
+            logger.info("Starting test")
+            tester.do_test(http_test, handlers.TEST_DOWNLINK_PHASE, handlers.TEST_SPEEDTEST_TYPE, http_result, [])
+            logger.info("Closing test connection")
+            tester.close_test_connection()
+        except handlers.TesterException as test_exc:
+            if test_exc.errno is None:
+                logger.error("Test failed %s, %i" % (test_exc.message, test_exc.error))
+            else:
+                logger.error("Test failed %s, %i, %i" % (test_exc.message, test_exc.error, test_exc.errno))
+            http_result["error"] = "Test failed %s, %i" % (test_exc.message, test_exc.error)
+            report["http_error"] = http_result["error"]
+    else:
+        logger.info("HTTP test not requested")
+    logger.info("Initializing control connection to server")
+    attempts = 0
+    while True:
+        report["attempts"] += 1
+        connector = handlers.Connector()
+        try:
+            connector.connect(server_address, server_port, interface=interface, timeout=30)
+        except handlers.ConnectorException as ce:
+            logger.error(ce.message)
+            report["outcome"] = SESSION_UNREACHABLE
+            retry_after = handlers.DEFAULT_CONNECT_RETRY_INTERVAL * (attempts + 1)
+        else:
+            controller = handlers.Controller(connector.connector_socket, handlers.ROLE_CLIENT)
+            retry_after = control_session(controller, interface, server_address, bt_test, ct_test, http_result,
+                                          stop_interfaces, duration, logger, monroe, producer, report, probes,
+                                          spool, udp_bt_test, udp_ct_test, sweep_burst_duration, third_test)
+        connector.close_connection()
+        if retry_after is None:
+            break
+        attempts += 1
+        if attempts > retries:
+            logger.critical("Server not available after %i attempts, exiting" % attempts)
+            if monroe:
+                producer.stop()
+            break
+        logger.warning("Server busy, retrying in %i seconds" % retry_after)
+        time.sleep(retry_after)
+    if monroe:
+        producer.join()
+    if probes is not None:
+        probes.stop()
+        report["probes"] = probes.report
+    report["end"] = time.time()
+    return report
+
+
+def interface_session_process(reports_queue, interface, *session_args):
+    # The parent waits for a report from every process, so one is sent also when the session fails
+    start = time.time()
+    try:
+        report = interface_session(interface, *session_args)
+    except Exception as e:
+        logging.getLogger("neutmon").critical("Session on interface %s failed: %s" % (interface, e))
+        report = {"interface": interface, "start": start, "end": time.time(), "attempts": 0, "tests": 0,
+                  "failed_tests": 0, "http_error": None, "outcome": SESSION_FAILED}
+    reports_queue.put(report)
 
 
 def main(argv):
@@ -88,6 +590,51 @@ def main(argv):
     parser.add_argument("-S", "--stop", help="stop traceroute when the interface(s) specified is (are) encountered")
     parser.add_argument("-t", "--http", help="execute HTTP test before the NeutMon tests", action="store_true")
     parser.add_argument("-f", "--file", help="http test file. if not specified file defaults to http_test.txt")
+    parser.add_argument("--http_port", type=int, default=handlers.HTTP_PORT,
+                        help="port of the http test. the default value is %i" % handlers.HTTP_PORT)
+    parser.add_argument("-z", "--http_size", type=int,
+                        help="download only the first HTTP_SIZE bytes of the http test file, with a range request")
+    parser.add_argument("--udp_rate", type=float, default=test.DEFAULT_UDP_RATE,
+                        help="sending rate (in Mbps) of the uplink UDP phases, run when the server asks for them. "
+                             "the default value is %i" % test.DEFAULT_UDP_RATE)
+    parser.add_argument("--sweep_burst", type=int, default=sweep.DEFAULT_SWEEP_BURST,
+                        help="duration (in seconds) of the uplink bursts of port sweeps, run when the server asks for "
+                             "them. the default value is %i" % sweep.DEFAULT_SWEEP_BURST)
+    parser.add_argument("--trace", metavar="PCAP",
+                        help="replay a TCP flow of a capture, by default the one with the most payload, in the three "
+                             "way tests. it is replayed only if the server replays the same flow, otherwise the third "
+                             "test is skipped")
+    parser.add_argument("--trace_port", type=int, help="replay the flow with the most payload on this port")
+    parser.add_argument("--trace_full_speed", action="store_true",
+                        help="send the uplink trace replays back to back instead of with the recorded pacing")
+    parser.add_argument("-r", "--retries", type=int, default=handlers.DEFAULT_CONNECT_RETRIES,
+                        help="number of attempts to reach the server again when it is busy or unreachable. the "
+                             "default value is %i" % handlers.DEFAULT_CONNECT_RETRIES)
+    parser.add_argument("-B", "--metadata_buffer", type=int, default=DEFAULT_METADATA_BUFFER_SIZE,
+                        help="in monroe, number of modem and of GPS metadata messages kept. the default value is %i"
+                             % DEFAULT_METADATA_BUFFER_SIZE)
+    parser.add_argument("-M", "--modem_interval", type=float, default=DEFAULT_METADATA_INTERVALS["MODEM"],
+                        help="in monroe, minimum interval (in seconds) between the kept messages of a modem")
+    parser.add_argument("-G", "--gps_interval", type=float, default=DEFAULT_METADATA_INTERVALS["GPS"],
+                        help="in monroe, minimum interval (in seconds) between the kept GPS messages")
+    parser.add_argument("-P", "--probes", action="store_true",
+                        help="run paris-traceroute and tracebox towards the server during the session")
+    parser.add_argument("--paris_binary", default=pathprobes.DEFAULT_PARIS_BINARY,
+                        help="paris-traceroute executable. the default value is %s" % pathprobes.DEFAULT_PARIS_BINARY)
+    parser.add_argument("--tracebox_binary", default=pathprobes.DEFAULT_TRACEBOX_BINARY,
+                        help="tracebox executable. the default value is %s" % pathprobes.DEFAULT_TRACEBOX_BINARY)
+    parser.add_argument("-T", "--probe_timeout", type=int, default=pathprobes.DEFAULT_PROBE_TIMEOUT,
+                        help="seconds after which paris-traceroute and tracebox are killed. the default value is %i"
+                             % pathprobes.DEFAULT_PROBE_TIMEOUT)
+    parser.add_argument("-u", "--spool", default=handlers.DEFAULT_SPOOL_DIRECTORY,
+                        help="directory where results are kept until the server has stored them. the default value is "
+                             "%s" % handlers.DEFAULT_SPOOL_DIRECTORY)
+    parser.add_argument("-n", "--no_spool", action="store_true", help="do not spool results")
+    parser.add_argument("-c", "--concurrent", action="store_true",
+                        help="test the interfaces at the same time, each in its own process")
+    parser.add_argument("-R", "--report", default="neutmon_client_report.json",
+                        help="file where to write the report of the sessions. the default value is "
+                             "neutmon_client_report.json")
     parser.add_argument("-l", "--log", help="set the logging level. possible values are DEBUG, INFO, WARNING, ERROR,"
                                             "and CRITICAL. if not specified the default value is WARNING")
     parser.add_argument("-g", "--logfile", help="set the output file for logs. the default value is neutmon_client.log")
@@ -159,174 +706,53 @@ def main(argv):
         logger.critical("In MONROE mode the execution number must be provided")
         exit(1)
 
-    for interface in interfaces:
-        bt_test = test.TCPBTTest()
-        ct_test = test.TCPRandomTest()
-        if args.monroe:
-            manager = multiprocessing.Manager()
-            commands_queue = manager.Queue()
-            results_queue = manager.Queue()
-            mp = MetadataProducer(interface, args.execution, commands_queue, results_queue)
-            mp.start()
-        http_result = dict()
-        if args.http:
-            if args.file:
-                http_file = args.file
-            else:
-                http_file = handlers.DEFAULT_HTTP_TEST_PATH
-            http_test = test.TCPHTTPTest(server_address, http_file)
-            try:
-                logger.info("Instantiate HTTP tester")
-                tester = handlers.Tester(80, handlers.ROLE_CLIENT, interface=interface)
-                logger.info("Connecting tester to server")
-                tester.connect(server_address, interface=interface)
-                logger.info("Starting test")
-                tester.do_test(http_test, handlers.TEST_DOWNLINK_PHASE, handlers.TEST_SPEEDTEST_TYPE, http_result, [])
-                logger.info("Closing test connection")
-                tester.close_test_connection()
-            except handlers.TesterException as test_exc:
-                if test_exc.errno is None:
-                    logger.error("Test failed %s, %i" % (test_exc.message, test_exc.error))
-                else:
-                    logger.error("Test failed %s, %i, %i" % (test_exc.message, test_exc.error, test_exc.errno))
-                http_result["error"] = "Test failed %s, %i" % (test_exc.message, test_exc.error)
+    if args.http:
+        if args.file:
+            http_file = args.file
         else:
-            logger.info("HTTP test not requested")
-        logger.info("Initializing control connection to server")
-        connector = handlers.Connector()
-        connector.connect(server_address, server_port, interface=interface, timeout=30)
-        controller = handlers.Controller(connector.connector_socket, handlers.ROLE_CLIENT)
-        while True:
-            try:
-                msg, port = controller.recv_control_msg()
-            except handlers.ControllerException as ce:
-                logger.critical(" Controller error, exiting: %s" % ce.message)
-                if args.monroe:
-                    commands_queue.put(True)
-                break
-            if msg == handlers.CONTROLLER_ABORT_MEASURE_MSG:
-                logger.info("Received abort measure message")
-                if args.monroe:
-                    try:
-                        commands_queue.put(True)
-                    except IOError:
-                        pass
-                break
-            elif msg == handlers.CONTROLLER_FINISH_MEASURE_MSG:
-                logger.info("Received finish measure message")
-                if args.monroe:
-                    try:
-                        commands_queue.put(True)
-                    except IOError:
-                        pass
-                break
-            elif msg == handlers.CONTROLLER_START_UB_MSG:
-                if port is None:
-                    logger.error("Error: port is None")
-                    continue
-                logger.info("Received message start UB, port %i" % port)
-                test_var = bt_test
-                phase = handlers.TEST_UPLINK_PHASE
-            elif msg == handlers.CONTROLLER_START_UC_MSG:
-                if port is None:
-                    logger.error("Error: port is None")
-                    continue
-                logger.info("Received message start UC, port %i" % port)
-                test_var = ct_test
-                phase = handlers.TEST_UPLINK_PHASE
-            elif msg == handlers.CONTROLLER_START_DB_MSG:
-                if port is None:
-                    logger.error("Error: port is None")
-                    continue
-                logger.info("Received message start DB, port %i" % port)
-                test_var = bt_test
-                phase = handlers.TEST_DOWNLINK_PHASE
-            elif msg == handlers.CONTROLLER_START_DC_MSG:
-                if port is None:
-                    logger.error("Error: port is None")
-                    continue
-                logger.info("Received message start DC, port %i" % port)
-                test_var = ct_test
-                phase = handlers.TEST_DOWNLINK_PHASE
-            elif msg == handlers.CONTROLLER_START_UT_MSG:
-                if port is None:
-                    logger.error("Error: port is None")
-                    continue
-                logger.info("Received message start UT, port %i" % port)
-                test_var = ct_test
-                phase = handlers.TEST_UPLINK_PHASE
-            elif msg == handlers.CONTROLLER_START_DT_MSG:
-                if port is None:
-                    logger.error("Error: port is None")
-                    continue
-                logger.info("Received message start DT, port %i" % port)
-                test_var = ct_test
-                phase = handlers.TEST_DOWNLINK_PHASE
-            elif msg == handlers.CONTROLLER_SEND_META_DATA_MSG:
-                logger.info("Received message send meta data")
-                if args.monroe:
-                    commands_queue.put(True)
-                    meta_data = results_queue.get()
-                else:
-                    meta_data = dict()
-                meta_data["http_test"] = http_result
-                logger.info("Metadata: %s" % meta_data)
-                logger.info("Sending data to server")
-                controller.send_control_msg(handlers.CONTROLLER_OK_MSG, meta_data)
-                continue
-            try:
-                result = dict()
-                logger.info("Instantiate tester")
-                tester = handlers.Tester(port, handlers.ROLE_CLIENT, interface=interface)
-                try:
-                    logger.info("Connecting tester to server")
-                    tester.connect(server_address, interface=interface)
-                    logger.info("Starting test")
-                    for test_type in [handlers.TEST_SPEEDTEST_TYPE, handlers.TEST_TRACEROUTE_TYPE]:
-                        logger.info("Starting test %i" % test_type)
-                        tester.do_test(test_var, phase, test_type, result, stop_interfaces, duration)
-                        if phase == handlers.TEST_UPLINK_PHASE and test_type == handlers.TEST_SPEEDTEST_TYPE:
-                            logger.info("Sleeping")
-                            time.sleep(10)
-                        if msg == handlers.CONTROLLER_START_UT_MSG or msg == handlers.CONTROLLER_START_DT_MSG:
-                            break
-                    logger.info("Sending result to server")
-                    controller.send_control_msg(handlers.CONTROLLER_OK_MSG, result)
-                except handlers.TesterException as test_exc:
-                    if test_exc.errno is None:
-                        logger.error("Test failed %s, %i" % (test_exc.message, test_exc.error))
-                    else:
-                        logger.error("Test failed %s, %i, %i" % (test_exc.message, test_exc.error, test_exc.errno))
-                    if test_exc.error == handlers.TESTER_CONNECT_TIMEOUT_ERROR:
-                        controller.send_control_msg(handlers.CONTROLLER_CLIENT_CONNECT_TIMEOUT_ERROR)
-                    elif test_exc.error == handlers.TESTER_CONNECT_REFUSED_ERROR:
-                        controller.send_control_msg(handlers.CONTROLLER_CLIENT_CONNECT_REFUSED_ERROR)
-                    elif test_exc.error == handlers.TESTER_CONNECT_GENERIC_ERROR:
-                        controller.send_control_msg(handlers.CONTROLLER_CLIENT_CONNECT_GENERIC_ERROR)
-                    elif test_exc.error == handlers.TESTER_TEST_RESET_ERROR:
-                        controller.send_control_msg(handlers.CONTROLLER_CLIENT_TEST_RESET_ERROR, result)
-                    elif test_exc.error == handlers.TESTER_TEST_ABORT_ERROR:
-                        controller.send_control_msg(handlers.CONTROLLER_CLIENT_TEST_ABORT_ERROR, result)
-                    elif test_exc.error == handlers.TESTER_TEST_TIMEOUT_ERROR:
-                        controller.send_control_msg(handlers.CONTROLLER_CLIENT_TEST_TIMEOUT_ERROR, result)
-                    elif test_exc.error == handlers.TESTER_TEST_GENERIC_ERROR:
-                        controller.send_control_msg(handlers.CONTROLLER_CLIENT_TEST_GENERIC_ERROR, result)
-                finally:
-                    logger.info("Closing test connection")
-                    tester.close_test_connection()
-            except handlers.TesterException as te:
-                if te.errno is None:
-                    logger.error("Test failed %s, %i" % (te.message, te.error))
-                else:
-                    logger.error("Test failed %s, %i, %i" % (te.message, te.error, te.errno))
-                if te.error == handlers.TESTER_INIT_CLIENT_ERROR:
-                    controller.send_control_msg(handlers.CONTROLLER_CLIENT_TEST_INIT_ERROR)
-        if args.monroe:
-            # commands_queue.close()
-            # results_queue.close()
-            mp.join()
-        logger.info("Ending")
-        connector.close_connection()
+            http_file = handlers.DEFAULT_HTTP_TEST_PATH
+    else:
+        http_file = None
+    if args.trace:
+        try:
+            trace = traces.load_pcap_flow(args.trace, args.trace_port)
+        except (IOError, ValueError) as e:
+            logger.critical("Cannot load the trace: %s" % e)
+            exit(1)
+    else:
+        trace = None
+    metadata_intervals = {"MODEM": args.modem_interval, "GPS": args.gps_interval}
+    if args.probes:
+        probe_options = {"paris_binary": args.paris_binary, "tracebox_binary": args.tracebox_binary,
+                         "timeout": args.probe_timeout}
+    else:
+        probe_options = None
+    session_args = (server_address, server_port, duration, stop_interfaces, http_file, args.monroe, args.execution,
+                    args.retries, args.metadata_buffer, metadata_intervals, probe_options,
+                    None if args.no_spool else args.spool, args.http_port, args.http_size, args.udp_rate,
+                    args.sweep_burst, trace, args.trace_full_speed)
+    if args.concurrent and len(interfaces) > 1:
+        # One process per interface, each session is bound to its interface as in the sequential mode
+        reports_queue = multiprocessing.Queue()
+        sessions = []
+        for interface in interfaces:
+            session = multiprocessing.Process(target=interface_session_process,
+                                              args=(reports_queue, interface) + session_args)
+            session.start()
+            sessions.append(session)
+        reports = [reports_queue.get() for session in sessions]
+        for session in sessions:
+            session.join()
+        reports.sort(key=lambda r: interfaces.index(r["interface"]))
+    else:
+        reports = [interface_session(interface, *session_args) for interface in interfaces]
+    for r in reports:
+        logger.info("Interface %s: %s, %i tests, %i failed, %.1f s" % (r["interface"], r["outcome"], r["tests"],
+                                                                      r["failed_tests"], r["end"] - r["start"]))
+    with open(args.report, "w") as f:
+        json.dump({"concurrent": args.concurrent, "start": min(r["start"] for r in reports),
+                   "end": max(r["end"] for r in reports), "interfaces": reports}, f, indent=4)
+    logger.info("Ending")
 
 
 if __name__ == "__main__":
@@ -1,3 +1,12 @@
 from handlers import *
 from test import *
 from analysis import *
+from cache import *
+from stream import *
+from batchstats import *
+from tiles import *
+from pathprobes import *
+from datagrams import *
+from sweep import *
+from traces import *
+from shaper import *
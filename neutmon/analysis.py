@@ -2,15 +2,41 @@
 
 import sys
 import collections
+import cPickle
 import contextlib
+import os
+import tempfile
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from scipy import stats
+import stream
 
 
 TRACEROUTE = 0
 SPEEDTEST = 1
-METADATA = 2
+
+# Points of each plotted line, longer series are downsampled
+DEFAULT_PLOT_POINTS = 2000
+
+# Columns of the MONROE modem and GPS metadata joined with the throughput bins, and their metadata keys
+RADIO_FIELDS = [("mode", "DeviceMode", np.float64), ("rssi", "RSSI", np.float64), ("operator", "Operator", object),
+                ("cell", "CID", object)]
+GPS_FIELDS = [("latitude", "Latitude", np.float64), ("longitude", "Longitude", np.float64)]
+# Metadata older than this (s) at the end of a bin is not joined with it
+DEFAULT_METADATA_MAX_AGE = 60
+
+TRACEROUTES_STATE_FORMAT = 3
+TRACEROUTES_AGGREGATES = ["bt_ul", "ct_ul", "bt_dl", "ct_dl", "paris", "tracebox_6881", "tracebox_6881_mods",
+                          "tracebox_53674", "tracebox_53674_mods"]
+
+# Per hop comparison of BT and CT with each other and with the paris-traceroute and tracebox references.
+# Sets are None when a reference is missing, "perc" fields are the fraction of the BT or CT set not in the other one.
+HOP_REFERENCES = ["paris", "t6881", "t53674"]
+HOP_SET_FIELDS = ["bt", "ct", "paris", "t6881", "t53674", "intersection", "only_bt", "only_ct", "only_bt_paris",
+                  "only_ct_paris", "only_bt_t6881", "only_ct_t6881", "only_bt_t53674", "only_ct_t53674"]
+HOP_PERC_FIELDS = ["only_bt_perc", "only_ct_perc", "only_bt_paris_perc", "only_ct_paris_perc", "only_bt_t6881_perc",
+                   "only_ct_t6881_perc", "only_bt_t53674_perc", "only_ct_t53674_perc"]
 
 compact_keys = ["HT", "BT", "CT", "TT"]
 compact_colors = ["b", "g", "r", "c"]
@@ -24,57 +50,130 @@ def order_dict(d, dict_type):
     elif dict_type == SPEEDTEST:
         d = {float(k): int(v) for k, v in d.items()}
     else:
-        d = {float(k): dict(v) for k, v in d.items()}
+        raise ValueError("Unknown dict type %s" % dict_type)
     ordered_dict = collections.OrderedDict()
     for key in sorted(d.keys()):
         ordered_dict[key] = d[key]
     return ordered_dict
 
 
-def filter_by_operator(d, operator):
-    dd = collections.OrderedDict()
-    for k, v in d.items():
-        if v["Operator"] == operator:
-            dd[k] = d[k]
-    return dd
+def speedtest_arrays(speed_test_dict):
+    # Samples of a speedtest as two arrays sorted by time: timestamps and received bytes
+    if isinstance(speed_test_dict, tuple):
+        return speed_test_dict
+    n = len(speed_test_dict)
+    times = np.fromiter((float(k) for k in speed_test_dict.keys()), dtype=np.float64, count=n)
+    sizes = np.fromiter((int(v) for v in speed_test_dict.values()), dtype=np.int64, count=n)
+    order = np.argsort(times, kind="mergesort")
+    return times[order], sizes[order]
+
+
+def interval_boundaries(times, min_interval=0):
+    # Indexes closing each interval longer than min_interval, starting from the first sample
+    if min_interval <= 0:
+        return np.concatenate(([0], np.flatnonzero(np.diff(times) > 0) + 1))
+    boundaries = [0]
+    while True:
+        i = np.searchsorted(times, times[boundaries[-1]] + min_interval, side="right")
+        if i >= len(times):
+            break
+        boundaries.append(i)
+    return np.array(boundaries)
 
 
 def transfer_cumulative(speed_test_dict):
-    speed_test = order_dict(speed_test_dict, SPEEDTEST)
-    times = speed_test.keys()
-    min_time = min(times)
-    interval = max(times) - min_time
-    times = [x - min_time for x in times]
-    cumulative = np.cumsum(speed_test.values())
-    total_bytes = sum(speed_test.values())
-    return times, cumulative, (float(total_bytes) * 8) / (interval * 1e6)
+    times, sizes = speedtest_arrays(speed_test_dict)
+    min_time = times[0]
+    interval = times[-1] - min_time
+    cumulative = np.cumsum(sizes)
+    return times - min_time, cumulative, (float(cumulative[-1]) * 8) / (interval * 1e6)
+
+
+def throughput_bins(speed_test_dict, min_interval=0):
+    # Start, end and throughput (Mbps) of each interval longer than min_interval, in time order
+    times, sizes = speedtest_arrays(speed_test_dict)
+    # Bytes of the first sample are not part of any interval
+    boundaries = interval_boundaries(times, min_interval)
+    cumulative = np.cumsum(sizes)
+    byte_amounts = cumulative[boundaries[1:]] - cumulative[boundaries[:-1]]
+    intervals = times[boundaries[1:]] - times[boundaries[:-1]]
+    return times[boundaries[:-1]], times[boundaries[1:]], (byte_amounts.astype(np.float64) * 8) / (intervals * 1e6)
 
 
 def throughput_cdf(speed_test_dict, min_interval=0):
-    speed_test = order_dict(speed_test_dict, SPEEDTEST)
-    prev_key = 0
-    interval = 0
-    byte_amount = 0
-    throughput = []
-    for key in sorted(speed_test.keys()):
-        if prev_key == 0:
-            prev_key = key
-            continue
-        interval += key - prev_key
-        byte_amount += speed_test[key]
-        prev_key = key
-        if interval > min_interval:
-            throughput.append((float(byte_amount) * 8) / (interval * 1e6))
-            interval = 0
-            byte_amount = 0
-    throughput = sorted(throughput)
+    throughput = np.sort(throughput_bins(speed_test_dict, min_interval)[2])
     n = len(throughput)
-    y = []
     if n == 1:
         return [throughput[0], throughput[0]], [0, 1]
-    for x in range(n):
-        y.append(float(x) / (n - 1))
-    return throughput, y
+    return throughput, np.arange(n, dtype=np.float64) / (n - 1)
+
+
+def metadata_arrays(meta_dict, fields):
+    # {time: record} metadata as columns sorted by time, fields are (column, record key, dtype),
+    # missing values are NaN in float columns and None in object columns
+    items = sorted((float(k), v) for k, v in meta_dict.items())
+    columns = {"time": np.array([t for t, v in items], dtype=np.float64)}
+    for column, key, dtype in fields:
+        if dtype is object:
+            columns[column] = np.array([v.get(key) for t, v in items], dtype=object)
+        else:
+            columns[column] = np.array([v.get(key, np.nan) for t, v in items], dtype=dtype)
+    return columns
+
+
+def asof_indexes(times, table_times, max_age=None):
+    # Index of the last table row at or before each time, -1 when there is none or it is older than max_age
+    indexes = np.searchsorted(table_times, times, side="right") - 1
+    if max_age is not None and len(table_times) > 0:
+        indexes[(indexes >= 0) & (times - table_times[np.maximum(indexes, 0)] > max_age)] = -1
+    return indexes
+
+
+def asof_column(column, indexes):
+    if column.dtype == object:
+        joined = np.empty(len(indexes), dtype=object)
+    else:
+        joined = np.full(len(indexes), np.nan)
+    joined[indexes >= 0] = column[indexes[indexes >= 0]]
+    return joined
+
+
+def join_metadata(parsed, results_index, min_interval=0, operator="", max_age=DEFAULT_METADATA_MAX_AGE):
+    # Throughput bins of all the speedtests of a result with the radio and GPS state at the end of each bin
+    radio = parsed.get("radio", metadata_arrays(dict(), RADIO_FIELDS))
+    if operator != "":
+        mask = radio["operator"] == operator
+        radio = dict((column, values[mask]) for column, values in radio.items())
+    gps = parsed.get("gps", metadata_arrays(dict(), GPS_FIELDS))
+    speedtests = sorted(parsed["results"][results_index]["speedtests"].items())
+    if "http_test" in parsed:
+        speedtests.append((("downlink", "http"), parsed["http_test"]))
+    parts = [{"direction": np.zeros(0, dtype=object), "test": np.zeros(0, dtype=object), "start": np.zeros(0),
+              "end": np.zeros(0), "throughput": np.zeros(0)}]
+    for (direction, test), speedtest in speedtests:
+        start, end, throughput = throughput_bins(speedtest, min_interval)
+        parts.append({"direction": np.repeat(np.array([direction], dtype=object), len(start)),
+                      "test": np.repeat(np.array([test], dtype=object), len(start)),
+                      "start": start, "end": end, "throughput": throughput})
+    joined = dict((column, np.concatenate([part[column] for part in parts])) for column in parts[0])
+    for table, fields in [(radio, RADIO_FIELDS), (gps, GPS_FIELDS)]:
+        indexes = asof_indexes(joined["end"], table["time"], max_age)
+        for column, key, dtype in fields:
+            joined[column] = asof_column(table[column], indexes)
+    return joined
+
+
+def stratified_pairs(joined, column, first="bt", second="ct"):
+    # (direction, stratum, first throughputs, second throughputs) for each direction and value of column
+    pairs = []
+    for direction in ["uplink", "downlink"]:
+        in_direction = (joined["direction"] == direction) & ((joined["test"] == first) | (joined["test"] == second))
+        strata = joined[column][in_direction]
+        for stratum in sorted(set(strata[strata == strata]) - set([None])):
+            in_stratum = in_direction & (joined[column] == stratum)
+            pairs.append((direction, stratum, joined["throughput"][in_stratum & (joined["test"] == first)],
+                          joined["throughput"][in_stratum & (joined["test"] == second)]))
+    return pairs
 
 
 def compute_ks(file_name, bt_x, ct_x, significance):
@@ -87,54 +186,90 @@ def compute_ks(file_name, bt_x, ct_x, significance):
         f.write("%s\td, p\t%e\t%e\n" % (risul, d, p))
 
 
-def plot_cumulative(file_name, **kwargs):
+def lttb(x, y, threshold):
+    # Largest-Triangle-Three-Buckets downsampling to threshold points, keeps the first and the last point and,
+    # for each bucket, the point forming the largest triangle with the previous choice and the next bucket average
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if threshold < 3 or n <= threshold:
+        return x, y
+    edges = (np.arange(threshold - 1) * (float(n - 2) / (threshold - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start = edges[i]
+        end = edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        average_x = x[end:next_end].mean()
+        average_y = y[end:next_end].mean()
+        areas = np.abs((x[a] - average_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (average_y - y[a]))
+        a = start + np.argmax(areas)
+        selected[i + 1] = a
+    return x[selected], y[selected]
+
+
+def new_figure():
+    # Figures are drawn with the Agg canvas, no pyplot global state, savefig picks the PDF backend by extension
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def plot_cumulative(file_name, max_points=DEFAULT_PLOT_POINTS, **kwargs):
+    figure = new_figure()
+    ax = figure.add_subplot(111)
     for i in range(len(compact_keys)):
         if compact_keys[i] in kwargs:
-            plt.plot(kwargs[compact_keys[i]][0], kwargs[compact_keys[i]][1], label=compact_keys[i],
-                     color=compact_colors[i])
-    plt.xlabel("Time (s)")
-    plt.ylabel("Data (Bytes)")
-    plt.legend()
-    plt.savefig(file_name)
-    plt.close()
+            x, y = lttb(kwargs[compact_keys[i]][0], kwargs[compact_keys[i]][1], max_points)
+            ax.plot(x, y, label=compact_keys[i], color=compact_colors[i])
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Data (Bytes)")
+    ax.legend()
+    figure.savefig(file_name)
 
 
-def two_scales(ax1, time, datasx1, datasx2, **kwargs):
+def two_scales(ax1, time, datasx1, datasx2, max_points=DEFAULT_PLOT_POINTS, **kwargs):
     ax2 = ax1.twinx()
-    ax1.plot(time, datasx1, color='#e39d15', label='MODE')
-    ax1.plot(time, datasx2, color='#438fc4', label='RSSI')
+    ax1.plot(*lttb(time, datasx1, max_points), color='#e39d15', label='MODE')
+    ax1.plot(*lttb(time, datasx2, max_points), color='#438fc4', label='RSSI')
     ax1.set_xlabel('Time (s)')
     ax1.set_ylabel('Metadata')
     ax1.legend()
     # colors = ['b', 'y', 'm', 'c']
     for i in range(len(extended_keys)):
         if extended_keys[i] in kwargs:
-            ax2.plot(kwargs[extended_keys[i]].keys(), kwargs[extended_keys[i]].values(), label=extended_keys[i],
-                     color=extended_colors[i])
+            times, sizes = speedtest_arrays(kwargs[extended_keys[i]])
+            times, sizes = lttb(times, sizes, max_points)
+            ax2.plot(times, sizes, label=extended_keys[i], color=extended_colors[i])
     ax2.set_ylabel('Speed')
     ax2.legend()
     return ax1, ax2
 
 
-def plot_metadata(file_name, times, mode, rssi, **kwargs):
+def plot_metadata(file_name, times, mode, rssi, max_points=DEFAULT_PLOT_POINTS, **kwargs):
     # Create axes
-    fig, ax = plt.subplots()
+    figure = new_figure()
+    ax = figure.add_subplot(111)
     mode2 = [x * 10 for x in mode]
-    ax1, ax2 = two_scales(ax, times, mode2, rssi, **kwargs)
-    plt.savefig(file_name)
-    plt.close()
+    ax1, ax2 = two_scales(ax, times, mode2, rssi, max_points, **kwargs)
+    figure.savefig(file_name)
 
 
-def plot_cdf(file_name, **kwargs):
+def plot_cdf(file_name, max_points=DEFAULT_PLOT_POINTS, **kwargs):
+    figure = new_figure()
+    ax = figure.add_subplot(111)
     for i in range(len(compact_keys)):
         if compact_keys[i] in kwargs:
-            plt.plot(kwargs[compact_keys[i]][0], kwargs[compact_keys[i]][1], label=compact_keys[i],
-                     color=compact_colors[i])
-    plt.xlabel("Throughput (Mbps)")
-    plt.ylabel("CDF")
-    plt.legend()
-    plt.savefig(file_name)
-    plt.close()
+            x, y = lttb(kwargs[compact_keys[i]][0], kwargs[compact_keys[i]][1], max_points)
+            ax.plot(x, y, label=compact_keys[i], color=compact_colors[i])
+    ax.set_xlabel("Throughput (Mbps)")
+    ax.set_ylabel("CDF")
+    ax.legend()
+    figure.savefig(file_name)
 
 
 def update_traceroutes_dict(traceroutes, single_traceroute, paris=False):
@@ -147,139 +282,191 @@ def update_traceroutes_dict(traceroutes, single_traceroute, paris=False):
             traceroutes[key].add(single_traceroute[key])
 
 
-def compare_interfaces_sets(s1, s2):
-    if s1 is None or s2 is None:
-        intersection = None
-        only_s1 = None
-        only_s2 = None
-    else:
-        intersection = s1 & s2
-        only_s1 = s1 - s2
-        only_s2 = s2 - s1
-    return intersection, only_s1, only_s2
+def new_traceroutes_state():
+    # Hop -> interfaces aggregates of all the files in "files", with the mtime and size they were read with, and the
+    # aggregates of each file in "contributions". Interfaces are bitsets of the hop interners in "interners", tracebox
+    # modifications are sets.
+    state = {"format": TRACEROUTES_STATE_FORMAT, "files": dict(), "contributions": dict(), "interners": dict()}
+    for aggregate in TRACEROUTES_AGGREGATES:
+        state[aggregate] = dict()
+    return state
 
 
-def compare_traceroutes_dicts(t1, t2, ignore_interfaces_set, paris=None, tracebox_6881=None, tracebox_53674=None):
+def load_traceroutes_state(file_name):
+    try:
+        with open(file_name, "rb") as f:
+            state = cPickle.load(f)
+    except IOError as ioe:
+        if ioe.errno != 2:
+            raise ioe
+        return new_traceroutes_state()
+    if state.get("format") != TRACEROUTES_STATE_FORMAT:
+        raise ValueError("%s: unsupported traceroutes state format" % file_name)
+    return state
+
+
+def save_traceroutes_state(state, file_name):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)))
+    with os.fdopen(fd, "wb") as f:
+        cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, file_name)
+
+
+def traceroutes_state_contains(state, file_name):
+    file_stat = os.stat(file_name)
+    return state["files"].get(os.path.abspath(file_name)) == (file_stat.st_mtime, file_stat.st_size)
+
+
+class AddressInterner(object):
+    # Interns the interface addresses of a hop to integer ids, sets of addresses become bitsets (bit i for address i)
+    def __init__(self):
+        self.ids = dict()
+        self.addresses = []
+
+    def bitset(self, addresses):
+        bits = 0
+        for address in addresses:
+            address_id = self.ids.get(address)
+            if address_id is None:
+                address_id = self.ids[address] = len(self.addresses)
+                self.addresses.append(address)
+            bits |= 1 << address_id
+        return bits
+
+    def addresses_of(self, bits):
+        addresses = set()
+        while bits:
+            lowest = bits & -bits
+            addresses.add(self.addresses[lowest.bit_length() - 1])
+            bits ^= lowest
+        return addresses
+
+
+def bitset_count(bits):
+    return bin(bits).count("1")
+
+
+def hop_interner(interners, key):
+    if key not in interners:
+        interners[key] = AddressInterner()
+    return interners[key]
+
+
+def update_traceroutes_bitsets(traceroutes, interners, single_traceroute, paris=False):
+    # Same as update_traceroutes_dict, with the interfaces of each hop interned in interners
+    for key in single_traceroute:
+        addresses = single_traceroute[key] if paris else [single_traceroute[key]]
+        traceroutes[key] = traceroutes.get(key, 0) | hop_interner(interners, key).bitset(addresses)
+
+
+def intern_traceroutes(traceroutes, interners):
+    bitsets = dict()
+    for key in traceroutes:
+        bitsets[key] = hop_interner(interners, key).bitset(traceroutes[key])
+    return bitsets
+
+
+class HopComparison(collections.namedtuple("HopComparison", HOP_SET_FIELDS + HOP_PERC_FIELDS + ["interner"])):
+    # Sets are bitsets of the hop interner, decoded only when the interfaces are needed
+    __slots__ = ()
+
+    def interfaces(self, field):
+        bits = getattr(self, field)
+        if bits is None:
+            return None
+        return self.interner.addresses_of(bits)
+
+    def count(self, field):
+        bits = getattr(self, field)
+        if bits is None:
+            return None
+        return bitset_count(bits)
+
+
+def compare_traceroutes_bitsets(interners, t1, t2, ignore_interfaces_set, paris=None, tracebox_6881=None,
+                                tracebox_53674=None):
+    # t1 and t2 are the BT and CT traceroutes, paris and tracebox the optional references they are compared to
     result = dict()
     if not set(t1.keys()) == set(t2.keys()):
         # TODO better error handling
         return result
+    references = zip(HOP_REFERENCES, [paris, tracebox_6881, tracebox_53674])
     for key in t1:
-        set_t1 = t1[key] - ignore_interfaces_set
-        set_t2 = t2[key] - ignore_interfaces_set
-
-        if paris and key in paris:
-            set_paris = paris[key] - ignore_interfaces_set
-        elif paris and key not in paris:
-            set_paris = set()
-        elif paris is None:
-            set_paris = None
-
-        if tracebox_6881 and key in tracebox_6881:
-            set_tracebox_6881 = tracebox_6881[key] - ignore_interfaces_set
-        elif tracebox_6881 and key not in tracebox_6881:
-            set_tracebox_6881 = set()
-        elif tracebox_6881 is None:
-            set_tracebox_6881 = None
-
-        if tracebox_53674 and key in tracebox_53674:
-            set_tracebox_53674 = tracebox_53674[key] - ignore_interfaces_set
-        elif tracebox_53674 and key not in tracebox_53674:
-            set_tracebox_53674 = set()
-        elif tracebox_53674 is None:
-            set_tracebox_53674 = None
-
-        intersection, only_t1, only_t2 = compare_interfaces_sets(set_t1, set_t2)
-        paris_inters, only_t1_paris, only_paris_t1 = compare_interfaces_sets(set_t1, set_paris)
-        paris_inters, only_t2_paris, only_paris_t2 = compare_interfaces_sets(set_t2, set_paris)
-        t6881_inters, only_t1_t6881, only_t6881_t1 = compare_interfaces_sets(set_t1, set_tracebox_6881)
-        t6881_inters, only_t2_t6881, only_t6881_t2 = compare_interfaces_sets(set_t2, set_tracebox_6881)
-        t53674_inters, only_t1_t53674, only_t53674_t1 = compare_interfaces_sets(set_t1, set_tracebox_53674)
-        t53674_inters, only_t2_t53674, only_t53674_t2 = compare_interfaces_sets(set_t2, set_tracebox_53674)
-        len_t1 = len(set_t1)
-        len_t2 = len(set_t2)
-        len_only_t1 = len(only_t1)
-        len_only_t2 = len(only_t2)
-        if len_t1 == 0:
-            perc1 = 0
-            if only_t1_paris is not None:
-                perc1_paris = 0
-            else:
-                perc1_paris = "-"
-            if only_t1_t6881 is not None:
-                perc1_t6881 = 0
-            else:
-                perc1_t6881 = "-"
-            if only_t1_t53674 is not None:
-                perc1_t53674 = 0
-            else:
-                perc1_t53674 = "-"
-        else:
-            perc1 = float(len_only_t1) / len_t1
-            if only_t1_paris is not None:
-                len_only_t1_paris = len(only_t1_paris)
-                perc1_paris = float(len_only_t1_paris) / len_t1
-            else:
-                perc1_paris = "-"
-            if only_t1_t6881 is not None:
-                len_only_t1_t6881 = len(only_t1_t6881)
-                perc1_t6881 = float(len_only_t1_t6881) / len_t1
-            else:
-                perc1_t6881 = "-"
-            if only_t1_t53674 is not None:
-                len_only_t1_t53674 = len(only_t1_t53674)
-                perc1_t53674 = float(len_only_t1_t53674) / len_t1
-            else:
-                perc1_t53674 = "-"
-        if len_t2 == 0:
-            perc2 = 0
-            if only_t2_paris is not None:
-                perc2_paris = 0
-            else:
-                perc2_paris = "-"
-            if only_t2_t6881 is not None:
-                perc2_t6881 = 0
-            else:
-                perc2_t6881 = "-"
-            if only_t2_t53674 is not None:
-                perc2_t53674 = 0
-            else:
-                perc2_t53674 = "-"
-        else:
-            perc2 = float(len_only_t2) / len_t2
-            if only_t2_paris is not None:
-                len_only_t2_paris = len(only_t2_paris)
-                perc2_paris = float(len_only_t2_paris) / len_t2
-            else:
-                perc2_paris = "-"
-            if only_t2_t6881 is not None:
-                len_only_t2_t6881 = len(only_t2_t6881)
-                perc2_t6881 = float(len_only_t2_t6881) / len_t2
-            else:
-                perc2_t6881 = "-"
-            if only_t2_t53674 is not None:
-                len_only_t2_t53674 = len(only_t2_t53674)
-                perc2_t53674 = float(len_only_t2_t53674) / len_t2
-            else:
-                perc2_t53674 = "-"
-        if set_paris is None:
-            set_paris = "-"
-            only_t1_paris = "-"
-            only_t2_paris = "-"
-        if set_tracebox_6881 is None:
-            set_tracebox_6881 = "-"
-            only_t1_t6881 = "-"
-            only_t2_t6881 = "-"
-        if set_tracebox_53674 is None:
-            set_tracebox_53674 = "-"
-            only_t1_t53674 = "-"
-            only_t2_t53674 = "-"
-        result[key] = (set_t1, set_t2, set_paris, set_tracebox_6881, set_tracebox_53674, intersection, only_t1, only_t2,
-                       only_t1_paris, only_t2_paris, only_t1_t6881, only_t2_t6881, only_t1_t53674, only_t2_t53674,
-                       perc1, perc2, perc1_paris, perc2_paris, perc1_t6881, perc1_t53674, perc2_t6881, perc2_t53674)
+        interner = hop_interner(interners, key)
+        ignored = interner.bitset(ignore_interfaces_set)
+        bt = t1[key] & ~ignored
+        ct = t2[key] & ~ignored
+        bt_count = bitset_count(bt)
+        ct_count = bitset_count(ct)
+        fields = {"interner": interner, "bt": bt, "ct": ct, "intersection": bt & ct, "only_bt": bt & ~ct,
+                  "only_ct": ct & ~bt}
+        fields["only_bt_perc"] = float(bitset_count(fields["only_bt"])) / bt_count if bt_count else 0
+        fields["only_ct_perc"] = float(bitset_count(fields["only_ct"])) / ct_count if ct_count else 0
+        for name, reference in references:
+            if reference is None:
+                fields.update(dict.fromkeys([name, "only_bt_" + name, "only_ct_" + name, "only_bt_%s_perc" % name,
+                                             "only_ct_%s_perc" % name]))
+                continue
+            reference_bits = reference.get(key, 0) & ~ignored
+            only_bt = fields["only_bt_" + name] = bt & ~reference_bits
+            only_ct = fields["only_ct_" + name] = ct & ~reference_bits
+            fields[name] = reference_bits
+            fields["only_bt_%s_perc" % name] = float(bitset_count(only_bt)) / bt_count if bt_count else 0
+            fields["only_ct_%s_perc" % name] = float(bitset_count(only_ct)) / ct_count if ct_count else 0
+        result[key] = HopComparison(**fields)
     return result
 
 
+def compare_traceroutes_dicts(t1, t2, ignore_interfaces_set, paris=None, tracebox_6881=None, tracebox_53674=None):
+    interners = dict()
+    bitsets = [None if t is None else intern_traceroutes(t, interners)
+               for t in [t1, t2, paris, tracebox_6881, tracebox_53674]]
+    return compare_traceroutes_bitsets(interners, bitsets[0], bitsets[1], ignore_interfaces_set, *bitsets[2:])
+
+
+def traceroutes_contribution(interners, parsed, results_index):
+    # Aggregates of a single file
+    contribution = dict((aggregate, dict()) for aggregate in TRACEROUTES_AGGREGATES)
+    if results_index is None:
+        return contribution
+    # paris only runs on the default route and failed probes are left out of the metadata
+    if "paris" in parsed:
+        update_traceroutes_bitsets(contribution["paris"], interners, parsed["paris"], True)
+    for tracebox in ["tracebox_6881", "tracebox_53674"]:
+        if tracebox in parsed:
+            trace, mods = parsed[tracebox]
+            update_traceroutes_bitsets(contribution[tracebox], interners, trace)
+            update_traceroutes_dict(contribution[tracebox + "_mods"], mods, True)
+    traceroutes = parsed["results"][results_index]["traceroutes"]
+    update_traceroutes_bitsets(contribution["bt_ul"], interners, traceroutes["uplink", "bt"])
+    update_traceroutes_bitsets(contribution["ct_ul"], interners, traceroutes["uplink", "ct"])
+    update_traceroutes_bitsets(contribution["bt_dl"], interners, traceroutes["downlink", "bt"])
+    update_traceroutes_bitsets(contribution["ct_dl"], interners, traceroutes["downlink", "ct"])
+    return contribution
+
+
+def update_traceroutes_state(state, file_name, parsed, results_index):
+    # The aggregates are unions of the contributions of the files. A file read again replaces its previous
+    # contribution, the hops of both are rebuilt from the contributions of all the files.
+    file_stat = os.stat(file_name)
+    path = os.path.abspath(file_name)
+    state["files"][path] = (file_stat.st_mtime, file_stat.st_size)
+    contribution = traceroutes_contribution(state["interners"], parsed, results_index)
+    previous = state["contributions"].get(path)
+    state["contributions"][path] = contribution
+    for aggregate in TRACEROUTES_AGGREGATES:
+        if previous is None:
+            for key, value in contribution[aggregate].items():
+                state[aggregate][key] = state[aggregate].get(key, type(value)()) | value
+            continue
+        for key in set(previous[aggregate]) | set(contribution[aggregate]):
+            values = [c[aggregate][key] for c in state["contributions"].values() if key in c[aggregate]]
+            if values:
+                state[aggregate][key] = reduce(lambda a, b: a | b, values, type(values[0])())
+            else:
+                state[aggregate].pop(key, None)
+
+
 @contextlib.contextmanager
 def traceroute_open(filename=None):
     if filename and filename != '-':
@@ -293,6 +480,12 @@ def traceroute_open(filename=None):
             fh.close()
 
 
+def format_interfaces(interfaces):
+    if interfaces is None:
+        return "-"
+    return "{" + ", ".join(sorted(interfaces)) + "}"
+
+
 def print_traceroutes_result(res, filename=None):
     if len(res) != 0:
         with traceroute_open(filename) as f:
@@ -308,39 +501,19 @@ def print_traceroutes_result(res, filename=None):
                         "only bt t6881 perc\tonly bt t6881 len\tonly ct t6881 perc\tonly ct t6881 len\t"
                         "only bt t53674 perc\tonly bt t53674 len\tonly ct t53674 perc\tonly ct t53674 len\n")
             for key in res:
-                if filename is None:
-                    f.write(str(key) + "\t" + 
-                            str(res[key][14]) + "\t" + str(len(res[key][6])) + "\t" +
-                            str(res[key][15]) + "\t" + str(len(res[key][7])) + "\t" +
-                            str(res[key][16]) + "\t" + str(len(res[key][8])) + "\t" +
-                            str(res[key][17]) + "\t" + str(len(res[key][9])) + "\t" +
-                            str(res[key][18]) + "\t" + str(len(res[key][10])) + "\t" +
-                            str(res[key][19]) + "\t" + str(len(res[key][11])) + "\t" +
-                            str(res[key][20]) + "\t" + str(len(res[key][12])) + "\t" +
-                            str(res[key][21]) + "\t" + str(len(res[key][13])) + "\n")
-                else:
-                    f.write(str(key) + "\t")
-                    for i in range(14):
-                        if res[key][i] == "-":
-                            f.write(res[key][i] + "\t")
-                            continue
-                        first = True
-                        f.write("{")
-                        for ip in res[key][i]:
-                            if first:
-                                f.write(ip)
-                                first = False
-                            else:
-                                f.write(", " + ip)
-                        f.write("}\t")
-                    f.write(str(res[key][14]) + "\t" + str(len(res[key][6])) + "\t" +
-                            str(res[key][15]) + "\t" + str(len(res[key][7])) + "\t" +
-                            str(res[key][16]) + "\t" + str(len(res[key][8])) + "\t" +
-                            str(res[key][17]) + "\t" + str(len(res[key][9])) + "\t" +
-                            str(res[key][18]) + "\t" + str(len(res[key][10])) + "\t" +
-                            str(res[key][19]) + "\t" + str(len(res[key][11])) + "\t" +
-                            str(res[key][20]) + "\t" + str(len(res[key][12])) + "\t" +
-                            str(res[key][21]) + "\t" + str(len(res[key][13])) + "\n")
+                hop = res[key]
+                f.write(str(key) + "\t")
+                if filename is not None:
+                    for field in HOP_SET_FIELDS:
+                        f.write(format_interfaces(hop.interfaces(field)) + "\t")
+                columns = []
+                for perc_field in HOP_PERC_FIELDS:
+                    only_count = hop.count(perc_field[:-len("_perc")])
+                    if only_count is None:
+                        columns += ["-", "-"]
+                    else:
+                        columns += [str(getattr(hop, perc_field)), str(only_count)]
+                f.write("\t".join(columns) + "\n")
 
 
 def parse_paris(paris_string):
@@ -400,3 +573,56 @@ def print_tracebox_mods(tracebox_6881, tracebox_53674, filename):
                 else:
                     f.write(", " + i)
             f.write("}\n")
+
+
+def parse_result(json_data):
+    # Everything the analyzers use of a NeutMon output file, in the form they use it
+    parsed = dict()
+    if "error" in json_data:
+        parsed["error"] = json_data["error"]["message"]
+        return parsed
+    parsed["results"] = []
+    for result in json_data["results"]:
+        parsed_result = {"finished": result["finished"], "port": result["port"], "speedtests": dict(),
+                         "traceroutes": dict(), "udp": dict()}
+        for direction in ["uplink", "downlink"]:
+            for test, test_result in result.get(direction, dict()).items():
+                if "speedtest" in test_result:
+                    parsed_result["speedtests"][direction, test] = speedtest_arrays(test_result["speedtest"])
+                if "udp" in test_result:
+                    # datagram statistics of the UDP tests: loss, jitter and reordering
+                    parsed_result["udp"][direction, test] = test_result["udp"]
+                if "traceroute" in test_result:
+                    parsed_result["traceroutes"][direction, test] = order_dict(test_result["traceroute"], TRACEROUTE)
+        parsed["results"].append(parsed_result)
+    client_meta = json_data.get("meta_data", dict()).get("client_meta", dict())
+    if "interface" in client_meta:
+        parsed["radio"] = metadata_arrays(client_meta["interface"], RADIO_FIELDS)
+    if "gps" in client_meta:
+        parsed["gps"] = metadata_arrays(client_meta["gps"], GPS_FIELDS)
+    if len(client_meta.get("http_test", dict())) > 0:
+        speedtest = client_meta["http_test"]
+        if isinstance(speedtest, dict):
+            speedtest = dict(speedtest)
+            speedtest.pop("error", None)
+        speedtest = speedtest_arrays(speedtest)
+        if len(speedtest[0]) > 0:
+            parsed["http_test"] = speedtest
+    if "paris" in client_meta:
+        parsed["paris"] = parse_paris(client_meta["paris"])
+    for tracebox in ["tracebox_6881", "tracebox_53674"]:
+        if tracebox in client_meta:
+            parsed[tracebox] = parse_tracebox(client_meta[tracebox])
+    return parsed
+
+
+def parse_result_file(file_name):
+    # Only the parts parse_result uses are loaded, speedtests straight into arrays
+    with open(file_name, "rb") as json_file:
+        return parse_result(stream.load_json_subtrees(json_file))
+
+
+def load_result(file_name, cache=None):
+    if cache is None:
+        return parse_result_file(file_name)
+    return cache.load(file_name, parse_result_file)
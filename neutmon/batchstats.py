@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+import numpy as np
+from scipy import stats
+
+DEFAULT_RESAMPLES = 1000
+DEFAULT_CONFIDENCE = 0.95
+# Pairs resampled together, bounds the memory of the bootstrap to BOOTSTRAP_BLOCK * resamples values
+BOOTSTRAP_BLOCK = 1000
+CORRECTIONS = ["bh", "holm", "none"]
+
+TABLE_COLUMNS = ["label", "n1", "n2", "median1", "median2", "median_difference", "difference_low",
+                 "difference_high", "cliffs_delta", "ks_d", "ks_p", "ks_p_adjusted", "verdict"]
+
+
+def sorted_pairs(pairs):
+    # All the samples of all the pairs sorted by pair and value in one array, with per element pair ids and
+    # a flag telling if the element belongs to the first sample of its pair
+    n1 = np.array([len(first) for first, second in pairs], dtype=np.int64)
+    n2 = np.array([len(second) for first, second in pairs], dtype=np.int64)
+    values = np.concatenate([np.asarray(sample, dtype=np.float64) for pair in pairs for sample in pair])
+    groups = np.repeat(np.arange(len(pairs)), n1 + n2)
+    first = np.repeat(np.tile([True, False], len(pairs)), np.column_stack((n1, n2)).ravel())
+    order = np.lexsort((values, groups))
+    return n1, n2, values[order], groups[order], first[order]
+
+
+def group_cumsum(flags, groups, starts):
+    # Inclusive count of the flagged elements of each group up to each element
+    counts = np.cumsum(flags)
+    before = np.concatenate(([0], counts))[starts]
+    return counts - before[groups]
+
+
+def group_medians(values, sizes):
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    return (values[starts + (sizes - 1) // 2] + values[starts + sizes // 2]) / 2.0
+
+
+def rank_statistics(pairs):
+    # Two sample KS statistic and p-value (as stats.ks_2samp), Cliff's delta and medians of all the pairs at once.
+    # Cliff's delta is P(first > second) - P(first < second).
+    n1, n2, values, groups, first = sorted_pairs(pairs)
+    starts = np.concatenate(([0], np.cumsum(n1 + n2)[:-1]))
+    count1 = group_cumsum(first, groups, starts)
+    count2 = group_cumsum(~first, groups, starts)
+    # the empirical CDFs are compared at the last element of each run of equal values
+    run_end = np.ones(len(values), dtype=bool)
+    run_end[:-1] = (values[1:] != values[:-1]) | (groups[1:] != groups[:-1])
+    distance = np.where(run_end, np.absolute(count1 / n1[groups].astype(np.float64) -
+                                             count2 / n2[groups].astype(np.float64)), 0)
+    d = np.maximum.reduceat(distance, starts)
+    en = np.sqrt(n1 * n2 / (n1 + n2).astype(np.float64))
+    p = stats.distributions.kstwobign.sf((en + 0.12 + 0.11 / en) * d)
+    # second sample elements smaller than, and equal to, each run
+    run_ids = np.cumsum(np.concatenate(([True], run_end[:-1]))) - 1
+    equal2 = np.bincount(run_ids, weights=~first)
+    smaller2 = count2[run_end] - equal2
+    u = np.bincount(groups[first], weights=smaller2[run_ids[first]] + 0.5 * equal2[run_ids[first]],
+                    minlength=len(pairs))
+    delta = 2 * u / (n1 * n2) - 1
+    medians1 = group_medians(values[first], n1)
+    medians2 = group_medians(values[~first], n2)
+    return n1, n2, medians1, medians2, d, p, delta
+
+
+def bootstrap_median_indexes(sizes, resamples, random_state):
+    # Position in the sorted sample of the median of each bootstrap resample, as a pair of (equal for odd sizes)
+    # order statistics. The k-th smallest of n indexes drawn with replacement is floor(n * U) with U the k-th
+    # order statistic of n uniforms, Beta(k, n - k + 1) distributed, so no resample is drawn.
+    sizes = sizes[:, np.newaxis]
+    k = (sizes + 1) // 2
+    low = random_state.beta(k, sizes - k + 1, (len(sizes), resamples))
+    # the next order statistic, for even sizes, is the smallest of the n - k uniforms above the k-th one
+    high = low + (1 - low) * random_state.beta(1, np.maximum(sizes - k, 1), (len(sizes), resamples))
+    high = np.where(sizes % 2 == 1, low, high)
+    return (np.minimum(np.floor(sizes * low), sizes - 1).astype(np.int64),
+            np.minimum(np.floor(sizes * high), sizes - 1).astype(np.int64))
+
+
+def bootstrap_median_difference(pairs, resamples, confidence, random_state):
+    # Percentile bootstrap interval of median(second) - median(first) of each pair
+    low = np.empty(len(pairs))
+    high = np.empty(len(pairs))
+    alpha = (1 - confidence) / 2.0
+    for block in range(0, len(pairs), BOOTSTRAP_BLOCK):
+        block_pairs = pairs[block:block + BOOTSTRAP_BLOCK]
+        differences = 0
+        for sample_index, sign in [(1, 1), (0, -1)]:
+            samples = [np.sort(np.asarray(pair[sample_index], dtype=np.float64)) for pair in block_pairs]
+            sizes = np.array([len(sample) for sample in samples], dtype=np.int64)
+            offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))[:, np.newaxis]
+            values = np.concatenate(samples)
+            index_low, index_high = bootstrap_median_indexes(sizes, resamples, random_state)
+            differences = differences + sign * (values[offsets + index_low] + values[offsets + index_high]) / 2.0
+        low[block:block + len(block_pairs)], high[block:block + len(block_pairs)] = \
+            np.percentile(differences, [100 * alpha, 100 * (1 - alpha)], axis=1)
+    return low, high
+
+
+def holm(p):
+    p = np.asarray(p, dtype=np.float64)
+    m = len(p)
+    order = np.argsort(p)
+    adjusted = np.empty(m)
+    adjusted[order] = np.minimum(np.maximum.accumulate((m - np.arange(m)) * p[order]), 1)
+    return adjusted
+
+
+def benjamini_hochberg(p):
+    p = np.asarray(p, dtype=np.float64)
+    m = len(p)
+    order = np.argsort(p)
+    adjusted = np.empty(m)
+    adjusted[order] = np.minimum(np.minimum.accumulate((m * p[order] / np.arange(1, m + 1))[::-1])[::-1], 1)
+    return adjusted
+
+
+def compare_pairs(pairs, labels=None, significance=0.05, resamples=DEFAULT_RESAMPLES,
+                  confidence=DEFAULT_CONFIDENCE, correction="bh", seed=None):
+    # Tidy table, a row of TABLE_COLUMNS for each (first, second) sample pair. Pairs with an empty sample get
+    # a "-" verdict and are left out of the multiple comparison correction.
+    if correction not in CORRECTIONS:
+        raise ValueError("Unknown correction %s" % correction)
+    if labels is None:
+        labels = [str(i) for i in range(len(pairs))]
+    valid = [i for i in range(len(pairs)) if len(pairs[i][0]) > 0 and len(pairs[i][1]) > 0]
+    valid_pairs = [pairs[i] for i in valid]
+    rows = []
+    for i in range(len(pairs)):
+        rows.append([labels[i], len(pairs[i][0]), len(pairs[i][1])] + [float("nan")] * 9 + ["-"])
+    if len(valid_pairs) == 0:
+        return rows
+    n1, n2, medians1, medians2, d, p, delta = rank_statistics(valid_pairs)
+    if resamples > 0:
+        low, high = bootstrap_median_difference(valid_pairs, resamples, confidence, np.random.RandomState(seed))
+    else:
+        low = high = np.full(len(valid_pairs), np.nan)
+    if correction == "bh":
+        adjusted = benjamini_hochberg(p)
+    elif correction == "holm":
+        adjusted = holm(p)
+    else:
+        adjusted = p
+    for j, i in enumerate(valid):
+        rows[i][3:] = [medians1[j], medians2[j], medians2[j] - medians1[j], low[j], high[j], delta[j], d[j], p[j],
+                       adjusted[j], "DIFF" if adjusted[j] < significance else "SAME"]
+    return rows
+
+
+def format_column(column):
+    if isinstance(column, float):
+        return "%e" % column
+    return str(column)
+
+
+def write_table(file_name, rows):
+    with open(file_name, "w") as f:
+        f.write("\t".join(TABLE_COLUMNS) + "\n")
+        for row in rows:
+            f.write("\t".join(format_column(column) for column in row) + "\n")
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+import cPickle
+import hashlib
+import os
+import tempfile
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".neutmon_cache")
+DEFAULT_CACHE_SIZE = 512    # MB
+# Bump when the parsed form changes, old entries are then never hit and get evicted
+CACHE_FORMAT = 3
+CACHE_ENTRY_SUFFIX = ".pickle"
+
+
+class ResultCache(object):
+    # On-disk cache of parsed NeutMon output files, keyed by path, mtime and size of the file.
+    # The mtime of an entry is its last use, the least recently used entries are evicted first.
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size * 1024 * 1024
+        self.size = None
+        try:
+            os.makedirs(directory)
+        except OSError as ose:
+            if ose.errno != 17:
+                raise ose
+
+    def __entry_path(self, file_name):
+        file_stat = os.stat(file_name)
+        key = "%i\0%s\0%r\0%i" % (CACHE_FORMAT, os.path.abspath(file_name), file_stat.st_mtime, file_stat.st_size)
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + CACHE_ENTRY_SUFFIX)
+
+    def __entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entry_stat = os.stat(path)
+            except OSError:
+                # evicted by another process
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, path))
+        return entries
+
+    def load(self, file_name, parse):
+        path = self.__entry_path(file_name)
+        try:
+            with open(path, "rb") as f:
+                parsed = cPickle.load(f)
+            os.utime(path, None)
+            return parsed
+        except IOError as ioe:
+            if ioe.errno != 2:
+                raise ioe
+        except Exception:
+            # truncated or stale entry, parse the file again
+            pass
+        parsed = parse(file_name)
+        self.__store(path, parsed)
+        return parsed
+
+    def __store(self, path, parsed):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            cPickle.dump(parsed, f, cPickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.rename(temp_path, path)
+        if self.size is None:
+            self.size = sum(entry[1] for entry in self.__entries())
+        else:
+            self.size += size
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self.__entries())
+        self.size = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+
+import array
+import ctypes
+import errno
+import select
+import socket
+import numpy as np
+
+DATAGRAM_BATCH = 64  # datagrams sent or received with a single system call
+MAX_DATAGRAM_SIZE = 2048  # Bytes
+DEFAULT_REPORT_INTERVAL = 0.1  # seconds
+MSG_DONTWAIT = 0x40
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32), ("msg_iov", ctypes.POINTER(IOVec)),
+                ("msg_iovlen", ctypes.c_size_t), ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+# Batched datagram system calls, datagrams are sent and received one at a time where libc has none
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc_sendmmsg = libc.sendmmsg
+    libc_sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    libc_sendmmsg.restype = ctypes.c_int
+    libc_recvmmsg = libc.recvmmsg
+    libc_recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    libc_recvmmsg.restype = ctypes.c_int
+except (OSError, AttributeError):
+    libc_sendmmsg = None
+    libc_recvmmsg = None
+
+
+class DatagramBatch(object):
+    # Buffers of a batch of datagrams of a connected non blocking UDP socket. Datagrams are built and parsed in place
+    # in data, datagram i starts at offset(i).
+    def __init__(self, size=DATAGRAM_BATCH, datagram_size=MAX_DATAGRAM_SIZE):
+        self.size = size
+        self.datagram_size = datagram_size
+        self.data = bytearray(size * datagram_size)
+        self.lengths = [0] * size
+        self.__view = memoryview(self.data)
+        self.__messages = (MMsgHdr * size)()
+        self.__iovecs = (IOVec * size)()
+        base = ctypes.addressof((ctypes.c_char * len(self.data)).from_buffer(self.data))
+        for i in range(size):
+            self.__iovecs[i].iov_base = base + i * datagram_size
+            self.__iovecs[i].iov_len = datagram_size
+            self.__messages[i].msg_hdr.msg_iov = ctypes.pointer(self.__iovecs[i])
+            self.__messages[i].msg_hdr.msg_iovlen = 1
+
+    def offset(self, i):
+        return i * self.datagram_size
+
+    def datagram(self, i):
+        return self.__view[self.offset(i):self.offset(i) + self.lengths[i]]
+
+    def send(self, batch_socket, count, timeout):
+        # Sends the first count datagrams, with the lengths in lengths, waiting at most timeout for buffer space
+        sent = 0
+        while sent < count:
+            try:
+                if libc_sendmmsg is None:
+                    batch_socket.send(self.datagram(sent))
+                    sent += 1
+                    continue
+                for i in range(sent, count):
+                    self.__iovecs[i].iov_len = self.lengths[i]
+                n = libc_sendmmsg(batch_socket.fileno(), ctypes.byref(self.__messages[sent]), count - sent, 0)
+                if n < 0:
+                    error = ctypes.get_errno()
+                    raise socket.error(error, errno.errorcode.get(error, str(error)))
+                sent += n
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.EAGAIN and e.errno != errno.ENOBUFS:
+                    raise
+                if not select.select([], [batch_socket], [], timeout)[1]:
+                    raise socket.timeout("Timeout while sending datagrams")
+        return sent
+
+    def receive(self, batch_socket, timeout):
+        # Receives up to size datagrams, their lengths are in lengths. Raises socket.timeout when none arrives.
+        if not select.select([batch_socket], [], [], timeout)[0]:
+            raise socket.timeout("No datagram received")
+        if libc_recvmmsg is None:
+            received = 0
+            while received < self.size:
+                try:
+                    datagram = self.__view[self.offset(received):self.offset(received) + self.datagram_size]
+                    self.lengths[received] = batch_socket.recv_into(datagram, 0, MSG_DONTWAIT)
+                except socket.error as e:
+                    if e.errno == errno.EAGAIN or e.errno == errno.EINTR:
+                        break
+                    raise
+                received += 1
+            return received
+        for i in range(self.size):
+            self.__iovecs[i].iov_len = self.datagram_size
+        n = libc_recvmmsg(batch_socket.fileno(), self.__messages, self.size, MSG_DONTWAIT, None)
+        if n < 0:
+            error = ctypes.get_errno()
+            if error == errno.EAGAIN or error == errno.EINTR:
+                return 0
+            raise socket.error(error, errno.errorcode.get(error, str(error)))
+        for i in range(n):
+            self.lengths[i] = self.__messages[i].msg_len
+        return n
+
+
+class DatagramLog(object):
+    # Sequence number, send time, arrival time and size of the data datagrams received by a test, in arrival order
+    def __init__(self):
+        self.sequences = array.array("l")
+        self.sent_times = array.array("d")
+        self.arrivals = array.array("d")
+        self.sizes = array.array("l")
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def append(self, sequence, sent_time, arrival, size):
+        self.sequences.append(sequence)
+        self.sent_times.append(sent_time)
+        self.arrivals.append(arrival)
+        self.sizes.append(size)
+        self.bytes += size
+
+    def statistics(self, sent_count=None, start=None, interval=DEFAULT_REPORT_INTERVAL):
+        columns = [np.frombuffer(values, dtype=values.typecode) if len(values) > 0 else []
+                   for values in [self.sequences, self.sent_times, self.arrivals, self.sizes]]
+        return datagram_statistics(*columns, sent_count=sent_count, start=start, interval=interval)
+
+
+def datagram_statistics(sequences, sent_times, arrivals, sizes, sent_count=None, start=None,
+                        interval=DEFAULT_REPORT_INTERVAL):
+    # Per interval goodput (Mbps), received, lost, reordered and duplicated datagrams and jitter (s) of the data
+    # datagrams of a test, in arrival order. Lost datagrams are counted in the interval of the datagram closing the
+    # gap of sequence numbers, the ones after the last datagram received in the last interval. Jitter is the mean
+    # absolute difference of consecutive one way delays (the D of RFC 3550), which needs no clock synchronization,
+    # None in intervals without two datagrams.
+    sequences = np.asarray(sequences, dtype=np.int64)
+    sent_times = np.asarray(sent_times, dtype=np.float64)
+    arrivals = np.asarray(arrivals, dtype=np.float64)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if len(sequences) == 0:
+        return {"interval": interval, "times": [], "goodput": [], "received": [], "lost": [], "reordered": [],
+                "duplicated": [], "jitter": [], "totals": {"sent": sent_count or 0, "received": 0,
+                                                          "lost": sent_count or 0, "reordered": 0, "duplicated": 0,
+                                                          "jitter": None}}
+    if start is None:
+        start = arrivals[0]
+    bins = np.maximum(((arrivals - start) / interval).astype(np.int64), 0)
+    bins_count = bins.max() + 1
+    first = np.zeros(len(sequences), dtype=bool)
+    first[np.unique(sequences, return_index=True)[1]] = True
+    unique_sequences = sequences[first]
+    unique_bins = bins[first]
+    # a datagram is reordered if one with a greater sequence number arrived before it
+    reordered = np.zeros(len(unique_sequences), dtype=bool)
+    reordered[1:] = unique_sequences[1:] < np.maximum.accumulate(unique_sequences)[:-1]
+    expected = max(sent_count or 0, unique_sequences.max() + 1)
+    order = np.argsort(unique_sequences)
+    gaps = np.diff(np.concatenate(([-1], unique_sequences[order]))) - 1
+    lost = np.bincount(unique_bins[order], weights=gaps, minlength=bins_count)
+    lost[-1] += expected - 1 - unique_sequences[order[-1]]
+    delays = arrivals[first] - sent_times[first]
+    variations = np.absolute(np.diff(delays))
+    variation_sums = np.bincount(unique_bins[1:], weights=variations, minlength=bins_count)
+    variation_counts = np.bincount(unique_bins[1:], minlength=bins_count)
+    jitter = [s / c if c > 0 else None for s, c in zip(variation_sums.tolist(), variation_counts.tolist())]
+    goodput = np.bincount(unique_bins, weights=sizes[first], minlength=bins_count) * 8 / (interval * 1e6)
+    received = np.bincount(unique_bins, minlength=bins_count)
+    return {"interval": interval,
+            "times": (start + np.arange(bins_count) * interval).tolist(),
+            "goodput": goodput.tolist(),
+            "received": received.tolist(),
+            "lost": lost.astype(np.int64).tolist(),
+            "reordered": np.bincount(unique_bins[reordered], minlength=bins_count).tolist(),
+            "duplicated": np.bincount(bins[~first], minlength=bins_count).tolist(),
+            "jitter": jitter,
+            "totals": {"sent": int(expected), "received": int(len(unique_sequences)),
+                       "lost": int(expected - len(unique_sequences)), "reordered": int(reordered.sum()),
+                       "duplicated": int(len(sequences) - len(unique_sequences)),
+                       "jitter": float(variations.mean()) if len(variations) > 0 else None}}
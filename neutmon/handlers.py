@@ -1,10 +1,20 @@
 #!/usr/bin/python
 
+import collections
+import ctypes
 import errno
+import fcntl
 import json
 import logging
+import mmap
+import multiprocessing
+import os
+import Queue
 import socket
 import struct
+import tempfile
+import threading
+import time
 import traceback
 
 DEFAULT_SERVER_ADDRESS = "localhost"
@@ -14,8 +24,13 @@ SERVER_PORT = 10000
 BT_PORT = 6881
 ALT_BT_PORT = 53674
 TT_PORT = 54894
+# uTP shares the port of BitTorrent over TCP
+UDP_PORT = 6881
 # ALT_BT_PORTS = range(50000, 65536)
 BACKLOG_QUEUE_SIZE = 5
+SO_REUSEPORT = 15
+SO_ATTACH_REUSEPORT_CBPF = 51
+SKF_NET_OFF = -0x100000
 ROLE_SERVER = 0
 ROLE_CLIENT = 1
 
@@ -37,6 +52,32 @@ CONTROLLER_CLIENT_TEST_ABORT_ERROR = 14  # Connection aborted when testing
 CONTROLLER_CLIENT_TEST_TIMEOUT_ERROR = 15  # Connection timeout when testing
 CONTROLLER_CLIENT_TEST_GENERIC_ERROR = 16  # Generic error when testing
 CONTROLLER_CLIENT_TEST_INIT_ERROR = 17  # Generic error when initialising tester
+CONTROLLER_HEARTBEAT_MSG = 18  # Liveness message, can be sent by both roles at any time
+# Session is pipelined, results are uploaded apart from phase status. The client sends it back once connected for a
+# phase, after the uploads of the previous phases.
+CONTROLLER_PIPELINE_MSG = 19
+CONTROLLER_RESULT_MSG = 20  # Result of a phase, uploaded by client in pipelined sessions
+CONTROLLER_RETRY_AFTER_MSG = 21  # Session not admitted, extra is the number of seconds after which to retry
+CONTROLLER_SESSION_MSG = 22  # Session id, the client answers with its spooled sessions then with an OK message
+CONTROLLER_SPOOL_MSG = 23  # Results of a previous session spooled by the client
+CONTROLLER_SPOOL_ACK_MSG = 24  # Spooled session stored by the server, extra is its session id
+CONTROLLER_START_UUB_MSG = 25  # Start of the UDP phases, uplink and downlink BitTorrent (uTP) and control
+CONTROLLER_START_UUC_MSG = 26
+CONTROLLER_START_UDB_MSG = 27
+CONTROLLER_START_UDC_MSG = 28
+CONTROLLER_START_USWEEP_MSG = 29  # Start of a batch of port sweep bursts, uplink and downlink, extra is the ports
+CONTROLLER_START_DSWEEP_MSG = 30
+CONTROLLER_SPOOL_REJECT_MSG = 31  # Spooled session refused by the server, extra is the reason
+# Digest of the trace the server replays in the third test, the client answers with an OK message whose extra is
+# {"trace": digest of its trace or None}. The third test runs only if they match.
+CONTROLLER_TRACE_MSG = 32
+# Messages starting a phase, extra is the port number
+START_MESSAGES = range(CONTROLLER_START_UB_MSG, CONTROLLER_START_DT_MSG + 1) + \
+    range(CONTROLLER_START_UUB_MSG, CONTROLLER_START_UDC_MSG + 1)
+UDP_START_MESSAGES = range(CONTROLLER_START_UUB_MSG, CONTROLLER_START_UDC_MSG + 1)
+SWEEP_MESSAGES = [CONTROLLER_START_USWEEP_MSG, CONTROLLER_START_DSWEEP_MSG]
+# Server messages whose extra is a string: session id, reason of a rejection or trace digest
+TEXT_MESSAGES = [CONTROLLER_SESSION_MSG, CONTROLLER_SPOOL_ACK_MSG, CONTROLLER_SPOOL_REJECT_MSG, CONTROLLER_TRACE_MSG]
 
 TESTER_OK = 9
 TESTER_CONNECT_REFUSED_ERROR = 10
@@ -57,8 +98,51 @@ TEST_DOWNLINK_PHASE = 1
 TEST_SPEEDTEST_TYPE = 0
 TEST_TRACEROUTE_TYPE = 1
 
+DEFAULT_HEARTBEAT_INTERVAL = 2  # seconds
+DEFAULT_HEARTBEAT_TIMEOUT = 5 * DEFAULT_HEARTBEAT_INTERVAL  # seconds
+DEFAULT_SESSION_DEADLINE = 900  # seconds
+DEFAULT_PHASE_DEADLINE = 150  # seconds, speedtest duration excluded
+PENDING_TEST_CONNECTION_TIMEOUT = 30  # seconds
+# Datagrams of a client arriving once its test socket is closed must not be taken for the next test
+PENDING_DATAGRAM_TIMEOUT = 1  # seconds
+MAX_DATAGRAM_SIZE = 2048  # Bytes
+DEFAULT_ADMISSION_QUEUE_SIZE = 20
+DEFAULT_ADMISSION_MAX_WAIT = 600  # seconds
+DEFAULT_SESSION_BANDWIDTH = 100  # Mbps
+DEFAULT_SESSION_TIME_ESTIMATE = 300  # seconds
+DEFAULT_CONNECT_RETRIES = 3
+DEFAULT_CONNECT_RETRY_INTERVAL = 30  # seconds
+DEFAULT_SPOOL_DIRECTORY = os.path.join(os.path.expanduser("~"), ".neutmon_spool")
+SPOOL_SUFFIX = ".spool"
+HTTP_PORT = 80
+DEFAULT_HTTP_OBJECT_SIZE = 9437184  # Bytes
+DEFAULT_HTTP_MAX_OBJECT_SIZE = 64 * 1024 * 1024  # Bytes
+HTTP_MAX_REQUEST_LENGTH = 8192  # Bytes
+HTTP_MAX_CONNECTIONS = 32
+HTTP_REQUEST_TIMEOUT = 10  # seconds
+HTTP_SEND_TIMEOUT = 30  # seconds, a stalled download is closed after it
+HTTP_REASONS = {200: "OK", 206: "Partial Content", 400: "Bad Request", 405: "Method Not Allowed",
+                416: "Range Not Satisfiable", 503: "Service Unavailable"}
+
 logger = logging.getLogger(__name__)
 
+# Zero-copy transfer of the HTTP test object, sent from a memory map of it where libc has no sendfile
+try:
+    libc_sendfile = ctypes.CDLL(None, use_errno=True).sendfile
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    libc_sendfile = None
+
+
+def pin_by_source_address(listening_socket, groups):
+    # Classic BPF program run by the kernel on SO_REUSEPORT groups: the returned value is the index of the socket
+    # receiving the connection. A = source IPv4 address; A %= groups; return A
+    program = [(0x20, 0, 0, (SKF_NET_OFF + 12) & 0xffffffff), (0x94, 0, 0, groups), (0x16, 0, 0, 0)]
+    instructions = ctypes.create_string_buffer("".join([struct.pack("HBBI", *i) for i in program]))
+    listening_socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF,
+                                struct.pack("HP", len(program), ctypes.addressof(instructions)))
+
 
 class Connector(object):
     def __init__(self):
@@ -87,11 +171,13 @@ class ConnectorException(Exception):
 
 
 class Listener(object):
-    def __init__(self):
+    def __init__(self, reuse_port=False, address=SERVER_BINDING_ADDRESS):
         try:
             self.listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.listening_socket.bind((SERVER_BINDING_ADDRESS, SERVER_PORT))
+            if reuse_port:
+                self.listening_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            self.listening_socket.bind((address, SERVER_PORT))
             self.listening_socket.listen(BACKLOG_QUEUE_SIZE)
         except socket.error:
             raise ListenerException("Couldn't initialize listener socket")
@@ -103,6 +189,12 @@ class Listener(object):
             raise ListenerException("Error while accepting incoming connection")
         return client_socket, address
 
+    def pin_by_source_address(self, groups):
+        try:
+            pin_by_source_address(self.listening_socket, groups)
+        except socket.error:
+            raise ListenerException("Couldn't attach reuseport filter to listener socket")
+
     def close_socket(self):
         self.listening_socket.close()
 
@@ -112,23 +204,37 @@ class ListenerException(Exception):
 
 
 class Controller(object):
-    def __init__(self, control_socket, role=ROLE_SERVER):
+    def __init__(self, control_socket, role=ROLE_SERVER, heartbeat_timeout=0):
         if role != ROLE_SERVER and role != ROLE_CLIENT:
             raise WrongRoleException("Role %s does not exist" % role)
         self.__role = role
+        self.__heartbeat_timeout = heartbeat_timeout
+        self.__send_lock = threading.Lock()
         self.control_socket = control_socket
+        self.last_heartbeat = None
 
     def send_control_msg(self, msg, extra=None):
-        if msg not in range(CONTROLLER_START_UB_MSG, CONTROLLER_CLIENT_TEST_INIT_ERROR + 1):
+        if msg not in range(CONTROLLER_START_UB_MSG, CONTROLLER_TRACE_MSG + 1):
             raise ControllerException("Message is not valid")
-        if msg in range(CONTROLLER_START_UB_MSG, CONTROLLER_START_DT_MSG + 1):
+        if msg in START_MESSAGES:
             # extra is port number (integer)
             if self.__role != ROLE_SERVER:
                 raise WrongRoleException("Trying to send a server message without being server")
-            if extra is None or (extra != BT_PORT and extra != BT_PORT + 1 and extra not in [ALT_BT_PORT, TT_PORT]):
+            if extra is None or (extra != BT_PORT and extra != BT_PORT + 1 and
+                                 extra not in [ALT_BT_PORT, TT_PORT, UDP_PORT]):
                 raise ControllerException("Illegal or missing port number")
             try:
-                Controller.send_msg_on_tcp_socket(self.control_socket, msg, str(extra))
+                self.__send_msg(msg, str(extra))
+            except socket.error, se:
+                raise ControllerException("Controller socket error on sending message %i" % se.errno)
+        elif msg in SWEEP_MESSAGES:
+            # extra is the list of the ports of the batch
+            if self.__role != ROLE_SERVER:
+                raise WrongRoleException("Trying to send a server message without being server")
+            if not extra or [port for port in extra if port < 1 or port > 65535]:
+                raise ControllerException("Illegal or missing sweep ports")
+            try:
+                self.__send_msg(msg, ",".join(str(port) for port in extra))
             except socket.error, se:
                 raise ControllerException("Controller socket error on sending message %i" % se.errno)
         elif msg in range(CONTROLLER_OK_MSG, CONTROLLER_CLIENT_TEST_INIT_ERROR + 1):
@@ -137,9 +243,9 @@ class Controller(object):
                 raise WrongRoleException("Trying to send a client message without being client")
             try:
                 if extra is None:
-                    Controller.send_msg_on_tcp_socket(self.control_socket, msg)
+                    self.__send_msg(msg)
                 else:
-                    Controller.send_msg_on_tcp_socket(self.control_socket, msg, json.dumps(extra, encoding="utf-8"))
+                    self.__send_msg(msg, json.dumps(extra, encoding="utf-8"))
             except socket.error, se:
                 logger.error(traceback.format_exc())
                 raise ControllerException("Controller socket error on sending message %i" % se.errno)
@@ -148,9 +254,50 @@ class Controller(object):
             if self.__role != ROLE_SERVER:
                 raise WrongRoleException("Trying to send a server message without being server")
             try:
-                Controller.send_msg_on_tcp_socket(self.control_socket, msg)
+                self.__send_msg(msg)
             except socket.error, se:
                 raise ControllerException("Controller socket error on sending message %i", se.errno)
+        elif msg == CONTROLLER_HEARTBEAT_MSG or msg == CONTROLLER_PIPELINE_MSG:
+            # no extra, both roles
+            try:
+                self.__send_msg(msg)
+            except socket.error, se:
+                raise ControllerException("Controller socket error on sending message %i" % se.errno)
+        elif msg == CONTROLLER_RETRY_AFTER_MSG:
+            # extra is number of seconds (integer)
+            if self.__role != ROLE_SERVER:
+                raise WrongRoleException("Trying to send a server message without being server")
+            if extra is None:
+                raise ControllerException("Missing retry after seconds")
+            try:
+                self.__send_msg(msg, str(int(extra)))
+            except socket.error, se:
+                raise ControllerException("Controller socket error on sending message %i" % se.errno)
+        elif msg == CONTROLLER_RESULT_MSG or msg == CONTROLLER_SPOOL_MSG:
+            # extra is phase upload or spooled session dictionary
+            if self.__role != ROLE_CLIENT:
+                raise WrongRoleException("Trying to send a client message without being client")
+            if extra is None:
+                raise ControllerException("Missing result to upload")
+            try:
+                self.__send_msg(msg, json.dumps(extra, encoding="utf-8"))
+            except socket.error, se:
+                raise ControllerException("Controller socket error on sending result %i" % se.errno)
+        elif msg in TEXT_MESSAGES:
+            # extra is session id, reason of the rejection or trace digest
+            if self.__role != ROLE_SERVER:
+                raise WrongRoleException("Trying to send a server message without being server")
+            if extra is None:
+                raise ControllerException("Missing session id, reason or digest")
+            try:
+                self.__send_msg(msg, str(extra))
+            except socket.error, se:
+                raise ControllerException("Controller socket error on sending message %i" % se.errno)
+
+    def __send_msg(self, msg, extra=None):
+        # Heartbeats are sent from another thread, messages must not interleave on the socket
+        with self.__send_lock:
+            Controller.send_msg_on_tcp_socket(self.control_socket, msg, extra)
 
     def abort_measure(self):
         self.send_control_msg(CONTROLLER_ABORT_MEASURE_MSG)
@@ -158,23 +305,63 @@ class Controller(object):
     def finish_measure(self):
         self.send_control_msg(CONTROLLER_FINISH_MEASURE_MSG)
 
-    def recv_control_msg(self):
+    def recv_control_msg(self, deadline=None):
+        socket_timeout = self.control_socket.gettimeout()
         try:
-            msg, extra = Controller.recv_msg_from_tcp_socket(self.control_socket)
-            if msg not in range(CONTROLLER_START_UB_MSG, CONTROLLER_CLIENT_TEST_INIT_ERROR + 1):
+            while True:
+                timeout = socket_timeout
+                # Once the peer has proven to send heartbeats, silence is detected much earlier
+                if self.__heartbeat_timeout and self.last_heartbeat is not None:
+                    timeout = self.__heartbeat_timeout
+                if deadline is not None:
+                    timeout = deadline.timeout(timeout)
+                self.control_socket.settimeout(timeout)
+                msg, extra = Controller.recv_msg_from_tcp_socket(self.control_socket)
+                if msg != CONTROLLER_HEARTBEAT_MSG:
+                    break
+                logger.debug("Received heartbeat")
+                self.last_heartbeat = time.time()
+            if msg not in range(CONTROLLER_START_UB_MSG, CONTROLLER_TRACE_MSG + 1):
                 raise ControllerException("Received message is not valid")
-            if msg in range(CONTROLLER_START_UB_MSG, CONTROLLER_START_DT_MSG + 1):
+            if msg in START_MESSAGES:
                 if extra is None:
                     raise ControllerException("Received message is %i but doesn't contain port" % msg)
                 extra = int(extra)
-                if extra != BT_PORT and extra != BT_PORT + 1 and extra not in [ALT_BT_PORT, TT_PORT]:
+                if extra != BT_PORT and extra != BT_PORT + 1 and extra not in [ALT_BT_PORT, TT_PORT, UDP_PORT]:
                     raise ControllerException("The specified port for a start measure message is not valid")
+            elif msg in SWEEP_MESSAGES:
+                if extra is None:
+                    raise ControllerException("Received sweep message doesn't contain ports")
+                try:
+                    extra = [int(port) for port in extra.split(",")]
+                except ValueError:
+                    raise ControllerException("Received sweep ports are not valid")
+                if [port for port in extra if port < 1 or port > 65535]:
+                    raise ControllerException("Received sweep ports are not valid")
             elif msg in range(CONTROLLER_OK_MSG, CONTROLLER_CLIENT_TEST_INIT_ERROR + 1) and extra is not None:
                 extra = json.loads(extra, encoding="utf-8")
+            elif msg == CONTROLLER_RETRY_AFTER_MSG:
+                if extra is None:
+                    raise ControllerException("Received retry after message doesn't contain seconds")
+                extra = int(extra)
+            elif msg == CONTROLLER_RESULT_MSG or msg == CONTROLLER_SPOOL_MSG:
+                if extra is None:
+                    raise ControllerException("Received result upload is empty")
+                extra = json.loads(extra, encoding="utf-8")
+            elif msg in TEXT_MESSAGES:
+                if extra is None:
+                    raise ControllerException("Received message is %i but doesn't contain its text" % msg)
         except socket.timeout, t:
+            if deadline is not None and deadline.expired():
+                raise DeadlineException(deadline.name)
             raise ControllerException("Controller socket timeout on receiving message: %s" % t.message)
         except socket.error, e:
             raise ControllerException("Controller socket error on receiving message: %s %i" % (e.message, e.errno))
+        finally:
+            try:
+                self.control_socket.settimeout(socket_timeout)
+            except socket.error:
+                pass
         return msg, extra
 
     @staticmethod
@@ -240,31 +427,491 @@ class ControllerException(Exception):
     pass
 
 
+class DeadlineException(ControllerException):
+    def __init__(self, deadline_name):
+        self.deadline = deadline_name
+        ControllerException.__init__(self, "%s deadline exceeded" % deadline_name.capitalize())
+
+
+class Deadline(object):
+    def __init__(self, name, timeout, parent=None):
+        self.name = name
+        self.expiration = time.time() + timeout
+        # A deadline never outlives the one containing it (e.g. a phase inside a session)
+        if parent is not None and parent.expiration < self.expiration:
+            self.name = parent.name
+            self.expiration = parent.expiration
+
+    def remaining(self):
+        return self.expiration - time.time()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, timeout=None):
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineException(self.name)
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+
+class Watchdog(object):
+    # Once cancel returns the callback is over or never runs, so it can not act on a pooled tester checked out again
+    # by another session
+    def __init__(self, deadline, callback):
+        self.__callback = callback
+        self.__cancelled = False
+        self.__lock = threading.Lock()
+        self.__timer = threading.Timer(max(deadline.remaining(), 0), self.__expire)
+        self.__timer.daemon = True
+        self.__timer.start()
+
+    def __expire(self):
+        with self.__lock:
+            if not self.__cancelled:
+                self.__callback()
+
+    def cancel(self):
+        self.__timer.cancel()
+        with self.__lock:
+            self.__cancelled = True
+
+
+class Heartbeat(threading.Thread):
+    def __init__(self, controller, interval=DEFAULT_HEARTBEAT_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.__controller = controller
+        self.__interval = interval
+        self.__stop_event = threading.Event()
+
+    def run(self):
+        while not self.__stop_event.wait(self.__interval):
+            try:
+                self.__controller.send_control_msg(CONTROLLER_HEARTBEAT_MSG)
+            except ControllerException as ce:
+                logger.warning("Heartbeat stopped: %s" % ce.message)
+                break
+
+    def stop(self):
+        self.__stop_event.set()
+        self.join()
+
+
+class ResultUploader(threading.Thread):
+    def __init__(self, controller):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.__controller = controller
+        self.__uploads = Queue.Queue()
+        self.error = None
+
+    def upload(self, command, port, result):
+        self.__uploads.put({"command": command, "port": port, "result": result})
+
+    def run(self):
+        while True:
+            upload = self.__uploads.get()
+            try:
+                if upload is None:
+                    break
+                if self.error is None:
+                    self.__controller.send_control_msg(CONTROLLER_RESULT_MSG, upload)
+            except ControllerException as ce:
+                logger.error("Result upload failed: %s" % ce.message)
+                self.error = ce
+            finally:
+                self.__uploads.task_done()
+
+    def flush(self):
+        self.__uploads.join()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self.__uploads.put(None)
+        self.join()
+
+
+class ResultSpool(object):
+    # Client side copy of the results of the sessions not yet known to be stored by the server, a file of JSON lines
+    # for each session. The file of a running session is locked, so concurrent clients do not upload it.
+    def __init__(self, directory=DEFAULT_SPOOL_DIRECTORY):
+        self.directory = directory
+        self.session = None
+        self.__file = None
+        try:
+            os.makedirs(directory)
+        except OSError as ose:
+            if ose.errno != errno.EEXIST:
+                raise ose
+
+    def __path(self, session):
+        return os.path.join(self.directory, session + SPOOL_SUFFIX)
+
+    def open_session(self, session):
+        self.close_session()
+        self.session = session
+        self.__file = open(self.__path(session), "a")
+        fcntl.flock(self.__file, fcntl.LOCK_EX)
+
+    def __append(self, entry):
+        if self.__file is None:
+            return
+        try:
+            self.__file.write(json.dumps(entry, encoding="utf-8") + "\n")
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+        except (IOError, OSError) as e:
+            logger.error("Cannot spool result: %s" % e)
+
+    def store(self, command, port, status, result):
+        self.__append({"command": command, "port": port, "status": status, "result": result})
+
+    def store_meta_data(self, meta_data):
+        self.__append({"meta_data": meta_data})
+
+    def close_session(self, delivered=False):
+        # A delivered session is removed, otherwise it is uploaded to the server in a later session
+        if self.__file is None:
+            return
+        if delivered:
+            self.remove(self.session)
+        self.__file.close()
+        self.__file = None
+        self.session = None
+
+    def remove(self, session):
+        try:
+            os.remove(self.__path(session))
+        except OSError as ose:
+            if ose.errno != errno.ENOENT:
+                raise ose
+
+    def pending(self):
+        # Spooled sessions not locked by a running session, as spool message dictionaries
+        sessions = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(SPOOL_SUFFIX):
+                continue
+            session = name[:-len(SPOOL_SUFFIX)]
+            if session == self.session:
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "r") as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        continue
+                    spooled = {"session": session, "phases": [], "meta_data": None}
+                    for line in f:
+                        try:
+                            entry = json.loads(line, encoding="utf-8")
+                        except ValueError:
+                            # last line of a client that died while writing it
+                            continue
+                        if "meta_data" in entry:
+                            spooled["meta_data"] = entry["meta_data"]
+                        else:
+                            spooled["phases"].append(entry)
+            except IOError as ioe:
+                if ioe.errno != errno.ENOENT:
+                    raise ioe
+                continue
+            sessions.append(spooled)
+        return sessions
+
+
+class BandwidthReservations(object):
+    # Bandwidth (Mbps) reserved by the running sessions of every worker against a cap shared by all of them. The
+    # reservations are in shared memory, they must be created before the workers are forked.
+    def __init__(self, max_bandwidth, workers=1):
+        self.max_bandwidth = max_bandwidth
+        self.__reserved = multiprocessing.Array("d", workers)
+
+    def reserve(self, worker, bandwidth):
+        # A session is admitted when nothing is reserved, even beyond the cap
+        with self.__reserved.get_lock():
+            reserved = sum(self.__reserved)
+            if reserved > 0 and reserved + bandwidth > self.max_bandwidth:
+                return False
+            self.__reserved[worker] += bandwidth
+            return True
+
+    def release(self, worker, bandwidth):
+        with self.__reserved.get_lock():
+            self.__reserved[worker] -= bandwidth
+
+    def reset(self, worker):
+        # The sessions of a worker that exited are over
+        with self.__reserved.get_lock():
+            self.__reserved[worker] = 0
+
+
+class AdmissionController(object):
+    def __init__(self, handler, queue_size=DEFAULT_ADMISSION_QUEUE_SIZE, max_wait=DEFAULT_ADMISSION_MAX_WAIT,
+                 max_bandwidth=0, session_bandwidth=DEFAULT_SESSION_BANDWIDTH,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL, reservations=None, worker=0):
+        # handler(client) runs an admitted session, each in its own thread
+        self.__handler = handler
+        self.__queue_size = queue_size
+        self.__max_wait = max_wait
+        self.__heartbeat_interval = heartbeat_interval
+        # Every running session reserves a fixed bandwidth, whatever it uses, in the reservations shared by the
+        # workers of the server if any. Without a cap sessions of a worker run one at a time.
+        if max_bandwidth > 0:
+            self.__max_bandwidth = max_bandwidth
+            self.__session_bandwidth = session_bandwidth
+            self.__reservations = BandwidthReservations(max_bandwidth) if reservations is None else reservations
+            self.__worker = 0 if reservations is None else worker
+        else:
+            self.__max_bandwidth = self.__session_bandwidth = 1
+            self.__reservations = BandwidthReservations(1)
+            self.__worker = 0
+        # client address -> waiting clients, in round robin order across addresses
+        self.__waiting = collections.OrderedDict()
+        self.__waiting_number = 0
+        self.__active = set()
+        self.__session_time = DEFAULT_SESSION_TIME_ESTIMATE
+        self.__condition = threading.Condition()
+        dispatcher = threading.Thread(target=self.__dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+
+    def submit(self, client):
+        with self.__condition:
+            if self.__waiting_number >= self.__queue_size:
+                retry_after = self.__retry_after(self.__waiting_number)
+            else:
+                retry_after = None
+                address = client.address[0]
+                if address not in self.__waiting:
+                    self.__waiting[address] = collections.deque()
+                self.__waiting[address].append((client, Controller(client.control_socket), time.time()))
+                self.__waiting_number += 1
+                self.__condition.notify_all()
+        if retry_after is not None:
+            logger.warning("Admission queue full, %s retries after %i seconds" % (client.address[0], retry_after))
+            self.__reject(client, Controller(client.control_socket), retry_after)
+
+    def __retry_after(self, position):
+        slots = max(self.__max_bandwidth / self.__session_bandwidth, 1)
+        return int(self.__session_time * (position / slots + 1))
+
+    def __reject(self, client, controller, retry_after):
+        try:
+            controller.send_control_msg(CONTROLLER_RETRY_AFTER_MSG, retry_after)
+        except ControllerException as ce:
+            logger.warning("Unable to send retry after message: %s" % ce.message)
+        client.close_connection()
+
+    def __next_admission(self):
+        # First address in round robin order without a running session, if its session fits in the bandwidth cap
+        for address in self.__waiting:
+            if address not in self.__active:
+                if not self.__reservations.reserve(self.__worker, self.__session_bandwidth):
+                    return None
+                waiting = self.__waiting.pop(address)
+                client, controller, arrival = waiting.popleft()
+                if waiting:
+                    self.__waiting[address] = waiting
+                self.__waiting_number -= 1
+                return client
+        return None
+
+    def __expired(self):
+        expired = []
+        now = time.time()
+        for address in self.__waiting.keys():
+            waiting = self.__waiting[address]
+            while waiting and now - waiting[0][2] > self.__max_wait:
+                expired.append(waiting.popleft())
+                self.__waiting_number -= 1
+            if not waiting:
+                self.__waiting.pop(address)
+        return expired
+
+    def __dispatch(self):
+        last_heartbeat = 0
+        while True:
+            with self.__condition:
+                client = self.__next_admission()
+                while client is not None:
+                    self.__active.add(client.address[0])
+                    session = threading.Thread(target=self.__run, args=(client,))
+                    session.daemon = True
+                    session.start()
+                    client = self.__next_admission()
+                expired = self.__expired()
+                position = self.__waiting_number
+                if time.time() - last_heartbeat >= self.__heartbeat_interval:
+                    waiting = [w for queue in self.__waiting.values() for w in queue]
+                    last_heartbeat = time.time()
+                else:
+                    waiting = []
+            for client, controller, arrival in expired:
+                logger.warning("%s waited too long for admission" % client.address[0])
+                self.__reject(client, controller, self.__retry_after(position))
+            # Waiting clients would otherwise hit their control connection timeout
+            gone = []
+            for w in waiting:
+                try:
+                    w[1].send_control_msg(CONTROLLER_HEARTBEAT_MSG)
+                except ControllerException:
+                    gone.append(w)
+            with self.__condition:
+                for w in gone:
+                    address = w[0].address[0]
+                    if address in self.__waiting and w in self.__waiting[address]:
+                        logger.warning("%s left the admission queue" % address)
+                        self.__waiting[address].remove(w)
+                        self.__waiting_number -= 1
+                        if not self.__waiting[address]:
+                            self.__waiting.pop(address)
+                        w[0].close_connection()
+                self.__condition.wait(self.__heartbeat_interval)
+
+    def __run(self, client):
+        start = time.time()
+        try:
+            self.__handler(client)
+        except Exception as e:
+            logger.error("Session of %s failed: %s" % (client.address[0], e))
+        finally:
+            with self.__condition:
+                self.__active.discard(client.address[0])
+                self.__reservations.release(self.__worker, self.__session_bandwidth)
+                self.__session_time = 0.8 * self.__session_time + 0.2 * (time.time() - start)
+                self.__condition.notify_all()
+
+
+class TestListener(object):
+    # With datagram, a UDP socket: the first datagram of a client is its connection, accepted as a new UDP socket
+    # bound to the same port and connected to the client, which from then on receives all its datagrams
+    def __init__(self, port, reuse_port=False, datagram=False, address=SERVER_BINDING_ADDRESS):
+        self.port = port
+        self.datagram = datagram
+        self.address = address
+        # Test connections accepted on behalf of other sessions sharing the listener, by client address
+        self.__pending = dict()
+        self.__pending_timeout = PENDING_DATAGRAM_TIMEOUT if datagram else PENDING_TEST_CONNECTION_TIMEOUT
+        # Addresses of the accepted datagram connections, their late datagrams (retransmitted hellos, FIN copies)
+        # reach the listening socket once the connected one is closed and must not be taken for new connections
+        self.__accepted = dict()
+        self.__accepting = False
+        self.__condition = threading.Condition()
+        self.__reuse_port = reuse_port
+        try:
+            self.__listening_socket = self.__new_socket()
+            if not datagram:
+                self.__listening_socket.listen(BACKLOG_QUEUE_SIZE)
+        except socket.error, e:
+            raise TesterException(TESTER_INIT_SERVER_ERROR, "Unable to open listening socket on port: %i" % self.port,
+                                  e.errno)
+
+    def __new_socket(self):
+        new_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM if self.datagram else socket.SOCK_STREAM)
+        new_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.__reuse_port:
+            new_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        new_socket.bind((self.address, self.port))
+        return new_socket
+
+    def __accept(self):
+        if not self.datagram:
+            return self.__listening_socket.accept()
+        while True:
+            test_address = self.__listening_socket.recvfrom(MAX_DATAGRAM_SIZE)[1]
+            now = time.time()
+            for address in self.__accepted.keys():
+                if now - self.__accepted[address] > PENDING_TEST_CONNECTION_TIMEOUT:
+                    del self.__accepted[address]
+            if test_address not in self.__accepted:
+                break
+        self.__accepted[test_address] = now
+        test_socket = self.__new_socket()
+        test_socket.connect(test_address)
+        return test_socket, test_address
+
+    def pin_by_source_address(self, groups):
+        try:
+            pin_by_source_address(self.__listening_socket, groups)
+        except socket.error, e:
+            raise TesterException(TESTER_INIT_SERVER_ERROR,
+                                  "Unable to attach reuseport filter on port: %i" % self.port, e.errno)
+
+    def accept(self, deadline, peer_address=None):
+        # Only one thread at a time accepts, the others wait for it to hand over their connection
+        while True:
+            with self.__condition:
+                now = time.time()
+                for address in self.__pending.keys():
+                    if now - self.__pending[address][2] > self.__pending_timeout:
+                        logger.warning("Discarding test connection from %s on port %i" % (address, self.port))
+                        self.__pending.pop(address)[0].close()
+                if peer_address is not None and peer_address in self.__pending:
+                    return self.__pending.pop(peer_address)[:2]
+                if not self.__accepting:
+                    self.__accepting = True
+                    break
+                self.__condition.wait(deadline.timeout())
+        try:
+            while True:
+                self.__listening_socket.settimeout(deadline.timeout())
+                test_socket, test_address = self.__accept()
+                if peer_address is None or test_address[0] == peer_address:
+                    return test_socket, test_address
+                with self.__condition:
+                    # Connection of another session, or a late one of a previous client
+                    if test_address[0] in self.__pending:
+                        self.__pending[test_address[0]][0].close()
+                    self.__pending[test_address[0]] = (test_socket, test_address, time.time())
+                    self.__condition.notify_all()
+        finally:
+            with self.__condition:
+                self.__accepting = False
+                self.__condition.notify_all()
+
+    def close(self):
+        with self.__condition:
+            for address in self.__pending.keys():
+                self.__pending.pop(address)[0].close()
+        self.__listening_socket.close()
+
+
 class Tester(object):
-    def __init__(self, port, role=ROLE_SERVER, interface=""):
+    def __init__(self, port, role=ROLE_SERVER, interface="", pooled=False, listener=None, datagram=False):
         if role != ROLE_SERVER and role != ROLE_CLIENT:
             raise WrongRoleException("Role %s does not exist" % role)
         self.__role = role
         self.__port = port
+        self.__pooled = pooled
+        self.datagram = datagram
         if role == ROLE_SERVER:
-            try:
-                self.__listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.__listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                self.__listening_socket.bind((SERVER_BINDING_ADDRESS, self.__port))
-                self.__listening_socket.listen(1)
-                self.__test_socket = None
-                self.__test_address = None
-            except socket.error, e:
-                raise TesterException(TESTER_INIT_SERVER_ERROR,
-                                      "Unable to open listening socket on port: %i" % self.__port, e.errno)
+            if listener is None:
+                listener = TestListener(self.__port, datagram=datagram)
+            self.__listener = listener
+            self.__test_socket = None
+            self.__test_address = None
         else:
             try:
-                self.__test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.__test_socket = socket.socket(socket.AF_INET,
+                                                   socket.SOCK_DGRAM if datagram else socket.SOCK_STREAM)
                 self.__test_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 # self.__test_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             except socket.error, e:
                 raise TesterException(TESTER_INIT_CLIENT_ERROR, "Unable to create socket for tests", e.errno)
-        self.__icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        try:
+            self.__icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        except socket.error, e:
+            if e.errno != errno.EPERM and e.errno != errno.EACCES:
+                raise
+            # Without privileges the speedtests still run, the uplink traceroutes fail
+            logger.warning("No raw ICMP socket for port %i, traceroutes are not available" % port)
+            self.__icmp_socket = None
+            return
         self.__icmp_socket.setsockopt(socket.SOL_IP, socket.IP_HDRINCL, 1)
         if interface != "":
             self.__icmp_socket.setsockopt(socket.SOL_SOCKET, 25, interface)
@@ -272,12 +919,18 @@ class Tester(object):
             self.__icmp_socket.bind(("", port))
         self.__icmp_socket.settimeout(5)
 
-    def accept_test_connection(self):
+    @property
+    def port(self):
+        return self.__port
+
+    def accept_test_connection(self, deadline=None, peer_address=None):
         if self.__role != ROLE_SERVER:
             raise WrongRoleException("Trying to accept not being server")
         try:
-            self.__listening_socket.settimeout(5)
-            (self.__test_socket, test_address) = self.__listening_socket.accept()
+            (self.__test_socket, test_address) = self.__listener.accept(Deadline("accept", 5, deadline), peer_address)
+        except DeadlineException:
+            raise TesterTimeoutException(TESTER_ACCEPT_TIMEOUT_ERROR, "No incoming connection on port %i" % self.__port,
+                                         None)
         except socket.timeout, t:
             raise TesterTimeoutException(TESTER_ACCEPT_TIMEOUT_ERROR, "No incoming connection on port %i" % self.__port,
                                          t.errno)
@@ -286,13 +939,15 @@ class Tester(object):
                                   e.errno)
         return self.__test_socket, test_address
 
-    def connect(self, address, interface=""):
+    def connect(self, address, interface="", timeout=None):
         if self.__role != ROLE_CLIENT:
             raise WrongRoleException("Trying to connect not being client")
         try:
             # self.__test_socket.bind(("", ALT_BT_PORT))
             if interface != "":
                 self.__test_socket.setsockopt(socket.SOL_SOCKET, 25, interface)
+            # tests set their own timeouts
+            self.__test_socket.settimeout(timeout)
             self.__test_socket.connect((address, self.__port))
         except socket.timeout, t:
             raise TesterTimeoutException(TESTER_CONNECT_TIMEOUT_ERROR, "Connection timeout for port %i" % self.__port,
@@ -314,6 +969,9 @@ class Tester(object):
                     else:
                         test.uplink_test(self.__test_socket, duration)
                 elif test_type == TEST_TRACEROUTE_TYPE:
+                    if self.__icmp_socket is None:
+                        raise TesterException(TESTER_TEST_GENERIC_ERROR,
+                                              "No raw ICMP socket for the traceroute on port %i" % self.__port, None)
                     test.uplink_traceroute(self.__test_socket, self.__icmp_socket, result, stop_interfaces)
             elif phase == TEST_DOWNLINK_PHASE:
                 if test_type == TEST_SPEEDTEST_TYPE:
@@ -332,10 +990,12 @@ class Tester(object):
                 raise TesterException(TESTER_TEST_GENERIC_ERROR, "Test failed", e.errno)
 
     def close_test_connection(self):
+        # Can be called by a watchdog thread while the pooled Tester is being released
+        test_socket = self.__test_socket
         try:
-            if self.__test_socket is not None:
-                self.__test_socket.shutdown(socket.SHUT_RDWR)
-                self.__test_socket.close()
+            if test_socket is not None:
+                test_socket.shutdown(socket.SHUT_RDWR)
+                test_socket.close()
         except socket.error as se:
             logger.warning("Error on shutdown: %s, %i" % (se.message, se.errno))
 
@@ -343,11 +1003,279 @@ class Tester(object):
         try:
             if self.__test_socket is not None:
                 self.__test_socket.close()
-            if self.__role == ROLE_SERVER and self.__listening_socket is not None:
-                self.__listening_socket.close()
+                if self.__pooled:
+                    self.__test_socket = None
+            if self.__role == ROLE_SERVER and not self.__pooled:
+                self.__listener.close()
         except socket.error as se:
             logger.warning("Error on shutdown: %s, %i" % (se.message, se.errno))
 
+    def drain_icmp(self):
+        # ICMP messages received while idle are not related to the next test and would fill the socket buffer
+        drained = 0
+        if self.__icmp_socket is None:
+            return drained
+        try:
+            self.__icmp_socket.setblocking(0)
+            while True:
+                self.__icmp_socket.recv(512)
+                drained += 1
+        except socket.error:
+            pass
+        finally:
+            self.__icmp_socket.settimeout(5)
+        return drained
+
+    def close(self):
+        self.finish_test()
+        if self.__icmp_socket is None:
+            return
+        try:
+            self.__icmp_socket.close()
+        except socket.error as se:
+            logger.warning("Error on close: %s, %i" % (se.message, se.errno))
+
+
+class TesterPool(object):
+    def __init__(self, reuse_port=False, address=SERVER_BINDING_ADDRESS):
+        # One listener per port and protocol shared by every Tester, idle Testers keep their ICMP socket open.
+        # Listeners and idle Testers are keyed by (port, datagram).
+        self.__listeners = dict()
+        self.__idle = dict()
+        self.__lock = threading.Lock()
+        self.__reuse_port = reuse_port
+        self.__address = address
+
+    def bind(self, port, datagram=False):
+        key = (port, datagram)
+        with self.__lock:
+            if key not in self.__listeners:
+                logger.info("Binding pooled %s listener on port %i" % ("UDP" if datagram else "TCP", port))
+                self.__listeners[key] = TestListener(port, self.__reuse_port, datagram, self.__address)
+                self.__idle[key] = [Tester(port, pooled=True, listener=self.__listeners[key], datagram=datagram)]
+
+    def pin_by_source_address(self, groups):
+        with self.__lock:
+            for listener in self.__listeners.values():
+                listener.pin_by_source_address(groups)
+
+    def checkout(self, port, datagram=False):
+        key = (port, datagram)
+        self.bind(port, datagram)
+        with self.__lock:
+            if self.__idle[key]:
+                tester = self.__idle[key].pop()
+            else:
+                tester = Tester(port, pooled=True, listener=self.__listeners[key], datagram=datagram)
+        tester.drain_icmp()
+        return tester
+
+    def checkin(self, tester):
+        tester.finish_test()
+        key = (tester.port, tester.datagram)
+        with self.__lock:
+            if key in self.__idle:
+                if tester not in self.__idle[key]:
+                    self.__idle[key].append(tester)
+            else:
+                tester.close()
+
+    def close(self):
+        with self.__lock:
+            for key in self.__listeners.keys():
+                for tester in self.__idle.pop(key):
+                    tester.close()
+                self.__listeners.pop(key).close()
+
+
+def parse_http_range(value, size):
+    # (first, last) bytes of a single range of a Range header, None when the header is to be ignored (other units,
+    # multiple ranges or invalid syntax) and ValueError when no byte of the object is in the range
+    unit, _, spec = value.strip().partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        first = int(first) if first.strip() != "" else None
+        last = int(last) if last.strip() != "" else None
+    except ValueError:
+        return None
+    if first is None:
+        # suffix range, the last bytes of the object
+        if last is None or last < 0:
+            return None
+        if last == 0 or size == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - last, 0), size - 1
+    if first < 0 or last is not None and last < first:
+        return None
+    if first >= size:
+        raise ValueError("Range starts after the object end")
+    return first, size - 1 if last is None else min(last, size - 1)
+
+
+class HTTPResponder(threading.Thread):
+    # HTTP test endpoint of the server: every path is a random object of object_size bytes, or of the size in the
+    # "size" query parameter up to max_object_size. Single byte ranges are served with 206 responses. The object
+    # is an unlinked temporary file, sent to the sockets with sendfile.
+    def __init__(self, port=HTTP_PORT, object_size=DEFAULT_HTTP_OBJECT_SIZE,
+                 max_object_size=DEFAULT_HTTP_MAX_OBJECT_SIZE, address=SERVER_BINDING_ADDRESS):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.port = port
+        self.object_size = object_size
+        self.max_object_size = max(max_object_size, object_size)
+        self.__connections = threading.BoundedSemaphore(HTTP_MAX_CONNECTIONS)
+        self.__stop_event = threading.Event()
+        try:
+            self.__listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.__listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.__listening_socket.bind((address, self.port))
+            self.__listening_socket.listen(BACKLOG_QUEUE_SIZE)
+        except socket.error:
+            raise ListenerException("Couldn't initialize HTTP listener socket on port %i" % self.port)
+        self.__object = tempfile.TemporaryFile()
+        written = 0
+        while written < self.max_object_size:
+            chunk = os.urandom(min(1024 * 1024, self.max_object_size - written))
+            self.__object.write(chunk)
+            written += len(chunk)
+        self.__object.flush()
+        self.__map = mmap.mmap(self.__object.fileno(), self.max_object_size, prot=mmap.PROT_READ)
+
+    def run(self):
+        while not self.__stop_event.is_set():
+            try:
+                connection, address = self.__listening_socket.accept()
+            except socket.error as e:
+                if self.__stop_event.is_set():
+                    break
+                logger.warning("HTTP: Error while accepting incoming connection: %s" % e)
+                continue
+            if not self.__connections.acquire(False):
+                logger.warning("HTTP: Too many connections, refusing %s" % address[0])
+                self.__respond_error(connection, 503)
+                connection.close()
+                continue
+            handler = threading.Thread(target=self.__serve, args=(connection, address))
+            handler.daemon = True
+            handler.start()
+
+    def __read_request(self, connection):
+        request = ""
+        while "\r\n\r\n" not in request:
+            if len(request) > HTTP_MAX_REQUEST_LENGTH:
+                raise ValueError("Request too long")
+            data = connection.recv(HTTP_MAX_REQUEST_LENGTH)
+            if not data:
+                raise ValueError("Connection closed before the end of the request")
+            request += data
+        lines = request.partition("\r\n\r\n")[0].split("\r\n")
+        method, _, target = lines[0].partition(" ")
+        target = target.rpartition(" ")[0] or target
+        headers = dict()
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return method, target, headers
+
+    def __object_size(self, target):
+        query = target.partition("?")[2]
+        for parameter in query.split("&"):
+            name, _, value = parameter.partition("=")
+            if name == "size":
+                size = int(value)
+                if size < 0 or size > self.max_object_size:
+                    raise ValueError("Object size %i out of range" % size)
+                return size
+        return self.object_size
+
+    def __respond_error(self, connection, status, headers=""):
+        try:
+            connection.sendall("HTTP/1.1 %i %s\r\nContent-Length: 0\r\n%sConnection: close\r\n\r\n" %
+                               (status, HTTP_REASONS[status], headers))
+        except socket.error:
+            pass
+
+    def __send_object(self, connection, offset, count):
+        if libc_sendfile is None:
+            connection.sendall(buffer(self.__map, offset, count))
+            return
+        position = ctypes.c_int64(offset)
+        end = offset + count
+        while position.value < end:
+            sent = libc_sendfile(connection.fileno(), self.__object.fileno(), ctypes.byref(position),
+                                 end - position.value)
+            if sent < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                raise socket.error(error, os.strerror(error))
+            if sent == 0:
+                raise socket.error(errno.EPIPE, "sendfile sent nothing")
+
+    def __serve(self, connection, address):
+        try:
+            connection.settimeout(HTTP_REQUEST_TIMEOUT)
+            try:
+                method, target, headers = self.__read_request(connection)
+            except (ValueError, socket.timeout) as e:
+                logger.warning("HTTP: Bad request from %s: %s" % (address[0], e))
+                self.__respond_error(connection, 400)
+                return
+            if method not in ["GET", "HEAD"]:
+                self.__respond_error(connection, 405, "Allow: GET, HEAD\r\n")
+                return
+            try:
+                size = self.__object_size(target)
+            except ValueError as e:
+                logger.warning("HTTP: Bad request from %s: %s" % (address[0], e))
+                self.__respond_error(connection, 400)
+                return
+            first, last = 0, size - 1
+            status = 200
+            extra_headers = ""
+            if "range" in headers:
+                try:
+                    byte_range = parse_http_range(headers["range"], size)
+                except ValueError:
+                    self.__respond_error(connection, 416, "Content-Range: bytes */%i\r\n" % size)
+                    return
+                if byte_range is not None:
+                    first, last = byte_range
+                    status = 206
+                    extra_headers = "Content-Range: bytes %i-%i/%i\r\n" % (first, last, size)
+            count = last - first + 1
+            connection.sendall("HTTP/1.1 %i %s\r\nContent-Type: application/octet-stream\r\nContent-Length: %i\r\n"
+                               "Accept-Ranges: bytes\r\n%sConnection: close\r\n\r\n" %
+                               (status, HTTP_REASONS[status], count, extra_headers))
+            if method == "HEAD" or count == 0:
+                return
+            # sendfile needs a blocking socket, stalled downloads are stopped by the kernel send timeout
+            connection.settimeout(None)
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack("ll", HTTP_SEND_TIMEOUT, 0))
+            start = time.time()
+            self.__send_object(connection, first, count)
+            interval = max(time.time() - start, 1e-6)
+            logger.info("HTTP: Sent %i bytes to %s, Interval: %f, Throughput: %f" % (count, address[0], interval,
+                                                                                       count / interval))
+        except socket.error as e:
+            logger.warning("HTTP: Transfer to %s failed: %s" % (address[0], e))
+        finally:
+            connection.close()
+            self.__connections.release()
+
+    def stop(self):
+        self.__stop_event.set()
+        try:
+            self.__listening_socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.__listening_socket.close()
+        self.join()
+        self.__map.close()
+        self.__object.close()
+
 
 class TesterException(Exception):
     def __init__(self, error_code, message, error_errno):
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+import json
+import logging
+import os
+import select
+import subprocess
+import threading
+import time
+import analysis
+import handlers
+
+DEFAULT_PARIS_BINARY = "paris-traceroute"
+DEFAULT_TRACEBOX_BINARY = "tracebox"
+DEFAULT_PROBE_TIMEOUT = 120  # seconds
+# tracebox probes the ports of the BT tests, the metadata keys are tracebox_<port>
+TRACEBOX_PORTS = [handlers.BT_PORT, handlers.ALT_BT_PORT]
+PROBE_READ_SIZE = 65536
+ROUTE_TABLE = "/proc/net/route"
+
+logger = logging.getLogger(__name__)
+
+
+def default_route_interface(route_table=ROUTE_TABLE):
+    # Interface of the default route with the lowest metric, None if there is none
+    routes = []
+    try:
+        with open(route_table, "r") as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                # destination and mask 0, flags up
+                if len(fields) >= 8 and fields[1] == "00000000" and fields[7] == "00000000" and int(fields[3], 16) & 1:
+                    routes.append((int(fields[6]), fields[0]))
+    except (IOError, ValueError):
+        return None
+    return min(routes)[1] if routes else None
+
+
+def probe_commands(server_address, interface="", paris_binary=DEFAULT_PARIS_BINARY,
+                   tracebox_binary=DEFAULT_TRACEBOX_BINARY, default_interface=None):
+    # paris-traceroute can not be bound to an interface and follows the routing table, it only probes the path of an
+    # interface that has the default route
+    commands = []
+    if interface == "" or interface == default_interface:
+        commands.append(("paris", [paris_binary, "-n", server_address]))
+    for port in TRACEBOX_PORTS:
+        command = [tracebox_binary, "-j", "-n", "-p", "IP/TCP{dst=%i}" % port]
+        if interface != "":
+            command += ["-i", interface]
+        commands.append(("tracebox_%i" % port, command + [server_address]))
+    return commands
+
+
+def parse_probe_output(name, output):
+    # Metadata entry of the output of a probe, as the analyzers read it, and its number of hops
+    if output.strip() == "":
+        raise ValueError("no output")
+    if name == "paris":
+        return output, len(analysis.parse_paris(output))
+    tracebox = json.loads(output)
+    return tracebox, len(analysis.parse_tracebox(tracebox)[0])
+
+
+class PathProbes(threading.Thread):
+    # Runs paris-traceroute and tracebox towards the server at the same time, reading their outputs without blocking,
+    # kills the ones still running after timeout seconds and parses the outputs into metadata entries.
+    # tracebox sends SYNs to the test ports of the server, so tests wait for it with wait_port_probes.
+    def __init__(self, server_address, interface="", paris_binary=DEFAULT_PARIS_BINARY,
+                 tracebox_binary=DEFAULT_TRACEBOX_BINARY, timeout=DEFAULT_PROBE_TIMEOUT):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.__commands = probe_commands(server_address, interface, paris_binary, tracebox_binary,
+                                         default_route_interface())
+        self.__timeout = timeout
+        self.__stop_event = threading.Event()
+        self.__port_probes_done = threading.Event()
+        self.meta_data = dict()
+        self.report = dict()
+        if "paris" not in [name for name, command in self.__commands]:
+            self.report["paris"] = {"hops": 0, "time": 0.0, "returncode": None, "killed": False,
+                                    "error": "Not run, paris-traceroute can not be bound to %s" % interface}
+
+    def run(self):
+        start = time.time()
+        processes = dict()
+        with open(os.devnull, "w") as devnull:
+            for name, command in self.__commands:
+                self.report[name] = {"hops": 0, "time": 0.0, "returncode": None, "killed": False, "error": None}
+                try:
+                    processes[name] = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=devnull, close_fds=True)
+                except OSError as ose:
+                    self.report[name]["error"] = "Cannot run %s: %s" % (command[0], ose.strerror)
+                    logger.error("%s not started: %s" % (name, self.report[name]["error"]))
+        outputs = dict((name, []) for name in processes)
+        open_outputs = dict((process.stdout.fileno(), name) for name, process in processes.items())
+        deadline = start + self.__timeout
+        while open_outputs and not self.__stop_event.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # the stop event is checked at least every second
+            readable = select.select(list(open_outputs), [], [], min(remaining, 1))[0]
+            for fd in readable:
+                data = os.read(fd, PROBE_READ_SIZE)
+                if data:
+                    outputs[open_outputs[fd]].append(data)
+                    continue
+                name = open_outputs.pop(fd)
+                self.report[name]["time"] = time.time() - start
+            if not [name for name in open_outputs.values() if name != "paris"]:
+                self.__port_probes_done.set()
+        for name, process in processes.items():
+            if process.poll() is None:
+                process.kill()
+                self.report[name]["killed"] = True
+                self.report[name]["time"] = time.time() - start
+            self.report[name]["returncode"] = process.wait()
+            process.stdout.close()
+            try:
+                self.meta_data[name], self.report[name]["hops"] = parse_probe_output(name, "".join(outputs[name]))
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                self.report[name]["error"] = "Cannot parse the output: %s" % e
+                logger.error("%s output discarded: %s" % (name, self.report[name]["error"]))
+        self.__port_probes_done.set()
+
+    def wait_port_probes(self):
+        self.__port_probes_done.wait()
+
+    def stop(self):
+        # Kills the probes still running, their outputs are parsed anyway
+        self.__stop_event.set()
+        self.join()
+
+    def results(self):
+        self.join()
+        return self.meta_data
@@ -0,0 +1,315 @@
+#!/usr/bin/python
+
+import errno
+import logging
+import Queue
+import random
+import socket
+import threading
+import time
+import handlers
+import sweep
+
+# Payload signatures matched on the first bytes of either direction of a connection, as a DPI classifier does
+SIGNATURES = {"bittorrent": "\x13BitTorrent protocol", "http": "GET "}
+SHAPER_CHUNK = 16384  # Bytes, read and shaped at a time
+SHAPER_BURST = 2 * SHAPER_CHUNK  # Bytes, sent at the line rate by an idle token bucket
+SHAPER_QUEUE_CHUNKS = 16  # chunks held by each direction of a connection before the sender is pushed back
+SHAPER_SEGMENT_SIZE = 1460  # Bytes, losses are drawn per segment
+# A lost segment stalls the stream for the minimum retransmission timeout of Linux
+SHAPER_RETRANSMISSION_TIMEOUT = 0.2  # seconds
+SHAPER_CONNECT_TIMEOUT = 5  # seconds
+SHAPER_DIRECTIONS = ["uplink", "downlink"]
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    # Rate limit (Mbps) shared by the connections of a rule, or of the link, in one direction. Waiting senders are
+    # served in the order they asked, each one is charged before waiting.
+    def __init__(self, rate, burst=SHAPER_BURST):
+        self.rate = rate * 1e6 / 8
+        self.burst = burst
+        self.__tokens = burst
+        self.__last = time.time()
+        self.__lock = threading.Lock()
+
+    def consume(self, length):
+        with self.__lock:
+            now = time.time()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate) - length
+            self.__last = now
+            wait = -self.__tokens / self.rate if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ShapingRule(object):
+    # Rate limit (Mbps, 0 for none), delay (s) and segment loss probability applied to the connections to one of the
+    # ports whose first bytes, in either direction, start with the signature. Rules without ports match every port,
+    # rules without signature every payload.
+    def __init__(self, name, ports=None, signature=None, rate=0, delay=0, loss=0, directions=None):
+        if ports is None and signature is None:
+            raise ValueError("Rule %s matches every connection, use the link shaping" % name)
+        if rate < 0 or delay < 0 or not 0 <= loss < 1:
+            raise ValueError("Invalid shaping of rule %s" % name)
+        self.name = name
+        self.ports = None if ports is None else set(ports)
+        self.signature = signature
+        self.rate = rate
+        self.delay = delay
+        self.loss = loss
+        self.directions = SHAPER_DIRECTIONS if directions is None else directions
+        self.buckets = dict((direction, TokenBucket(rate)) for direction in self.directions if rate > 0)
+
+    def matches_port(self, port):
+        return self.ports is None or port in self.ports
+
+
+def parse_rule(spec, name=None):
+    # "signature=bittorrent,rate=10", "ports=6881-6889+51413,delay=0.05,loss=0.01,direction=downlink". Signatures are
+    # the names in SIGNATURES or hexadecimal strings prefixed by "hex:".
+    options = dict()
+    for part in spec.split(","):
+        key, separator, value = part.partition("=")
+        if not separator or key.strip() == "":
+            raise ValueError("Invalid rule option %s" % part)
+        options[key.strip()] = value.strip()
+    unknown = set(options) - set(["ports", "signature", "rate", "delay", "loss", "direction"])
+    if unknown:
+        raise ValueError("Unknown rule options %s" % ", ".join(sorted(unknown)))
+    ports = None
+    if "ports" in options:
+        ports = sweep.parse_port_ranges(options["ports"].replace("+", ","))
+    signature = options.get("signature")
+    if signature is not None:
+        if signature.startswith("hex:"):
+            try:
+                signature = signature[4:].decode("hex")
+            except TypeError:
+                raise ValueError("Invalid hexadecimal signature %s" % signature)
+        elif signature in SIGNATURES:
+            signature = SIGNATURES[signature]
+        else:
+            raise ValueError("Unknown signature %s" % signature)
+    direction = options.get("direction", "both")
+    if direction not in SHAPER_DIRECTIONS + ["both"]:
+        raise ValueError("Unknown direction %s" % direction)
+    try:
+        return ShapingRule(spec if name is None else name, ports, signature, float(options.get("rate", 0)),
+                           float(options.get("delay", 0)), float(options.get("loss", 0)),
+                           None if direction == "both" else [direction])
+    except ValueError as ve:
+        raise ValueError("Invalid rule %s: %s" % (spec, ve))
+
+
+class ShapedConnection(object):
+    # A connection relayed by the proxy: each direction has a reader and a writer thread with a bounded queue of
+    # (arrival time, chunk) between them. The first port rule matching the connection applies when it is accepted,
+    # a signature rule before it in the list replaces it once the first bytes of a direction match. Bytes relayed
+    # before are not shaped by the signature rule.
+    def __init__(self, proxy, client_socket, server_socket, port):
+        self.proxy = proxy
+        self.port = port
+        self.sockets = {"uplink": (client_socket, server_socket), "downlink": (server_socket, client_socket)}
+        self.rule = None
+        self.__candidates = []
+        for rule in proxy.rules:
+            if not rule.matches_port(port):
+                continue
+            if rule.signature is None:
+                self.rule = rule
+                break
+            self.__candidates.append(rule)
+        self.__prefixes = {"uplink": "", "downlink": ""}
+        self.__lock = threading.Lock()
+        self.__open_directions = 2
+        self.__closed = False
+        self.threads = []
+        for direction in SHAPER_DIRECTIONS:
+            queue = Queue.Queue(SHAPER_QUEUE_CHUNKS)
+            self.threads.append(threading.Thread(target=self.__read, args=(direction, queue)))
+            self.threads.append(threading.Thread(target=self.__write, args=(direction, queue)))
+        if not self.__candidates and self.rule is not None:
+            proxy.count_connection(self.rule)
+
+    def start(self):
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __classify(self, direction, data):
+        with self.__lock:
+            if not self.__candidates:
+                return
+            length = max(len(rule.signature) for rule in self.__candidates)
+            prefix = self.__prefixes[direction]
+            if len(prefix) >= length:
+                return
+            prefix = self.__prefixes[direction] = prefix + data[:length - len(prefix)]
+            for rule in self.__candidates:
+                if prefix.startswith(rule.signature):
+                    self.rule = rule
+                    self.__candidates = []
+                    logger.info("Connection to port %i matched rule %s" % (self.port, rule.name))
+                    self.proxy.count_connection(rule)
+                    return
+            # a direction whose first bytes match no signature can not match later
+            if min(len(p) for p in self.__prefixes.values()) >= length:
+                self.__candidates = []
+                if self.rule is not None:
+                    self.proxy.count_connection(self.rule)
+
+    def __read(self, direction, queue):
+        source = self.sockets[direction][0]
+        try:
+            while True:
+                data = source.recv(SHAPER_CHUNK)
+                if not data:
+                    break
+                self.__classify(direction, data)
+                queue.put((time.time(), data))
+        except socket.error as se:
+            if not self.__closed:
+                logger.debug("Connection to port %i: %s reader error %s" % (self.port, direction, se))
+                self.close()
+        finally:
+            queue.put(None)
+
+    def __write(self, direction, queue):
+        destination = self.sockets[direction][1]
+        finished = False
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    finished = True
+                    break
+                arrival, data = item
+                rule = self.rule
+                if rule is not None and direction not in rule.directions:
+                    rule = None
+                due = arrival + self.proxy.link_delay
+                if rule is not None:
+                    due += rule.delay
+                    segments = (len(data) + SHAPER_SEGMENT_SIZE - 1) // SHAPER_SEGMENT_SIZE
+                    if rule.loss > 0 and random.random() < 1 - (1 - rule.loss) ** segments:
+                        due += SHAPER_RETRANSMISSION_TIMEOUT
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                if rule is not None:
+                    if direction in rule.buckets:
+                        rule.buckets[direction].consume(len(data))
+                    self.proxy.count_bytes(rule, len(data))
+                if direction in self.proxy.link_buckets:
+                    self.proxy.link_buckets[direction].consume(len(data))
+                destination.sendall(data)
+            destination.shutdown(socket.SHUT_WR)
+        except socket.error as se:
+            if not self.__closed:
+                logger.debug("Connection to port %i: %s writer error %s" % (self.port, direction, se))
+                self.close()
+            # the reader may be blocked on a full queue
+            while not finished and queue.get() is not None:
+                pass
+        with self.__lock:
+            self.__open_directions -= 1
+            done = self.__open_directions == 0
+        if done:
+            self.close()
+
+    def close(self):
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+        for client_or_server in self.sockets["uplink"]:
+            try:
+                client_or_server.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            client_or_server.close()
+        self.proxy.remove_connection(self)
+
+
+class ShapingProxy(object):
+    # User space stand-in of a differentiating middlebox: relays the TCP connections to the ports of listen_address
+    # to the same ports of target_address, shaping each connection with the first matching rule, then everything with
+    # the link rate limit (Mbps, 0 for none) and delay (s).
+    def __init__(self, listen_address, target_address, ports, rules, link_rate=0, link_delay=0):
+        self.listen_address = listen_address
+        self.target_address = target_address
+        self.ports = ports
+        self.rules = rules
+        self.link_delay = link_delay
+        self.link_buckets = dict((direction, TokenBucket(link_rate)) for direction in SHAPER_DIRECTIONS
+                                 if link_rate > 0)
+        self.statistics = dict((rule.name, {"connections": 0, "bytes": 0}) for rule in rules)
+        self.__connections = set()
+        self.__listeners = []
+        self.__lock = threading.Lock()
+        self.__stop_event = threading.Event()
+
+    def start(self):
+        for port in self.ports:
+            listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                listening_socket.bind((self.listen_address, port))
+                listening_socket.listen(handlers.BACKLOG_QUEUE_SIZE)
+            except socket.error as se:
+                listening_socket.close()
+                self.stop()
+                raise handlers.ListenerException("Couldn't initialize proxy listener on port %i: %s" % (port, se))
+            self.__listeners.append(listening_socket)
+            thread = threading.Thread(target=self.__accept, args=(listening_socket, port))
+            thread.daemon = True
+            thread.start()
+
+    def __accept(self, listening_socket, port):
+        while not self.__stop_event.is_set():
+            try:
+                client_socket, address = listening_socket.accept()
+            except socket.error as se:
+                if self.__stop_event.is_set() or se.errno == errno.EBADF:
+                    break
+                logger.warning("Proxy: error while accepting on port %i: %s" % (port, se))
+                continue
+            try:
+                server_socket = socket.create_connection((self.target_address, port), SHAPER_CONNECT_TIMEOUT)
+                server_socket.settimeout(None)
+            except socket.error as se:
+                # the client sees the failure of the server
+                logger.info("Proxy: cannot connect to port %i: %s" % (port, se))
+                client_socket.close()
+                continue
+            connection = ShapedConnection(self, client_socket, server_socket, port)
+            with self.__lock:
+                self.__connections.add(connection)
+            connection.start()
+
+    def count_connection(self, rule):
+        with self.__lock:
+            self.statistics[rule.name]["connections"] += 1
+
+    def count_bytes(self, rule, length):
+        with self.__lock:
+            self.statistics[rule.name]["bytes"] += length
+
+    def remove_connection(self, connection):
+        with self.__lock:
+            self.__connections.discard(connection)
+
+    def stop(self):
+        self.__stop_event.set()
+        for listening_socket in self.__listeners:
+            try:
+                listening_socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            listening_socket.close()
+        with self.__lock:
+            connections = list(self.__connections)
+        for connection in connections:
+            connection.close()
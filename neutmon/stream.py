@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+import array
+import json
+import numpy as np
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# What to do with a subtree of the document
+SKIP = 0
+DESCEND = 1
+KEEP = 2
+SAMPLES = 3
+
+SPEEDTEST_DIRECTIONS = ["uplink", "downlink"]
+CLIENT_META_KEEP = ["paris", "tracebox_6881", "tracebox_53674"]
+# Fields of the MONROE interface and GPS metadata used by the analyzers
+INTERFACE_META_KEEP = ["Operator", "DeviceMode", "RSSI", "CID"]
+GPS_META_KEEP = ["Latitude", "Longitude"]
+
+
+def select_result_subtree(path):
+    # Subtrees of a NeutMon output file used by parse_result, speedtests are read straight into sample arrays
+    depth = len(path)
+    if path[0] == "error":
+        return KEEP
+    if path[0] == "results":
+        if depth <= 2:
+            return DESCEND
+        if path[2] in ["finished", "port"]:
+            return KEEP
+        if path[2] not in SPEEDTEST_DIRECTIONS:
+            return SKIP
+        if depth <= 4:
+            return DESCEND
+        if path[4] == "speedtest":
+            return SAMPLES
+        if path[4] in ["traceroute", "udp"]:
+            return KEEP
+        return SKIP
+    if path[0] == "meta_data":
+        if depth == 1 or path[1] == "client_meta" and depth == 2:
+            return DESCEND
+        if path[1] != "client_meta":
+            return SKIP
+        if path[2] == "http_test":
+            return SAMPLES
+        if path[2] in ["interface", "gps"]:
+            if depth <= 4:
+                return DESCEND
+            keep = INTERFACE_META_KEEP if path[2] == "interface" else GPS_META_KEEP
+            return KEEP if path[4] in keep else SKIP
+        if path[2] in CLIENT_META_KEEP:
+            return KEEP
+    return SKIP
+
+
+def samples_arrays(times, sizes):
+    times = np.frombuffer(times, dtype=np.float64) if len(times) > 0 else np.zeros(0, dtype=np.float64)
+    sizes = np.array(sizes, dtype=np.int64)
+    order = np.argsort(times, kind="mergesort")
+    return times[order], sizes[order]
+
+
+def load_json_subtrees(json_file, select=select_result_subtree):
+    # Event based parsing of the subtrees chosen by select(path), path is the tuple of the keys from the root
+    # ("item" for array elements). Whole documents are loaded when ijson is not available.
+    # SAMPLES subtrees are {time: bytes} maps read into a (times, sizes) pair of sorted arrays, other entries
+    # of those maps (like an error message) are dropped.
+    if ijson is None:
+        return json.load(json_file)
+    root = None
+    # frames of the open containers: [container, mode, path, current key]
+    stack = []
+    skip_depth = 0
+    for event, value in ijson.basic_parse(json_file, use_float=True):
+        if skip_depth:
+            if event == "start_map" or event == "start_array":
+                skip_depth += 1
+            elif event == "end_map" or event == "end_array":
+                skip_depth -= 1
+            continue
+        if event == "map_key":
+            stack[-1][3] = value
+            continue
+        if event == "end_map" or event == "end_array":
+            container, mode, path, key = stack.pop()
+            if mode == SAMPLES:
+                container = samples_arrays(*container)
+            value = container
+        elif not stack:
+            stack.append([dict() if event == "start_map" else [], DESCEND, (), None])
+            continue
+        else:
+            parent, parent_mode, parent_path, key = stack[-1]
+            if parent_mode == SAMPLES:
+                if event == "number":
+                    try:
+                        parent[0].append(float(key))
+                    except ValueError:
+                        continue
+                    parent[1].append(int(value))
+                elif event == "start_map" or event == "start_array":
+                    skip_depth = 1
+                continue
+            path = parent_path + ((key if isinstance(parent, dict) else "item"),)
+            mode = KEEP if parent_mode == KEEP else select(path)
+            if mode == SKIP:
+                if event == "start_map" or event == "start_array":
+                    skip_depth = 1
+                continue
+            if event == "start_map":
+                if mode == SAMPLES:
+                    stack.append([(array.array("d"), array.array("l")), mode, path, None])
+                else:
+                    stack.append([dict(), mode, path, None])
+                continue
+            if event == "start_array":
+                stack.append([[], KEEP if mode == SAMPLES else mode, path, None])
+                continue
+        if not stack:
+            root = value
+        elif isinstance(stack[-1][0], dict):
+            stack[-1][0][stack[-1][3]] = value
+        else:
+            stack[-1][0].append(value)
+    return root
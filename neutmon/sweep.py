@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+import numpy as np
+import analysis
+import batchstats
+import handlers
+
+DEFAULT_SWEEP_CONCURRENCY = 4  # bursts at the same time, the reference one included
+DEFAULT_SWEEP_BURST = 5  # seconds
+DEFAULT_SWEEP_REFERENCE_PORT = handlers.TT_PORT
+DEFAULT_SWEEP_MIN_INTERVAL = 0.1  # seconds, minimum interval of the throughput bins compared
+# The sweep stops once this many ports are in each class, 0 sweeps all the ports
+DEFAULT_SWEEP_MIN_CLASS_PORTS = 3
+# A port whose bins differ from the reference ones is blocked when its median throughput is below this fraction of
+# the reference median, concurrent bursts never share the bottleneck evenly
+DEFAULT_THROTTLE_RATIO = 0.5
+SWEEP_CONNECT_TIMEOUT = 5  # seconds
+SWEEP_DIRECTIONS = ["uplink", "downlink"]
+BLOCKED = "blocked"
+UNBLOCKED = "unblocked"
+# Bursts that failed for reasons other than the network policy, their ports are in neither class
+ERROR = "error"
+# Statuses of the bursts that did not start because of the server or of the client
+SERVER_ERRORS = [handlers.TESTER_INIT_SERVER_ERROR, handlers.TESTER_ACCEPT_GENERIC_ERROR]
+CLIENT_ERRORS = [handlers.CONTROLLER_CLIENT_TEST_INIT_ERROR]
+
+
+def parse_port_ranges(spec):
+    # "6881-6889,51413" -> [6881, ..., 6889, 51413], without repetitions, in the given order
+    ports = []
+    seen = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        first, separator, last = part.partition("-")
+        try:
+            first = int(first)
+            last = int(last) if separator else first
+        except ValueError:
+            raise ValueError("Invalid port range %s" % part)
+        if first < 1 or last > 65535 or first > last:
+            raise ValueError("Invalid port range %s" % part)
+        if first <= handlers.SERVER_PORT <= last:
+            raise ValueError("Port range %s contains the control port %i" % (part, handlers.SERVER_PORT))
+        for port in range(first, last + 1):
+            if port not in seen:
+                seen.add(port)
+                ports.append(port)
+    if len(ports) == 0:
+        raise ValueError("No port to sweep")
+    return ports
+
+
+def spread_order(ports):
+    # Ports in the order of the bit reversed indexes, every prefix is spread over the whole list, so a sweep
+    # stopped early has sampled all of its ranges
+    bits = max(len(ports) - 1, 1).bit_length()
+    keys = [int(format(i, "0%ib" % bits)[::-1], 2) for i in range(len(ports))]
+    return [port for key, port in sorted(zip(keys, ports))]
+
+
+class PortSweep(object):
+    # Sweep of a direction: batches of short BT bursts, each with the reference port and up to concurrency - 1 swept
+    # ports at the same time. Every port is compared with the reference burst of its own batch, which had the same
+    # share of the bottleneck. Batches are lists of {port: entry} maps, entries hold the statuses of both sides and
+    # the samples of the speedtest of the receiver.
+    def __init__(self, ports, direction, reference=DEFAULT_SWEEP_REFERENCE_PORT,
+                 concurrency=DEFAULT_SWEEP_CONCURRENCY, min_class_ports=DEFAULT_SWEEP_MIN_CLASS_PORTS,
+                 significance=0.05, min_interval=DEFAULT_SWEEP_MIN_INTERVAL, throttle_ratio=DEFAULT_THROTTLE_RATIO):
+        if direction not in SWEEP_DIRECTIONS:
+            raise ValueError("Unknown sweep direction %s" % direction)
+        if concurrency < 2:
+            raise ValueError("Sweep concurrency must be at least 2, the reference burst included")
+        self.ports = spread_order([port for port in ports if port != reference])
+        self.direction = direction
+        self.reference = reference
+        self.concurrency = concurrency
+        self.min_class_ports = min_class_ports
+        self.significance = significance
+        self.min_interval = min_interval
+        self.throttle_ratio = throttle_ratio
+        self.batches = []
+        self.port_map = dict()
+        self.__position = 0
+        self.__pairs = []
+        self.__labels = []
+
+    def next_batch(self):
+        # Ports of the next batch, the reference first, None when the sweep is over
+        if self.__position >= len(self.ports) or self.separated():
+            return None
+        ports = self.ports[self.__position:self.__position + self.concurrency - 1]
+        self.__position += len(ports)
+        return [self.reference] + ports
+
+    def record(self, entries):
+        # Stores the entries of the last batch, keyed by port string, and classifies its ports
+        self.batches.append(entries)
+        self.port_map.update(self.classify(len(self.batches) - 1))
+
+    def throughput(self, entry):
+        if entry.get("server_status") != handlers.TESTER_OK or \
+                entry.get("client_status") != handlers.CONTROLLER_OK_MSG:
+            return np.zeros(0)
+        speedtest = entry.get("speedtest", dict())
+        if len(speedtest) < 2:
+            return np.zeros(0)
+        return analysis.throughput_bins(speedtest, self.min_interval)[2]
+
+    def failure_class(self, entry, reference_entry):
+        # Class of a failed burst: an error if a side could not run it or if the reference failed too, as the whole
+        # path may be down, otherwise the port is blocked
+        if entry.get("server_status") in SERVER_ERRORS or entry.get("client_status") in CLIENT_ERRORS:
+            return ERROR
+        if entry.get("server_status") is None or len(self.throughput(reference_entry)) == 0:
+            return ERROR
+        return BLOCKED
+
+    def classify(self, i):
+        # Per port map of batch i: median throughput (Mbps) of the port and of its reference, KS verdict against the
+        # reference bins and class. Failed bursts have a "-" verdict and are "error" or "blocked" (failure_class),
+        # only successful bursts with a failed reference are unblocked without a verdict.
+        # The multiple comparison correction covers the comparisons of all the batches so far, but the verdicts of
+        # the previous batches are final, so the classes the sweep stops on never change.
+        port_map = dict()
+        batch = self.batches[i]
+        reference = self.throughput(batch[str(self.reference)])
+        for port, entry in batch.items():
+            if port == str(self.reference):
+                continue
+            throughput = self.throughput(entry)
+            port_map[port] = {"batch": i, "server_status": entry.get("server_status"),
+                              "client_status": entry.get("client_status"),
+                              "throughput": float(np.median(throughput)) if len(throughput) > 0 else None,
+                              "reference_throughput": float(np.median(reference)) if len(reference) > 0 else None,
+                              "verdict": "-", "class": UNBLOCKED}
+            if len(throughput) == 0:
+                port_map[port]["class"] = self.failure_class(entry, batch[str(self.reference)])
+            elif len(reference) > 0:
+                self.__pairs.append((reference, throughput))
+                self.__labels.append(port)
+        if len(self.__pairs) > 0:
+            for row in batchstats.compare_pairs(self.__pairs, self.__labels, self.significance, resamples=0):
+                if row[0] not in port_map:
+                    continue
+                port_map[row[0]]["verdict"] = row[-1]
+                if row[-1] == "DIFF" and row[4] < self.throttle_ratio * row[3]:
+                    port_map[row[0]]["class"] = BLOCKED
+        return port_map
+
+    def class_counts(self):
+        classes = [entry["class"] for entry in self.port_map.values()]
+        return classes.count(BLOCKED), classes.count(UNBLOCKED), classes.count(ERROR)
+
+    def separated(self):
+        if self.min_class_ports <= 0:
+            return False
+        return min(self.class_counts()[:2]) >= self.min_class_ports
+
+    def report(self):
+        blocked, unblocked, errors = self.class_counts()
+        return {"direction": self.direction, "reference": self.reference, "concurrency": self.concurrency,
+                "batches": self.batches, "map": self.port_map, "blocked": blocked, "unblocked": unblocked,
+                "errors": errors,
+                "untested": self.ports[self.__position:],
+                "early_termination": self.__position < len(self.ports) and self.separated()}
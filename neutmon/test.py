@@ -1,19 +1,24 @@
 #!/usr/bin/python
 
+import errno
 import logging
 import os
 import random
+import select
 import socket
 import struct
 import time
 from abc import ABCMeta, abstractmethod
 from scapy.layers.inet import IP, IPerror, TCP, ICMP, TCPerror
 from scapy.all import *
+import datagrams
 
 DEFAULT_TEST_DURATION = 10  # seconds
 DEFAULT_TRANSFER_DIMENSION = 1024 * 1024  # Bytes
 DEFAULT_BT_TRANSFER_DIMENSION = 16397  # Bytes
 DEFAULT_HTTP_TRANSFER_DIMENSION = 260 + 9437184 + 2  # Bytes (header + file)
+HTTP_MAX_HEADER_LENGTH = 8192  # Bytes
+HTTP_RECEIVE_BUFFER = 65536  # Bytes
 BITTORRENT_PORT = 6881
 BITTORRENT_ALTERNATIVE_PORT = 51413
 BITTORRENT_REQUEST_LENGTH = 13
@@ -26,6 +31,30 @@ BITTORRENT_START_OFFSET = 0x0
 BITTORRENT_RESPONSE_LENGTH = 0x9
 BITTORRENT_PIECE_TYPE = 0x7
 NUMBER_OF_REQUESTS = 80
+DEFAULT_UDP_RATE = 10  # Mbps
+DEFAULT_UDP_DATAGRAM_SIZE = 1200  # Bytes
+UDP_HELLO_INTERVAL = 0.2  # seconds
+UDP_HANDSHAKE_TIMEOUT = 5  # seconds
+UDP_IDLE_TIMEOUT = 5  # seconds
+UDP_FIN_COPIES = 5
+UDP_FIN_INTERVAL = 0.02  # seconds
+DATAGRAM_HELLO = 0
+DATAGRAM_DATA = 1
+DATAGRAM_FIN = 2
+# kind, sequence number, send time
+UDP_TEST_HEADER = struct.Struct("!BId")
+UTP_VERSION = 1
+UTP_ST_DATA = 0
+UTP_ST_FIN = 1
+UTP_ST_SYN = 4
+UTP_WINDOW = 0x100000
+# type and version, extension, connection id, timestamp (us), timestamp difference (us), window, seq_nr, ack_nr
+UTP_HEADER = struct.Struct("!BBHIIIHH")
+# BitTorrent piece message: length, type, index, begin, then the send time at the start of the block
+UTP_PIECE_HEADER = struct.Struct("!IBIId")
+TRACE_RECEIVE_BUFFER = 65536  # Bytes
+TRACE_FULL_SPEED_CHUNK = 65536  # Bytes
+TRACE_IDLE_TIMEOUT = 5  # seconds, on top of the longest pause of the trace
 logger = logging.getLogger(__name__)
 
 
@@ -110,22 +139,73 @@ class TCPTest(Test):
 
 
 class TCPHTTPTest(TCPTest):
-    def __init__(self, host, http_file, transfer_dimension=DEFAULT_HTTP_TRANSFER_DIMENSION):
+    # Downloads http_file, or its first object_size bytes with a Range request. The length of the body is read from
+    # Content-Length, transfer_dimension bounds responses without it, which are read until the connection is closed.
+    def __init__(self, host, http_file, transfer_dimension=DEFAULT_HTTP_TRANSFER_DIMENSION, object_size=None):
         self.host = host
         self.http_file = http_file
+        self.object_size = object_size
         TCPTest.__init__(self, transfer_dimension)
 
+    def build_request(self):
+        request = "GET /%s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n" % (self.http_file, self.host)
+        if self.object_size is not None:
+            request += "Range: bytes=0-%i\r\n" % (self.object_size - 1)
+        return request + "\r\n"
+
+    def receive_header(self, receive_socket, intervals):
+        # Status code, lower case headers and the first bytes of the body received with the header
+        data = ""
+        while "\r\n\r\n" not in data:
+            if len(data) > HTTP_MAX_HEADER_LENGTH:
+                raise socket.error("HTTP header too long")
+            msg = receive_socket.recv(HTTP_RECEIVE_BUFFER)
+            if not msg:
+                raise socket.error("Connection closed while receiving the HTTP header")
+            intervals[time.time()] = len(msg)
+            data += msg
+        header, _, body = data.partition("\r\n\r\n")
+        lines = header.split("\r\n")
+        try:
+            status = int(lines[0].split()[1])
+        except (IndexError, ValueError):
+            raise socket.error("Malformed HTTP status line: %s" % lines[0][:100])
+        headers = dict()
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return status, headers, body
+
+    def receive_body(self, receive_socket, length, intervals):
+        # The body is only counted, received into a reused buffer
+        buffer_view = memoryview(bytearray(HTTP_RECEIVE_BUFFER))
+        received = 0
+        while received < length:
+            n = receive_socket.recv_into(buffer_view, min(HTTP_RECEIVE_BUFFER, length - received))
+            if n == 0:
+                break
+            intervals[time.time()] = n
+            received += n
+        return received
+
     def downlink_test(self, receive_socket, intervals):
         receive_socket.settimeout(5)
-        request = "GET /%s HTTP/1.1\r\nHost: %s\r\n\r\n" % (self.http_file, self.host)
-        self.send_on_socket(receive_socket, request)
+        self.send_on_socket(receive_socket, self.build_request())
         start = time.time()
         intervals[start] = 0
-        msg = self.receive_from_socket(receive_socket, self.transfer_dimension, intervals)
+        status, headers, body = self.receive_header(receive_socket, intervals)
+        if status not in [200, 206]:
+            logger.warning("HTTP status %i for /%s" % (status, self.http_file))
+        try:
+            length = int(headers["content-length"])
+        except (KeyError, ValueError):
+            length = self.transfer_dimension
+        received = len(body) + self.receive_body(receive_socket, length - len(body), intervals)
         stop = time.time()
         interval = stop - start
-        total_rec = len(msg)
-        logger.info("Received: %i, Interval: %f, Throughput: %f" % (total_rec, interval, (total_rec / interval)))
+        if received < length and "content-length" in headers:
+            logger.warning("Connection closed after %i of %i bytes" % (received, length))
+        logger.info("Received: %i, Interval: %f, Throughput: %f" % (received, interval, (received / interval)))
 
     def uplink_test(self, send_socket, duration=DEFAULT_TEST_DURATION):
         pass
@@ -446,23 +526,300 @@ class TCPBTTest(TCPTest):
         self.receive_from_socket(receive_socket, 5)
 
 
+class TCPTraceTest(TCPTest):
+    # Replays a recorded flow (a traces.Trace): the sender plays the forward direction and the receiver the reverse
+    # one, each from the buffer of its direction, repeating the schedule until the sender stops after the test
+    # duration and closes its side of the connection. The forward direction follows the recorded pacing or, at full
+    # speed, streams its buffer back to back. The reverse one always follows the recorded pacing.
+    def __init__(self, trace, full_speed=False):
+        TCPTest.__init__(self, len(trace.forward.data))
+        self.trace = trace
+        self.full_speed = full_speed
+        self.forward = self.compile_schedule(trace.forward)
+        self.reverse = self.compile_schedule(trace.reverse)
+        self.forward_view = memoryview(trace.forward.data)
+        pauses = [b - a for a, b in zip(trace.forward.times[:-1], trace.forward.times[1:])]
+        self.idle_timeout = TRACE_IDLE_TIMEOUT + max(pauses + [trace.period - trace.forward.times[-1]])
+
+    @staticmethod
+    def compile_schedule(direction):
+        # Send times and slices of the buffer of a direction
+        view = memoryview(direction.data)
+        chunks = []
+        offset = 0
+        for length in direction.lengths:
+            chunks.append(view[offset:offset + length])
+            offset += length
+        return direction.times, chunks
+
+    def replay(self, test_socket, schedule, full_speed, stop=None, intervals=None):
+        # Sends the schedule until stop, or until the peer closes the connection if stop is None, receiving the bytes
+        # of the peer meanwhile. Returns True if the peer closed the connection.
+        times, chunks = schedule
+        test_socket.setblocking(0)
+        buffer = bytearray(TRACE_RECEIVE_BUFFER)
+        start = last_receive = time.time()
+        index = 0
+        iteration = 0
+        offset = 0
+        pending = None
+        while True:
+            now = time.time()
+            if stop is not None and now >= stop:
+                return False
+            if intervals is not None and now - last_receive > self.idle_timeout:
+                raise socket.timeout("No data from the sender")
+            timeout = self.idle_timeout
+            if pending is None:
+                if full_speed:
+                    pending = self.forward_view[offset:offset + TRACE_FULL_SPEED_CHUNK]
+                    offset = (offset + len(pending)) % len(self.forward_view)
+                elif chunks:
+                    due = start + iteration * self.trace.period + times[index]
+                    if due <= now:
+                        pending = chunks[index]
+                        index += 1
+                        if index == len(chunks):
+                            index = 0
+                            iteration += 1
+                    else:
+                        timeout = due - now
+            if stop is not None:
+                timeout = min(timeout, stop - now)
+            readable, writable, _ = select.select([test_socket], [] if pending is None else [test_socket], [],
+                                                  timeout)
+            try:
+                if readable:
+                    n = test_socket.recv_into(buffer)
+                    if n == 0:
+                        return True
+                    last_receive = time.time()
+                    if intervals is not None:
+                        intervals[last_receive] = n
+                if writable:
+                    sent = test_socket.send(pending)
+                    pending = pending[sent:] if sent < len(pending) else None
+            except socket.error as e:
+                if e.errno != errno.EAGAIN and e.errno != errno.EINTR:
+                    raise
+
+    def uplink_test(self, send_socket, duration=DEFAULT_TEST_DURATION):
+        start = time.time()
+        if not self.replay(send_socket, self.forward, self.full_speed, start + duration):
+            # the receiver closes the connection once it has all the bytes
+            send_socket.shutdown(socket.SHUT_WR)
+            send_socket.settimeout(TRACE_IDLE_TIMEOUT)
+            try:
+                while send_socket.recv(TRACE_RECEIVE_BUFFER):
+                    pass
+            except socket.timeout:
+                logger.warning("Receiver did not close the connection")
+        send_socket.settimeout(None)
+        logger.info("Replayed the trace for %f s" % (time.time() - start))
+
+    def downlink_test(self, receive_socket, intervals):
+        start = time.time()
+        intervals[start] = 0
+        self.replay(receive_socket, self.reverse, False, intervals=intervals)
+        receive_socket.settimeout(None)
+        interval = time.time() - start
+        received = sum(intervals.values())
+        logger.info("Received: %i, Interval: %f, Throughput: %f" % (received, interval, received / interval))
+        return intervals
+
+    def uplink_traceroute(self, send_socket, icmp_socket, traceroute, stop_interfaces):
+        pass
+
+    def downlink_traceroute(self, receive_socket):
+        pass
+
+
 class UDPTest(Test):
+    # Random payload datagrams sent at a constant rate (Mbps) for the duration of the test, in batches. Every
+    # datagram starts with its kind, its sequence number and its send time. Both ends send hellos until they hear from
+    # the other one, which also opens the NATs in front of the client: the sender starts at the first datagram of the
+    # receiver, the receiver stops sending hellos at the first data datagram. The sender ends with copies of a fin
+    # carrying the number of data datagrams sent. The receiver keeps the datagram statistics of its last test in
+    # statistics, they are stored next to the samples.
+    def __init__(self, rate=DEFAULT_UDP_RATE, datagram_size=DEFAULT_UDP_DATAGRAM_SIZE):
+        Test.__init__(self, datagram_size)
+        self.rate = rate
+        self.statistics = None
+        self.random_bytes = os.urandom(datagram_size * 1000)
+        self.offset = 0
+
+    def fill_random(self, data, start, end):
+        length = end - start
+        if self.offset + length > len(self.random_bytes):
+            self.offset = 0
+        data[start:end] = self.random_bytes[self.offset:self.offset + length]
+        self.offset += length
+
+    def pack_datagram(self, data, offset, kind, sequence, timestamp):
+        # Writes a datagram at offset of data, returns its length
+        UDP_TEST_HEADER.pack_into(data, offset, kind, sequence, timestamp)
+        if kind != DATAGRAM_DATA:
+            return UDP_TEST_HEADER.size
+        self.fill_random(data, offset + UDP_TEST_HEADER.size, offset + self.transfer_dimension)
+        return self.transfer_dimension
+
+    def unpack_datagram(self, data, offset, length):
+        # (kind, sequence, send time) of a datagram, None if it is not a datagram of the test
+        if length < UDP_TEST_HEADER.size:
+            return None
+        kind, sequence, timestamp = UDP_TEST_HEADER.unpack_from(data, offset)
+        if kind not in [DATAGRAM_HELLO, DATAGRAM_DATA, DATAGRAM_FIN]:
+            return None
+        return kind, sequence, timestamp
+
     def send_on_socket(self, send_socket, data):
-        pass
+        send_socket.send(data)
 
     def receive_from_socket(self, receive_socket, length):
-        pass
+        return receive_socket.recv(length)
 
-    def uplink_test(self):
-        pass
+    def send_control_datagram(self, batch, send_socket, kind, sequence):
+        batch.lengths[0] = self.pack_datagram(batch.data, 0, kind, sequence, time.time())
+        batch.send(send_socket, 1, UDP_IDLE_TIMEOUT)
 
-    def downlink_test(self):
-        pass
+    def wait_receiver(self, send_socket, batch):
+        start = next_hello = time.time()
+        while True:
+            now = time.time()
+            if now - start > UDP_HANDSHAKE_TIMEOUT:
+                raise socket.timeout("No datagram from the receiver")
+            if now >= next_hello:
+                self.send_control_datagram(batch, send_socket, DATAGRAM_HELLO, 0)
+                next_hello = now + UDP_HELLO_INTERVAL
+            try:
+                n = batch.receive(send_socket, next_hello - now)
+            except socket.timeout:
+                continue
+            for i in range(n):
+                if self.unpack_datagram(batch.data, batch.offset(i), batch.lengths[i]) is not None:
+                    return
+
+    def uplink_test(self, send_socket, duration=DEFAULT_TEST_DURATION):
+        send_socket.setblocking(0)
+        batch = datagrams.DatagramBatch(datagram_size=self.transfer_dimension)
+        self.wait_receiver(send_socket, batch)
+        datagrams_per_second = self.rate * 1e6 / 8 / self.transfer_dimension
+        sent = 0
+        start = time.time()
+        while True:
+            now = time.time()
+            elapsed = now - start
+            if elapsed >= duration:
+                break
+            due = min(int(elapsed * datagrams_per_second) + 1 - sent, batch.size)
+            if due <= 0:
+                time.sleep(min(sent / datagrams_per_second - elapsed, duration - elapsed))
+                continue
+            for i in range(due):
+                batch.lengths[i] = self.pack_datagram(batch.data, batch.offset(i), DATAGRAM_DATA, sent + i, now)
+            batch.send(send_socket, due, UDP_IDLE_TIMEOUT)
+            sent += due
+        for i in range(UDP_FIN_COPIES):
+            try:
+                self.send_control_datagram(batch, send_socket, DATAGRAM_FIN, sent)
+            except socket.error as e:
+                # the receiver closed its socket on one of the previous copies
+                if e.errno != errno.ECONNREFUSED:
+                    raise
+                break
+            time.sleep(UDP_FIN_INTERVAL)
+        interval = time.time() - start
+        logger.info("Sent: %i datagrams, Interval: %f, Throughput: %f" % (sent, interval,
+                                                                         sent * self.transfer_dimension / interval))
 
+    def downlink_test(self, receive_socket, intervals):
+        self.statistics = None
+        receive_socket.setblocking(0)
+        batch = datagrams.DatagramBatch(datagram_size=datagrams.MAX_DATAGRAM_SIZE)
+        received_log = datagrams.DatagramLog()
+        sent_count = None
+        start = next_hello = time.time()
+        intervals[start] = 0
+        while sent_count is None:
+            now = time.time()
+            if len(received_log) == 0:
+                if now - start > UDP_HANDSHAKE_TIMEOUT:
+                    raise socket.timeout("No datagram from the sender")
+                if now >= next_hello:
+                    self.send_control_datagram(batch, receive_socket, DATAGRAM_HELLO, 0)
+                    next_hello = now + UDP_HELLO_INTERVAL
+                timeout = next_hello - now
+            else:
+                timeout = UDP_IDLE_TIMEOUT
+            try:
+                n = batch.receive(receive_socket, timeout)
+            except socket.timeout:
+                if len(received_log) == 0:
+                    continue
+                logger.info("Timeout occurred, measurement finished without fin")
+                break
+            arrival = time.time()
+            received = 0
+            for i in range(n):
+                datagram = self.unpack_datagram(batch.data, batch.offset(i), batch.lengths[i])
+                if datagram is None:
+                    continue
+                kind, sequence, timestamp = datagram
+                if kind == DATAGRAM_DATA:
+                    received_log.append(sequence, timestamp, arrival, batch.lengths[i])
+                    received += batch.lengths[i]
+                elif kind == DATAGRAM_FIN:
+                    sent_count = sequence
+            if received > 0:
+                intervals[arrival] = intervals.get(arrival, 0) + received
+        self.statistics = received_log.statistics(sent_count, start)
+        totals = self.statistics["totals"]
+        interval = time.time() - start
+        logger.info("Received: %i of %i datagrams, Lost: %i, Reordered: %i, Interval: %f, Throughput: %f" %
+                    (totals["received"], totals["sent"], totals["lost"], totals["reordered"], interval,
+                     received_log.bytes / interval))
+        return intervals
 
-class UDPBTTest(UDPTest):
-    def uplink_test(self):
-        pass
+    def uplink_traceroute(self, send_socket, icmp_socket, traceroute, stop_interfaces):
+        return traceroute
 
-    def downlink_test(self):
+    def downlink_traceroute(self, receive_socket):
         pass
+
+
+class UDPBTTest(UDPTest):
+    # uTP (BEP 29) datagrams: hellos are ST_SYN packets, data are ST_DATA packets carrying a BitTorrent piece message,
+    # whose index is the sequence number and whose block starts with the send time, and fins are ST_FIN packets
+    # whose window is the number of data datagrams sent
+    def __init__(self, rate=DEFAULT_UDP_RATE, datagram_size=DEFAULT_UDP_DATAGRAM_SIZE):
+        UDPTest.__init__(self, rate, datagram_size)
+        self.connection_id = random.getrandbits(16)
+
+    def pack_datagram(self, data, offset, kind, sequence, timestamp):
+        packet_type = {DATAGRAM_HELLO: UTP_ST_SYN, DATAGRAM_DATA: UTP_ST_DATA, DATAGRAM_FIN: UTP_ST_FIN}[kind]
+        window = sequence if kind == DATAGRAM_FIN else UTP_WINDOW
+        UTP_HEADER.pack_into(data, offset, packet_type << 4 | UTP_VERSION, 0, self.connection_id,
+                             int(timestamp * 1e6) & 0xffffffff, 0, window, sequence & 0xffff, 0)
+        if kind != DATAGRAM_DATA:
+            return UTP_HEADER.size
+        block = self.transfer_dimension - UTP_HEADER.size - UTP_PIECE_HEADER.size
+        UTP_PIECE_HEADER.pack_into(data, offset + UTP_HEADER.size, BITTORRENT_RESPONSE_LENGTH + block,
+                                   BITTORRENT_PIECE_TYPE, sequence, 0, timestamp)
+        self.fill_random(data, offset + UTP_HEADER.size + UTP_PIECE_HEADER.size, offset + self.transfer_dimension)
+        return self.transfer_dimension
+
+    def unpack_datagram(self, data, offset, length):
+        if length < UTP_HEADER.size:
+            return None
+        header = UTP_HEADER.unpack_from(data, offset)
+        if header[0] & 0xf != UTP_VERSION:
+            return None
+        packet_type = header[0] >> 4
+        if packet_type == UTP_ST_SYN:
+            return DATAGRAM_HELLO, header[6], 0
+        if packet_type == UTP_ST_FIN:
+            return DATAGRAM_FIN, header[5], 0
+        if packet_type != UTP_ST_DATA or length < UTP_HEADER.size + UTP_PIECE_HEADER.size:
+            return None
+        piece = UTP_PIECE_HEADER.unpack_from(data, offset + UTP_HEADER.size)
+        return DATAGRAM_DATA, piece[2], piece[4]
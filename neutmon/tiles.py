@@ -0,0 +1,268 @@
+#!/usr/bin/python
+
+import cPickle
+import math
+import os
+import tempfile
+import numpy as np
+import analysis
+import batchstats
+
+# Quadkey tiles of the Web Mercator projection, level 16 tiles are about 600 m wide at the equator
+DEFAULT_TILE_LEVEL = 16
+MAX_TILE_LEVEL = 30
+MAX_LATITUDE = 85.05112878
+TILES_STATE_FORMAT = 2
+# Per tile BT/CT verdicts are computed only when both tests have at least this many bins in the tile
+MIN_VERDICT_BINS = 10
+
+# Throughput aggregates of a tile: the statistics then the counts of the bins of a log-spaced histogram (Mbps),
+# with an underflow and an overflow bin, used for the quantiles of merged tiles
+TILE_STATISTICS = ["count", "sum", "sum_squares", "min", "max"]
+HISTOGRAM_EDGES = np.logspace(-3, 5, 161)
+AGGREGATE_SIZE = len(TILE_STATISTICS) + len(HISTOGRAM_EDGES) + 1
+
+TILE_COLUMNS = ["quadkey", "latitude", "longitude", "direction", "test", "bins", "mean", "std", "min", "max",
+                "median", "diff", "same"]
+
+
+def tile_xy(latitude, longitude, level):
+    latitude = np.radians(np.clip(np.asarray(latitude, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    longitude = np.asarray(longitude, dtype=np.float64)
+    scale = 1 << level
+    x = np.floor((longitude + 180) / 360 * scale)
+    y = np.floor((1 - np.log(np.tan(latitude) + 1 / np.cos(latitude)) / math.pi) / 2 * scale)
+    return np.clip(x, 0, scale - 1).astype(np.int64), np.clip(y, 0, scale - 1).astype(np.int64)
+
+
+def tile_keys(latitude, longitude, level=DEFAULT_TILE_LEVEL):
+    # Quadkeys as integers, two bits per level with the x bit first, so the key of the parent tile is key >> 2
+    x, y = tile_xy(latitude, longitude, level)
+    keys = np.zeros(len(x), dtype=np.int64)
+    for bit in range(level):
+        keys |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+    return keys
+
+
+def key_xy(keys, level):
+    keys = np.asarray(keys, dtype=np.int64)
+    x = np.zeros(len(keys), dtype=np.int64)
+    y = np.zeros(len(keys), dtype=np.int64)
+    for bit in range(level):
+        x |= ((keys >> (2 * bit)) & 1) << bit
+        y |= ((keys >> (2 * bit + 1)) & 1) << bit
+    return x, y
+
+
+def tile_centers(keys, level):
+    x, y = key_xy(keys, level)
+    scale = float(1 << level)
+    longitude = (x + 0.5) / scale * 360 - 180
+    latitude = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * (y + 0.5) / scale))))
+    return latitude, longitude
+
+
+def quadkey_string(key, level):
+    return "".join(str((key >> (2 * bit)) & 3) for bit in range(level - 1, -1, -1))
+
+
+def quadkey_value(quadkey):
+    key = 0
+    for digit in quadkey:
+        key = key << 2 | int(digit)
+    return key
+
+
+def new_tiles_state(level=DEFAULT_TILE_LEVEL, min_interval=0, significance=0.05,
+                    max_age=analysis.DEFAULT_METADATA_MAX_AGE):
+    # Per tile throughput aggregates, keyed by (tile, direction, test), and counts of the DIFF and SAME BT/CT
+    # verdicts of the tiles of every level, keyed by (level, tile, direction), of all the files in "files", with
+    # the mtime and size they were read with, and the same of each file in "contributions". Verdicts compare the
+    # bins of a single file.
+    if level > MAX_TILE_LEVEL:
+        raise ValueError("Tile level %i greater than %i" % (level, MAX_TILE_LEVEL))
+    return {"format": TILES_STATE_FORMAT, "level": level, "min_interval": min_interval,
+            "significance": significance, "max_age": max_age, "files": dict(), "contributions": dict(),
+            "throughput": dict(), "verdicts": dict()}
+
+
+def load_tiles_state(file_name, level=DEFAULT_TILE_LEVEL, min_interval=0, significance=0.05,
+                     max_age=analysis.DEFAULT_METADATA_MAX_AGE):
+    try:
+        with open(file_name, "rb") as f:
+            state = cPickle.load(f)
+    except IOError as ioe:
+        if ioe.errno != 2:
+            raise ioe
+        return new_tiles_state(level, min_interval, significance, max_age)
+    if state.get("format") != TILES_STATE_FORMAT:
+        raise ValueError("%s: unsupported tiles state format" % file_name)
+    return state
+
+
+def save_tiles_state(state, file_name):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)))
+    with os.fdopen(fd, "wb") as f:
+        cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, file_name)
+
+
+def tiles_state_contains(state, file_name):
+    file_stat = os.stat(file_name)
+    return state["files"].get(os.path.abspath(file_name)) == (file_stat.st_mtime, file_stat.st_size)
+
+
+def tile_aggregates(tile_ids, throughput, tiles_count):
+    aggregates = np.zeros((tiles_count, AGGREGATE_SIZE))
+    aggregates[:, 0] = np.bincount(tile_ids, minlength=tiles_count)
+    aggregates[:, 1] = np.bincount(tile_ids, weights=throughput, minlength=tiles_count)
+    aggregates[:, 2] = np.bincount(tile_ids, weights=throughput * throughput, minlength=tiles_count)
+    aggregates[:, 3] = np.inf
+    aggregates[:, 4] = -np.inf
+    np.minimum.at(aggregates[:, 3], tile_ids, throughput)
+    np.maximum.at(aggregates[:, 4], tile_ids, throughput)
+    bins = np.searchsorted(HISTOGRAM_EDGES, throughput, side="right")
+    histogram_size = len(HISTOGRAM_EDGES) + 1
+    aggregates[:, len(TILE_STATISTICS):] = np.bincount(tile_ids * histogram_size + bins,
+                                                       minlength=tiles_count * histogram_size).reshape(tiles_count, -1)
+    return aggregates
+
+
+def merge_aggregate(aggregates, key, aggregate):
+    current = aggregates.get(key)
+    if current is None:
+        aggregates[key] = aggregate.copy()
+        return
+    current[3] = min(current[3], aggregate[3])
+    current[4] = max(current[4], aggregate[4])
+    current[:3] += aggregate[:3]
+    current[len(TILE_STATISTICS):] += aggregate[len(TILE_STATISTICS):]
+
+
+def update_tiles_state(state, file_name, parsed, results_index):
+    # Adds to the state the throughput bins of a result located by the GPS fix joined with them. A file read again
+    # replaces its previous contribution, the tiles of both are rebuilt from the contributions of all the files.
+    file_stat = os.stat(file_name)
+    path = os.path.abspath(file_name)
+    state["files"][path] = (file_stat.st_mtime, file_stat.st_size)
+    contribution = tiles_contribution(state, parsed, results_index)
+    previous = state["contributions"].get(path)
+    state["contributions"][path] = contribution
+    for field in ["throughput", "verdicts"]:
+        if previous is None:
+            for key, value in contribution[field].items():
+                if field == "throughput":
+                    merge_aggregate(state[field], key, value)
+                else:
+                    state[field][key] = state[field].get(key, 0) + value
+            continue
+        for key in set(previous[field]) | set(contribution[field]):
+            values = [c[field][key] for c in state["contributions"].values() if key in c[field]]
+            state[field].pop(key, None)
+            for value in values:
+                if field == "throughput":
+                    merge_aggregate(state[field], key, value)
+                else:
+                    state[field][key] = state[field].get(key, 0) + value
+
+
+def tiles_contribution(state, parsed, results_index):
+    # Throughput aggregates and verdict counts of a single file
+    contribution = {"throughput": dict(), "verdicts": dict()}
+    if results_index is None or "gps" not in parsed:
+        return contribution
+    joined = analysis.join_metadata(parsed, results_index, state["min_interval"], max_age=state["max_age"])
+    located = ~np.isnan(joined["latitude"])
+    keys = tile_keys(joined["latitude"][located], joined["longitude"][located], state["level"])
+    tiles, tile_ids = np.unique(keys, return_inverse=True)
+    directions = joined["direction"][located]
+    tests = joined["test"][located]
+    throughput = joined["throughput"][located]
+    bt_ct = dict()
+    for direction, test in sorted(set(zip(directions, tests))):
+        in_test = (directions == direction) & (tests == test)
+        aggregates = tile_aggregates(tile_ids[in_test], throughput[in_test], len(tiles))
+        for i in np.flatnonzero(aggregates[:, 0]):
+            contribution["throughput"][int(tiles[i]), direction, test] = aggregates[i].copy()
+        if test in ["bt", "ct"]:
+            bt_ct[direction, test] = (tile_ids[in_test], throughput[in_test])
+    # one BT/CT comparison for each tile of each level with enough bins of both, corrected within the file
+    labels = []
+    pairs = []
+    for direction in ["uplink", "downlink"]:
+        if (direction, "bt") not in bt_ct or (direction, "ct") not in bt_ct:
+            continue
+        bt_ids, bt_x = bt_ct[direction, "bt"]
+        ct_ids, ct_x = bt_ct[direction, "ct"]
+        for level in range(state["level"] + 1):
+            level_tiles, level_ids = np.unique(tiles >> (2 * (state["level"] - level)), return_inverse=True)
+            bt_level_ids = level_ids[bt_ids]
+            ct_level_ids = level_ids[ct_ids]
+            enough = (np.bincount(bt_level_ids, minlength=len(level_tiles)) >= MIN_VERDICT_BINS) & \
+                     (np.bincount(ct_level_ids, minlength=len(level_tiles)) >= MIN_VERDICT_BINS)
+            for i in np.flatnonzero(enough):
+                labels.append((level, int(level_tiles[i]), direction))
+                pairs.append((bt_x[bt_level_ids == i], ct_x[ct_level_ids == i]))
+    if len(pairs) == 0:
+        return contribution
+    for row in batchstats.compare_pairs(pairs, labels, state["significance"], resamples=0):
+        counts = contribution["verdicts"].setdefault(row[0], np.zeros(2, dtype=np.int64))
+        counts[0 if row[-1] == "DIFF" else 1] += 1
+    return contribution
+
+
+def histogram_median(histogram):
+    position = np.searchsorted(np.cumsum(histogram), histogram.sum() / 2.0)
+    if position == 0:
+        return HISTOGRAM_EDGES[0]
+    if position == len(HISTOGRAM_EDGES):
+        return HISTOGRAM_EDGES[-1]
+    return math.sqrt(HISTOGRAM_EDGES[position - 1] * HISTOGRAM_EDGES[position])
+
+
+def query_tiles(state, level=None, bounds=None, quadkey=None):
+    # Rows of TILE_COLUMNS of the tiles of the given level (at most the level of the state), merged from the
+    # aggregates of the state, within bounds (south, west, north, east) and inside the quadkey tile if given
+    if level is None:
+        level = state["level"]
+    if level > state["level"]:
+        raise ValueError("Tile level %i greater than the state level %i" % (level, state["level"]))
+    if quadkey is not None and len(quadkey) > level:
+        raise ValueError("Quadkey %s finer than the tile level %i" % (quadkey, level))
+    shift = 2 * (state["level"] - level)
+    throughput = dict()
+    for (key, direction, test), aggregate in state["throughput"].items():
+        merge_aggregate(throughput, (key >> shift, direction, test), aggregate)
+    keys = sorted(throughput)
+    tiles = np.array([key for key, direction, test in keys], dtype=np.int64)
+    if bounds is not None and len(tiles) > 0:
+        south, west, north, east = bounds
+        min_x, min_y = tile_xy([north], [west], level)
+        max_x, max_y = tile_xy([south], [east], level)
+        x, y = key_xy(tiles, level)
+        inside = (x >= min_x[0]) & (x <= max_x[0]) & (y >= min_y[0]) & (y <= max_y[0])
+        keys = [keys[i] for i in np.flatnonzero(inside)]
+        tiles = tiles[inside]
+    if quadkey is not None:
+        inside = tiles >> (2 * (level - len(quadkey))) == quadkey_value(quadkey)
+        keys = [keys[i] for i in np.flatnonzero(inside)]
+        tiles = tiles[inside]
+    latitudes, longitudes = tile_centers(tiles, level)
+    rows = []
+    for (key, direction, test), latitude, longitude in zip(keys, latitudes, longitudes):
+        aggregate = throughput[key, direction, test]
+        count = aggregate[0]
+        mean = aggregate[1] / count
+        std = math.sqrt(max(aggregate[2] / count - mean * mean, 0))
+        diff, same = state["verdicts"].get((level, key, direction), (0, 0))
+        rows.append([quadkey_string(key, level), latitude, longitude, direction, test, int(count), mean, std,
+                     aggregate[3], aggregate[4], histogram_median(aggregate[len(TILE_STATISTICS):]), int(diff),
+                     int(same)])
+    return rows
+
+
+def write_tiles(file_name, rows):
+    with open(file_name, "w") as f:
+        f.write("\t".join(TILE_COLUMNS) + "\n")
+        for row in rows:
+            f.write("\t".join(batchstats.format_column(column) for column in row) + "\n")
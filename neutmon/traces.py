@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+import collections
+import hashlib
+from scapy.error import Scapy_Exception
+from scapy.layers.inet import IP, TCP
+from scapy.utils import PcapReader
+
+DEFAULT_TRACE_MAX_BYTES = 64 * 1024 * 1024  # Bytes, payload kept for each direction of a flow
+SEQUENCE_MODULO = 2 ** 32
+MIN_TRACE_PERIOD = 0.001  # seconds
+
+
+class TraceDirection(object):
+    # Payload of a direction of a flow in one buffer, sent in segments of the given lengths at the given times
+    # (seconds from the first packet of the flow)
+    def __init__(self, data, times, lengths):
+        self.data = data
+        self.times = times
+        self.lengths = lengths
+
+
+class Trace(object):
+    # The forward direction of a flow is the one carrying more payload, replayed by the sender of a test. The
+    # schedule of both directions repeats every period seconds.
+    def __init__(self, forward, reverse, period, endpoints):
+        self.forward = forward
+        self.reverse = reverse
+        self.period = period
+        self.endpoints = endpoints
+        self.__digest = None
+
+    def digest(self):
+        # Identifies the replayed schedules, the server and the client check that they replay the same flow
+        if self.__digest is None:
+            sha = hashlib.sha1()
+            for direction in [self.forward, self.reverse]:
+                sha.update("%i\0" % len(direction.data))
+                sha.update(direction.data)
+                sha.update(repr((direction.times, direction.lengths)))
+            sha.update(repr(self.period))
+            self.__digest = sha.hexdigest()
+        return self.__digest
+
+
+def tcp_payload(packet):
+    # Payload of a TCP segment, without the link layer padding of short frames
+    ip = packet[IP]
+    tcp = packet[TCP]
+    if ip.len == 0:
+        # segmentation offload, the total length is left to the interface
+        return str(tcp.payload)
+    length = ip.len - ip.ihl * 4 - tcp.dataofs * 4
+    if length <= 0:
+        return ""
+    return str(tcp.payload)[:length]
+
+
+def tcp_packets(file_name):
+    try:
+        reader = PcapReader(file_name)
+    except Scapy_Exception as se:
+        raise ValueError("%s: %s" % (file_name, se))
+    try:
+        for packet in reader:
+            if IP in packet and TCP in packet:
+                yield packet
+    finally:
+        reader.close()
+
+
+def flow_key(packet):
+    source = (packet[IP].src, packet[TCP].sport)
+    destination = (packet[IP].dst, packet[TCP].dport)
+    return (source, destination) if source < destination else (destination, source)
+
+
+def select_flow(file_name, port=None):
+    # Key of the flow with the most payload, among the ones with the given port if any
+    payload = collections.Counter()
+    for packet in tcp_packets(file_name):
+        if port is not None and port not in [packet[TCP].sport, packet[TCP].dport]:
+            continue
+        payload[flow_key(packet)] += len(tcp_payload(packet))
+    if not payload or payload.most_common(1)[0][1] == 0:
+        raise ValueError("No TCP flow with payload in %s" % file_name)
+    return payload.most_common(1)[0][0]
+
+
+def load_pcap_flow(file_name, port=None, max_bytes=DEFAULT_TRACE_MAX_BYTES):
+    # Trace of a TCP flow of a capture. Retransmitted bytes are dropped using the sequence numbers, bytes missing
+    # from the capture are skipped.
+    key = select_flow(file_name, port)
+    start = None
+    # per source: segments, payload length, next sequence number
+    segments = {key[0]: [], key[1]: []}
+    sizes = {key[0]: 0, key[1]: 0}
+    next_sequence = dict()
+    for packet in tcp_packets(file_name):
+        if flow_key(packet) != key:
+            continue
+        if start is None:
+            start = float(packet.time)
+        source = (packet[IP].src, packet[TCP].sport)
+        payload = tcp_payload(packet)
+        length = len(payload)
+        sequence = packet[TCP].seq
+        if packet[TCP].flags & 0x02:
+            # the SYN takes a sequence number
+            next_sequence[source] = (sequence + 1) % SEQUENCE_MODULO
+            continue
+        if length == 0 or sizes[source] >= max_bytes:
+            continue
+        if source in next_sequence:
+            old = (next_sequence[source] - sequence) % SEQUENCE_MODULO
+            if old >= length and old < SEQUENCE_MODULO / 2:
+                continue
+            if old < SEQUENCE_MODULO / 2:
+                payload = payload[old:]
+        next_sequence[source] = (sequence + length) % SEQUENCE_MODULO
+        payload = payload[:max_bytes - sizes[source]]
+        segments[source].append((float(packet.time) - start, payload))
+        sizes[source] += len(payload)
+    forward, reverse = sorted(key, key=lambda source: sizes[source], reverse=True)
+    directions = []
+    for source in [forward, reverse]:
+        directions.append(TraceDirection("".join(payload for t, payload in segments[source]),
+                                         [t for t, payload in segments[source]],
+                                         [len(payload) for t, payload in segments[source]]))
+    times = sorted(directions[0].times + directions[1].times)
+    gaps = sorted(b - a for a, b in zip(times[:-1], times[1:]))
+    # a gap as long as the median one separates the repetitions of the schedule
+    period = max(times[-1] + (gaps[len(gaps) // 2] if gaps else 0), MIN_TRACE_PERIOD)
+    return Trace(directions[0], directions[1], period, (forward, reverse))
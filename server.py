@@ -1,18 +1,34 @@
 #!/usr/bin/python
 
 import argparse
+import contextlib
+import fcntl
+import glob
 import json
 import logging
+import multiprocessing
+import os
+import Queue
+import signal
 import sys
+import tempfile
+import threading
 import time
 import traceback
 import uuid
 
 from neutmon import handlers
+from neutmon import sweep
 from neutmon import test
+from neutmon import traces
 
+# Spooled sessions received before the output file of the session is written
+SPOOLED_FILE = "spooled-%s.json"
+SPOOL_LOCK_FILE = "spooled.lock"
+UDP_TESTS = ["udp_bt", "udp_ct"]
 
-def init_current_test(port, three_way_test=False, third_port=0):
+
+def init_current_test(port, three_way_test=False, third_port=0, udp=False):
     current_test = dict()
     current_test["port"] = port
     current_test["finished"] = False
@@ -26,59 +42,312 @@ def init_current_test(port, three_way_test=False, third_port=0):
         current_test["uplink"]["third"] = dict()
         current_test["downlink"]["third"] = dict()
         current_test["third_port"] = third_port
+    if udp:
+        for direction in ["uplink", "downlink"]:
+            current_test[direction]["udp_bt"] = dict()
+            current_test[direction]["udp_ct"] = dict()
+        current_test["udp_port"] = handlers.UDP_PORT
     return current_test
 
 
+def command_phase(command):
+    # Server phase of a start command and where its results are stored
+    if command in [handlers.CONTROLLER_START_UB_MSG, handlers.CONTROLLER_START_UC_MSG,
+                   handlers.CONTROLLER_START_UT_MSG, handlers.CONTROLLER_START_UUB_MSG,
+                   handlers.CONTROLLER_START_UUC_MSG]:
+        phase = handlers.TEST_DOWNLINK_PHASE
+        phase_index = "uplink"
+    else:
+        phase = handlers.TEST_UPLINK_PHASE
+        phase_index = "downlink"
+    if command == handlers.CONTROLLER_START_UB_MSG or command == handlers.CONTROLLER_START_DB_MSG:
+        test_index = "bt"
+    elif command == handlers.CONTROLLER_START_UC_MSG or command == handlers.CONTROLLER_START_DC_MSG:
+        test_index = "ct"
+    elif command == handlers.CONTROLLER_START_UUB_MSG or command == handlers.CONTROLLER_START_UDB_MSG:
+        test_index = "udp_bt"
+    elif command == handlers.CONTROLLER_START_UUC_MSG or command == handlers.CONTROLLER_START_UDC_MSG:
+        test_index = "udp_ct"
+    else:
+        test_index = "third"
+    return phase, phase_index, test_index
+
+
+def store_client_result(current_test, phase, phase_index, test_index, extra):
+    if phase == handlers.TEST_UPLINK_PHASE and test_index in UDP_TESTS:
+        # samples and datagram statistics of the UDP receiver
+        current_test[phase_index][test_index]["speedtest"] = extra.get("speedtest")
+        current_test[phase_index][test_index]["udp"] = extra.get("udp")
+    elif phase == handlers.TEST_UPLINK_PHASE:
+        current_test[phase_index][test_index]["speedtest"] = extra
+    elif phase == handlers.TEST_DOWNLINK_PHASE:
+        current_test[phase_index][test_index]["traceroute"] = extra
+
+
+def recv_client_status(controller, deadline, phases, logger):
+    # In pipelined sessions results of previous phases can precede the status of the current one
+    while True:
+        resp, extra = controller.recv_control_msg(deadline)
+        if resp != handlers.CONTROLLER_RESULT_MSG:
+            return resp, extra
+        key = (extra.get("command"), extra.get("port"))
+        if key not in phases:
+            logger.warning("C: Discarding upload for unknown phase %s port %s" % key)
+            continue
+        logger.info("C: Received uploaded result for phase %i port %i" % key)
+        current_test, phase, phase_index, test_index = phases[key]
+        store_client_result(current_test, phase, phase_index, test_index, extra.get("result"))
+
+
+def write_json_file(file_name, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)))
+    with os.fdopen(fd, "w") as f:
+        f.write(json.dumps(data, indent=4))
+    os.rename(temp_path, file_name)
+
+
+@contextlib.contextmanager
+def spool_lock():
+    # Held by every worker while it writes an output file or merges a spooled session, so a session spooled while it
+    # is still running is either found by run_session or merged in its output file
+    with open(SPOOL_LOCK_FILE, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def merge_spooled_session(spooled, logger):
+    # Stores the client results of a previous session, spooled by the client, in the output file of that session.
+    # Results already in the file are kept, so uploads of the same session can be repeated. Returns the reason of the
+    # rejection of the session, None if it is stored.
+    # The session id is a random uuid4 known only to the server and to the client that ran the session, it
+    # authenticates the upload: after a reconnection or on another interface the client address is a different one.
+    session = spooled.get("session", "")
+    try:
+        valid = str(uuid.UUID(session)) == session
+    except (ValueError, TypeError, AttributeError):
+        valid = False
+    if not valid:
+        logger.warning("C: Rejecting spooled session with invalid id %s" % session)
+        return "Invalid session id %s" % session
+    with spool_lock():
+        output_files = glob.glob("output-*-%s.json" % session)
+        if not output_files:
+            # The session may still be running, its output is merged with this file when written
+            logger.warning("C: No output file of spooled session %s, storing it apart" % session)
+            write_json_file(SPOOLED_FILE % session, spooled)
+            return None
+        with open(output_files[0], "r") as f:
+            result = json.load(f)
+        merge_spooled_results(output_files[0], result, spooled, logger)
+    return None
+
+
+def merge_spooled_results(output_file, result, spooled, logger):
+    merged = 0
+    for entry in spooled.get("phases", []):
+        if entry.get("command") not in handlers.START_MESSAGES:
+            continue
+        phase, phase_index, test_index = command_phase(entry["command"])
+        if entry["command"] in handlers.UDP_START_MESSAGES:
+            # UDP phases run after the TCP ones, in the last result
+            tests = [t for t in result["results"] if t.get("udp_port") == entry.get("port")]
+        else:
+            tests = [t for t in result["results"] if t["port"] == entry.get("port") or
+                     test_index == "third" and t.get("third_port") == entry.get("port")]
+        if not tests or test_index not in tests[-1][phase_index]:
+            continue
+        current_test = tests[-1]
+        if "client_status" not in current_test[phase_index][test_index]:
+            current_test[phase_index][test_index]["client_status"] = entry.get("status")
+            merged += 1
+        field = "speedtest" if phase == handlers.TEST_UPLINK_PHASE else "traceroute"
+        if entry.get("result") is not None and field not in current_test[phase_index][test_index]:
+            store_client_result(current_test, phase, phase_index, test_index, entry["result"])
+            merged += 1
+    if spooled.get("meta_data") is not None and not result["meta_data"].get("client_meta"):
+        result["meta_data"]["client_meta"] = spooled["meta_data"]
+        merged += 1
+    if merged > 0:
+        result["meta_data"].setdefault("recovered", []).append(time.time())
+        write_json_file(output_file, result)
+    logger.info("C: Spooled session %s, %i results merged" % (spooled["session"], merged))
+
+
+def receive_spooled_sessions(controller, client, deadline, logger):
+    logger.info("C: Sending session id")
+    controller.send_control_msg(handlers.CONTROLLER_SESSION_MSG, client.id)
+    while True:
+        resp, extra = controller.recv_control_msg(deadline)
+        if resp == handlers.CONTROLLER_OK_MSG:
+            return
+        if resp != handlers.CONTROLLER_SPOOL_MSG:
+            raise handlers.ControllerException("Received message %i instead of a spooled session" % resp)
+        rejection = merge_spooled_session(extra, logger)
+        if rejection is None:
+            controller.send_control_msg(handlers.CONTROLLER_SPOOL_ACK_MSG, extra["session"])
+        else:
+            controller.send_control_msg(handlers.CONTROLLER_SPOOL_REJECT_MSG, rejection)
+
+
+def agree_trace(controller, trace, meta_data, deadline, logger):
+    # Sends the digest of the trace of the third test, returns True if the client replays the same one
+    logger.info("C: Sending trace digest %s" % trace.digest())
+    controller.send_control_msg(handlers.CONTROLLER_TRACE_MSG, trace.digest())
+    resp, extra = controller.recv_control_msg(deadline)
+    if resp != handlers.CONTROLLER_OK_MSG:
+        raise handlers.ControllerException("Received message %i instead of the trace digest of the client" % resp)
+    client_digest = (extra or dict()).get("trace")
+    meta_data["trace"] = {"digest": trace.digest(), "client_digest": client_digest,
+                          "replayed": client_digest == trace.digest()}
+    if not meta_data["trace"]["replayed"]:
+        logger.warning("C: Client trace %s is not the one of the server, skipping the third test" % client_digest)
+    return meta_data["trace"]["replayed"]
+
+
+def sweep_burst(pool, tester, phase, address, deadline, duration, entry, logger):
+    result = dict()
+    watchdog = handlers.Watchdog(deadline, tester.close_test_connection)
+    try:
+        tester.accept_test_connection(deadline, address)
+        tester.do_test(test.TCPBTTest(), phase, handlers.TEST_SPEEDTEST_TYPE, result, [], duration)
+        entry["server_status"] = handlers.TESTER_OK
+    except handlers.TesterException as te:
+        logger.info("C: Sweep burst on port %i failed: %s %i" % (tester.port, te.message, te.error))
+        entry["server_status"] = te.error
+    finally:
+        watchdog.cancel()
+        tester.close_test_connection()
+        pool.checkin(tester)
+    if phase == handlers.TEST_DOWNLINK_PHASE:
+        entry["speedtest"] = result
+
+
+def run_sweep(controller, client, pool, port_sweep, duration, phase_timeout, session_deadline, phases, sweeps,
+              logger):
+    # Batches of bursts until all the ports are swept or the blocked and unblocked ports are separated. The receiver
+    # of the bursts keeps their samples: the server in uplink, the client in downlink.
+    if port_sweep.direction == "uplink":
+        command = handlers.CONTROLLER_START_USWEEP_MSG
+        phase = handlers.TEST_DOWNLINK_PHASE
+    else:
+        command = handlers.CONTROLLER_START_DSWEEP_MSG
+        phase = handlers.TEST_UPLINK_PHASE
+    while True:
+        ports = port_sweep.next_batch()
+        if ports is None:
+            break
+        logger.info("C: Sweeping %s ports %s" % (port_sweep.direction, ",".join(str(port) for port in ports)))
+        phase_deadline = handlers.Deadline("phase", phase_timeout + duration, session_deadline)
+        entries = dict((str(port), dict()) for port in ports)
+        # Listeners are bound before the client is told to connect
+        testers = []
+        for port in ports:
+            try:
+                testers.append(pool.checkout(port))
+            except handlers.TesterException as te:
+                logger.info("C: Sweep burst on port %i failed: %s %i" % (port, te.message, te.error))
+                entries[str(port)]["server_status"] = te.error
+        controller.send_control_msg(command, ports)
+        threads = [threading.Thread(target=sweep_burst, args=(pool, tester, phase, client.address[0], phase_deadline,
+                                                              duration, entries[str(tester.port)], logger))
+                   for tester in testers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        resp, extra = recv_client_status(controller, phase_deadline, phases, logger)
+        for port, entry in entries.items():
+            client_entry = (extra or dict()).get(port, dict())
+            entry["client_status"] = client_entry.get("status", resp)
+            if phase == handlers.TEST_UPLINK_PHASE:
+                entry["speedtest"] = client_entry.get("speedtest", dict())
+        port_sweep.record(entries)
+        sweeps[port_sweep.direction] = port_sweep.report()
+        blocked, unblocked, errors = port_sweep.class_counts()
+        logger.info("C: Sweep %s, %i blocked, %i unblocked and %i failed ports" % (port_sweep.direction, blocked,
+                                                                                   unblocked, errors))
+    sweeps[port_sweep.direction] = port_sweep.report()
+
+
 class Client(object):
     def __init__(self, control_socket, address, cid):
         self.control_socket = control_socket
         self.address = address
         self.id = cid
+        self.arrival = time.time()
 
     def close_connection(self):
         self.control_socket.close()
 
 
-def client_handler(client, meta_data, results, error, logger, three_way_test=False, duration=0):
+def client_handler(client, meta_data, results, error, logger, three_way_test=False, duration=0,
+                   session_timeout=handlers.DEFAULT_SESSION_DEADLINE, phase_timeout=handlers.DEFAULT_PHASE_DEADLINE,
+                   heartbeat_timeout=handlers.DEFAULT_HEARTBEAT_TIMEOUT, pipelined=False, pool=None,
+                   spool_uploads=False, udp=False, udp_rate=test.DEFAULT_UDP_RATE, sweep_options=None, sweeps=None,
+                   third_test=None, bt_test=None, ct_test=None):
     # Uplink and downlink are referred to client. Uplink here is downlink for server and vice versa.
     logger.info("C: Initializing controller")
-    controller = handlers.Controller(client.control_socket)
-    bt_test = test.TCPBTTest()
-    ct_test = test.TCPRandomTest()
+    controller = handlers.Controller(client.control_socket, heartbeat_timeout=heartbeat_timeout)
+    session_deadline = handlers.Deadline("session", session_timeout)
+    tests = {"bt": test.TCPBTTest() if bt_test is None else bt_test,
+             "ct": test.TCPRandomTest() if ct_test is None else ct_test}
+    tests["third"] = tests["ct"] if third_test is None else third_test
+    if udp:
+        tests["udp_bt"] = test.UDPBTTest(udp_rate)
+        tests["udp_ct"] = test.UDPTest(udp_rate)
     port = handlers.BT_PORT
-    current_test = init_current_test(port, three_way_test, handlers.TT_PORT)
+    current_test = init_current_test(port, three_way_test, handlers.TT_PORT, udp)
     results.append(current_test)
+    # (command, port) -> where the client result of the phase is stored
+    phases = dict()
+    # Without a server wide pool, listeners live as long as the session
+    if pool is None:
+        session_pool = handlers.TesterPool()
+    else:
+        session_pool = pool
+    tester = None
     try:
-        tester = handlers.Tester(port)
-        command = handlers.CONTROLLER_START_UB_MSG
+        tester = session_pool.checkout(port)
+        if spool_uploads:
+            receive_spooled_sessions(controller, client, session_deadline, logger)
+        if three_way_test and isinstance(tests["third"], test.TCPTraceTest) and \
+                not agree_trace(controller, tests["third"].trace, meta_data, session_deadline, logger):
+            three_way_test = False
+            current_test = init_current_test(port, three_way_test, handlers.TT_PORT, udp)
+            results[-1] = current_test
+        if pipelined:
+            logger.info("C: Sending control message pipeline")
+            controller.send_control_msg(handlers.CONTROLLER_PIPELINE_MSG)
+        commands = range(handlers.CONTROLLER_START_UB_MSG, handlers.CONTROLLER_START_DC_MSG + 1)
         if three_way_test:
-            last_command = handlers.CONTROLLER_START_DT_MSG
-        else:
-            last_command = handlers.CONTROLLER_START_DC_MSG
-        while command in range(handlers.CONTROLLER_START_UB_MSG, last_command + 1):
+            commands += [handlers.CONTROLLER_START_UT_MSG, handlers.CONTROLLER_START_DT_MSG]
+        if udp:
+            commands += handlers.UDP_START_MESSAGES
+        position = 0
+        while position < len(commands):
+            command = commands[position]
             logger.info("C: Trying phase %i with port %i" % (command, port))
-            if command == handlers.CONTROLLER_START_UB_MSG or command == handlers.CONTROLLER_START_UC_MSG or\
-               command == handlers.CONTROLLER_START_UT_MSG:
-                phase = handlers.TEST_DOWNLINK_PHASE
-                phase_index = "uplink"
-            else:
-                phase = handlers.TEST_UPLINK_PHASE
-                phase_index = "downlink"
-            if command == handlers.CONTROLLER_START_UB_MSG or command == handlers.CONTROLLER_START_DB_MSG:
-                test_var = bt_test
-                test_index = "bt"
-            elif command == handlers.CONTROLLER_START_UC_MSG or command == handlers.CONTROLLER_START_DC_MSG:
-                test_var = ct_test
-                test_index = "ct"
-            else:
-                test_var = ct_test
-                test_index = "third"
+            phase, phase_index, test_index = command_phase(command)
+            test_var = tests[test_index]
+            phases[(command, port)] = (current_test, phase, phase_index, test_index)
+            phase_deadline = handlers.Deadline("phase", phase_timeout + duration, session_deadline)
             logger.info("C: Sending control message %i port %i" % (command, port))
             controller.send_control_msg(command, port)
+            # A stalled client must not keep the test port busy beyond the phase deadline
+            watchdog = handlers.Watchdog(phase_deadline, tester.close_test_connection)
+            client_status = None
             try:
                 logger.info("C: Doing test")
                 result = dict()
-                tester.accept_test_connection()
+                tester.accept_test_connection(phase_deadline, client.address[0])
+                if pipelined:
+                    # Uploads of the previous phases must not share the link with the measured transfer
+                    logger.info("C: Waiting for pending result uploads")
+                    client_status = recv_client_status(controller, phase_deadline, phases, logger)
+                    if client_status[0] != handlers.CONTROLLER_PIPELINE_MSG:
+                        raise handlers.TesterException(handlers.TESTER_TEST_GENERIC_ERROR,
+                                                       "Client status %i before the test" % client_status[0], None)
+                    client_status = None
                 for test_type in [handlers.TEST_SPEEDTEST_TYPE, handlers.TEST_TRACEROUTE_TYPE]:
                     logger.info("C: Starting %i test, phase %s %s" % (test_type, test_index, phase_index))
                     tester.do_test(test_var, phase, test_type, result, [], duration)
@@ -86,7 +355,8 @@ def client_handler(client, meta_data, results, error, logger, three_way_test=Fal
                     if phase == handlers.TEST_UPLINK_PHASE and test_type == handlers.TEST_SPEEDTEST_TYPE:
                         logger.info("C: Sleeping")
                         time.sleep(10)
-                    if command == handlers.CONTROLLER_START_UT_MSG or command == handlers.CONTROLLER_START_DT_MSG:
+                    if command == handlers.CONTROLLER_START_UT_MSG or command == handlers.CONTROLLER_START_DT_MSG or\
+                            command in handlers.UDP_START_MESSAGES:
                         break
                 logger.info("C: Closing test connection")
                 tester.close_test_connection()
@@ -97,47 +367,70 @@ def client_handler(client, meta_data, results, error, logger, three_way_test=Fal
                 else:
                     logger.error("C: Error in test on port %i: %s %i" % (port, te.message, te.errno))
                 tester.close_test_connection()
+                # The watchdog closed the test connection, the phase is over
+                if phase_deadline.expired():
+                    raise handlers.DeadlineException(phase_deadline.name)
+            finally:
+                watchdog.cancel()
             if phase == handlers.TEST_DOWNLINK_PHASE:
                 current_test[phase_index][test_index]["speedtest"] = result
+                if test_index in UDP_TESTS:
+                    current_test[phase_index][test_index]["udp"] = test_var.statistics
             elif phase == handlers.TEST_UPLINK_PHASE:
                 current_test[phase_index][test_index]["traceroute"] = result
+            if pipelined:
+                # Bind the port the next phase may switch to while the client is still finishing
+                if command == handlers.CONTROLLER_START_UB_MSG and port == handlers.BT_PORT:
+                    session_pool.bind(handlers.ALT_BT_PORT)
+                elif command == handlers.CONTROLLER_START_DC_MSG and three_way_test:
+                    session_pool.bind(current_test["third_port"])
+                elif position + 1 < len(commands) and commands[position + 1] == handlers.CONTROLLER_START_UUB_MSG:
+                    session_pool.bind(handlers.UDP_PORT, datagram=True)
             logger.info("C: Receiving status and result from client")
-            resp, extra = controller.recv_control_msg()
+            if client_status is None:
+                resp, extra = recv_client_status(controller, phase_deadline, phases, logger)
+            else:
+                resp, extra = client_status
             logger.info("C: Client status is %i" % resp)
             current_test[phase_index][test_index]["client_status"] = resp
             if extra is not None:
                 logger.info("C: client result is not empty")
-                if phase == handlers.TEST_UPLINK_PHASE:
-                    current_test[phase_index][test_index]["speedtest"] = extra
-                elif phase == handlers.TEST_DOWNLINK_PHASE:
-                    current_test[phase_index][test_index]["traceroute"] = extra
-            if resp != handlers.CONTROLLER_OK_MSG:
-                if command == handlers.CONTROLLER_START_UB_MSG and port == handlers.BT_PORT:
-                    tester.finish_test()
-                    port = handlers.ALT_BT_PORT
-                    current_test = init_current_test(port, three_way_test, handlers.TT_PORT)
-                    results.append(current_test)
-                    logger.info("C: First port failed, trying uplink BitTorrent with port %i" % port)
-                    tester = handlers.Tester(port)
-                else:
-                    command += 1
-                    if command == handlers.CONTROLLER_START_UT_MSG and three_way_test:
-                        tester.finish_test()
-                        port = current_test["third_port"]
-                        tester = handlers.Tester(port)
+                store_client_result(current_test, phase, phase_index, test_index, extra)
+            if resp != handlers.CONTROLLER_OK_MSG and command == handlers.CONTROLLER_START_UB_MSG and \
+                    port == handlers.BT_PORT:
+                session_pool.checkin(tester)
+                port = handlers.ALT_BT_PORT
+                current_test = init_current_test(port, three_way_test, handlers.TT_PORT, udp)
+                results.append(current_test)
+                logger.info("C: First port failed, trying uplink BitTorrent with port %i" % port)
+                tester = session_pool.checkout(port)
             else:
-                command += 1
-                if command == handlers.CONTROLLER_START_UT_MSG and three_way_test:
-                    tester.finish_test()
+                position += 1
+                next_command = commands[position] if position < len(commands) else None
+                if next_command == handlers.CONTROLLER_START_UT_MSG:
+                    session_pool.checkin(tester)
                     port = current_test["third_port"]
-                    tester = handlers.Tester(port)
+                    tester = session_pool.checkout(port)
+                elif next_command == handlers.CONTROLLER_START_UUB_MSG:
+                    session_pool.checkin(tester)
+                    port = handlers.UDP_PORT
+                    tester = session_pool.checkout(port, datagram=True)
         current_test["finished"] = True
         logger.info("C: Finishing test and closing test connection")
-        tester.finish_test()
+        session_pool.checkin(tester)
+        tester = None
+        if sweep_options is not None:
+            if sweeps is None:
+                sweeps = dict()
+            for direction in sweep_options["directions"]:
+                port_sweep = sweep.PortSweep(sweep_options["ports"], direction, sweep_options["reference"],
+                                             sweep_options["concurrency"], sweep_options["min_class_ports"])
+                run_sweep(controller, client, session_pool, port_sweep, sweep_options["burst"], phase_timeout,
+                          session_deadline, phases, sweeps, logger)
         logger.info("C: Sending control message send meta data")
         controller.send_control_msg(handlers.CONTROLLER_SEND_META_DATA_MSG)
         logger.info("C: Receiving status and result from client")
-        resp, extra = controller.recv_control_msg()
+        resp, extra = recv_client_status(controller, session_deadline, phases, logger)
         if resp == handlers.CONTROLLER_OK_MSG and extra is not None:
             meta_data["client_meta"] = extra
         else:
@@ -147,15 +440,21 @@ def client_handler(client, meta_data, results, error, logger, three_way_test=Fal
     except handlers.ControllerException as ce:
         logger.error("C: Error in controller: %s" % ce.message)
         error["message"] = ce.message
-        tester.finish_test()
+        if isinstance(ce, handlers.DeadlineException):
+            error["deadline"] = ce.deadline
+        if tester is not None:
+            session_pool.checkin(tester)
         try:
             controller.abort_measure()
         except handlers.ControllerException:
             pass
     except handlers.TesterException as te:
-        logger.error("C: Error in tester: %s %i %i" % (te.message, te.error, te.errno))
+        logger.error("C: Error in tester: %s %i %s" % (te.message, te.error, te.errno))
         error["message"] = te.error
-        tester.finish_test()
+        if session_deadline.expired():
+            error["deadline"] = session_deadline.name
+        if tester is not None:
+            session_pool.checkin(tester)
         try:
             controller.abort_measure()
         except handlers.ControllerException:
@@ -164,26 +463,256 @@ def client_handler(client, meta_data, results, error, logger, three_way_test=Fal
         error["message"] = "%s: %s" % (type(e).__name__, e.message)
         logger.error("C: Unexpected error %s %s %s" % (type(e).__name__, e.message, e.args))
         logger.error(traceback.format_exc())
-        tester.finish_test()
+        if tester is not None:
+            session_pool.checkin(tester)
         try:
             controller.abort_measure()
         except handlers.ControllerException:
             pass
     finally:
+        if pool is None:
+            session_pool.close()
         client.close_connection()
 
 
+def run_session(client, pool, logger, three_way_test, duration, args, stats_queue=None, worker=0):
+    meta_data = dict()
+    error = dict()
+    results = []
+    sweeps = dict()
+    meta_data["client_id"] = client.id
+    meta_data["client_ip"] = client.address
+    meta_data["arrival"] = client.arrival
+    meta_data["start"] = time.time()
+    logger.info("P: Passing client connection to handler")
+    client_handler(client, meta_data, results, error, logger, three_way_test, duration, args.session_deadline,
+                   args.phase_deadline, args.heartbeat_timeout, args.pipelined, pool, args.spool_uploads, args.udp,
+                   args.udp_rate, sweep_options(args), sweeps,
+                   None if args.trace is None else test.TCPTraceTest(args.trace, args.trace_full_speed))
+    meta_data["stop"] = time.time()
+    result = dict()
+    result["meta_data"] = meta_data
+    result["results"] = results
+    if sweeps:
+        result["sweep"] = sweeps
+    if error:
+        result["error"] = error
+    logger.info("P: Writing results on file")
+    output_file = "output-" + str(int(time.time())) + "-" + client.id + ".json"
+    with spool_lock():
+        write_json_file(output_file, result)
+        if os.path.exists(SPOOLED_FILE % client.id):
+            logger.info("P: Merging results spooled by the client during the session")
+            with open(SPOOLED_FILE % client.id, "r") as f:
+                merge_spooled_results(output_file, result, json.load(f), logger)
+            os.remove(SPOOLED_FILE % client.id)
+    if stats_queue is not None:
+        stats_queue.put((worker, bool(error), meta_data["stop"] - meta_data["start"]))
+
+
+def sweep_options(args):
+    if args.sweep is None:
+        return None
+    return {"ports": args.sweep, "reference": args.sweep_reference, "concurrency": args.sweep_concurrency,
+            "burst": args.sweep_burst, "min_class_ports": args.sweep_min_class,
+            "directions": sweep.SWEEP_DIRECTIONS if args.sweep_direction == "both" else [args.sweep_direction]}
+
+
+def serve(listener, pool, logger, three_way_test, duration, args, stats_queue=None, worker=0, reservations=None):
+    admission = handlers.AdmissionController(
+        lambda c: run_session(c, pool, logger, three_way_test, duration, args, stats_queue, worker),
+        args.queue_size, args.max_wait, args.max_bandwidth, args.session_bandwidth, reservations=reservations,
+        worker=worker)
+    while True:
+        logger.info("P: Accepting incoming connection")
+        client_socket, address = listener.accept_connection()
+        client_socket.settimeout(30)
+        client = Client(client_socket, address, str(uuid.uuid4()))
+        logger.info("P: Submitting client %s to admission control" % address[0])
+        admission.submit(client)
+
+
+def worker_main(worker, listener, pool, logger, three_way_test, duration, args, stats_queue, reservations):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    logger.info("P: Worker %i started" % worker)
+    try:
+        serve(listener, pool, logger, three_way_test, duration, args, stats_queue, worker, reservations)
+    except KeyboardInterrupt:
+        pass
+
+
+def write_stats(stats_file, stats):
+    total = {"sessions": 0, "failed_sessions": 0, "session_time": 0.0, "restarts": 0}
+    for worker_stats in stats.values():
+        for key in total:
+            total[key] += worker_stats[key]
+    with open(stats_file, "w") as f:
+        f.write(json.dumps({"total": total, "workers": stats}, indent=4))
+
+
+def supervise(workers_number, stats_file, logger, three_way_test, duration, args):
+    # Every worker gets its own listener on the shared ports. The supervisor creates them all, in order, before forking
+    # and keeps them open, so socket i is always the i-th member of each SO_REUSEPORT group and a client address is
+    # steered to the same worker for the control and for every test connection.
+    listeners = []
+    pools = []
+    for i in range(workers_number):
+        listeners.append(handlers.Listener(True, args.bind_address))
+        pool = handlers.TesterPool(True, args.bind_address)
+        for port in [handlers.BT_PORT, handlers.ALT_BT_PORT, handlers.TT_PORT]:
+            pool.bind(port)
+        if args.udp:
+            pool.bind(handlers.UDP_PORT, datagram=True)
+        if args.sweep is not None:
+            for port in [args.sweep_reference] + args.sweep:
+                try:
+                    pool.bind(port)
+                except handlers.TesterException as te:
+                    # the bursts on the port fail and it is reported as an error
+                    logger.error("P: Cannot bind sweep port %i: %s" % (port, te.message))
+        pools.append(pool)
+    listeners[0].pin_by_source_address(workers_number)
+    pools[0].pin_by_source_address(workers_number)
+    stats_queue = multiprocessing.Queue()
+    # The bandwidth cap is shared by the sessions of all the workers
+    reservations = handlers.BandwidthReservations(args.max_bandwidth, workers_number)
+    stats = dict()
+    workers = dict()
+    # Workers are stopped in the finally clause below also when the supervisor is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    for i in range(workers_number):
+        stats[i] = {"sessions": 0, "failed_sessions": 0, "session_time": 0.0, "restarts": 0}
+    try:
+        while True:
+            for i in range(workers_number):
+                if i in workers and workers[i].is_alive():
+                    continue
+                if i in workers:
+                    logger.error("P: Worker %i exited with code %s, restarting" % (i, workers[i].exitcode))
+                    stats[i]["restarts"] += 1
+                    write_stats(stats_file, stats)
+                    reservations.reset(i)
+                workers[i] = multiprocessing.Process(target=worker_main, args=(i, listeners[i], pools[i], logger,
+                                                                               three_way_test, duration, args,
+                                                                               stats_queue, reservations))
+                workers[i].daemon = True
+                workers[i].start()
+            try:
+                worker, failed, session_time = stats_queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            stats[worker]["sessions"] += 1
+            if failed:
+                stats[worker]["failed_sessions"] += 1
+            stats[worker]["session_time"] += session_time
+            write_stats(stats_file, stats)
+    finally:
+        for worker in workers.values():
+            worker.terminate()
+        for i in range(workers_number):
+            pools[i].close()
+            listeners[i].close_socket()
+
+
 def main(argv):
     parser = argparse.ArgumentParser(description="NeutMon client. Performs speed and traceroute tests to check if "
                                                  "ISPs are differentiating traffic.")
     parser.add_argument("-d", "--duration", help="specify speedtest duration (in seconds)", type=int)
     parser.add_argument("-t", "--three_way_test", help="enable three way testing", action="store_true")
+    parser.add_argument("-D", "--session_deadline", type=int, default=handlers.DEFAULT_SESSION_DEADLINE,
+                        help="maximum duration of a whole session (in seconds). the default value is %i"
+                             % handlers.DEFAULT_SESSION_DEADLINE)
+    parser.add_argument("-P", "--phase_deadline", type=int, default=handlers.DEFAULT_PHASE_DEADLINE,
+                        help="maximum duration of a single phase (in seconds), speedtest duration excluded. the "
+                             "default value is %i" % handlers.DEFAULT_PHASE_DEADLINE)
+    parser.add_argument("-b", "--heartbeat_timeout", type=int, default=handlers.DEFAULT_HEARTBEAT_TIMEOUT,
+                        help="control channel silence (in seconds) after which a client sending heartbeats is "
+                             "considered dead. 0 disables it. the default value is %i"
+                             % handlers.DEFAULT_HEARTBEAT_TIMEOUT)
     parser.add_argument("-l", "--log", help="set the logging level. possible values are DEBUG, INFO, WARNING, ERROR,"
                                             "and CRITICAL. if not specified the default value is WARNING")
     parser.add_argument("-g", "--logfile", help="set the output file for logs. the default value is neutmon_server.log")
+    parser.add_argument("-x", "--pipelined", help="upload results of a phase while the next one is set up",
+                        action="store_true")
+    parser.add_argument("-u", "--spool_uploads", action="store_true",
+                        help="send the session id to clients and store the results they spooled in previous sessions")
+    parser.add_argument("-q", "--queue_size", type=int, default=handlers.DEFAULT_ADMISSION_QUEUE_SIZE,
+                        help="number of clients waiting for admission, further clients are told when to retry. the "
+                             "default value is %i" % handlers.DEFAULT_ADMISSION_QUEUE_SIZE)
+    parser.add_argument("-W", "--max_wait", type=int, default=handlers.DEFAULT_ADMISSION_MAX_WAIT,
+                        help="maximum time (in seconds) a client waits for admission. the default value is %i"
+                             % handlers.DEFAULT_ADMISSION_MAX_WAIT)
+    parser.add_argument("-B", "--max_bandwidth", type=int, default=0,
+                        help="cap on the total bandwidth (in Mbps) of concurrent sessions, shared by all the "
+                             "workers. if not specified sessions of a worker run one at a time")
+    parser.add_argument("-S", "--session_bandwidth", type=int, default=handlers.DEFAULT_SESSION_BANDWIDTH,
+                        help="bandwidth (in Mbps) reserved for each session against the cap, whatever the session "
+                             "uses. the default value is %i" % handlers.DEFAULT_SESSION_BANDWIDTH)
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes sharing the server ports. sessions of a client address are "
+                             "always served by the same worker. the default value is 1")
+    parser.add_argument("-s", "--stats", default="neutmon_server_stats.json",
+                        help="output file for statistics of workers. the default value is neutmon_server_stats.json")
+    parser.add_argument("-U", "--udp", action="store_true",
+                        help="run the UDP phases, uTP BitTorrent and control, after the TCP ones")
+    parser.add_argument("--udp_rate", type=float, default=test.DEFAULT_UDP_RATE,
+                        help="sending rate (in Mbps) of the downlink UDP phases. the default value is %i"
+                             % test.DEFAULT_UDP_RATE)
+    parser.add_argument("-p", "--sweep", metavar="PORTS",
+                        help="sweep the comma separated ports and port ranges (like 6881-6889,51413) with short BT "
+                             "bursts after the other phases, to map port based policies")
+    parser.add_argument("--sweep_reference", type=int, default=sweep.DEFAULT_SWEEP_REFERENCE_PORT,
+                        help="port of the reference burst of every batch of the sweep. the default value is %i"
+                             % sweep.DEFAULT_SWEEP_REFERENCE_PORT)
+    parser.add_argument("--sweep_concurrency", type=int, default=sweep.DEFAULT_SWEEP_CONCURRENCY,
+                        help="bursts at the same time, the reference one included. the default value is %i"
+                             % sweep.DEFAULT_SWEEP_CONCURRENCY)
+    parser.add_argument("--sweep_burst", type=int, default=sweep.DEFAULT_SWEEP_BURST,
+                        help="duration (in seconds) of the downlink bursts of the sweep. the default value is %i"
+                             % sweep.DEFAULT_SWEEP_BURST)
+    parser.add_argument("--sweep_min_class", type=int, default=sweep.DEFAULT_SWEEP_MIN_CLASS_PORTS,
+                        help="stop the sweep once this many ports are blocked and this many are not. 0 sweeps all "
+                             "the ports. the default value is %i" % sweep.DEFAULT_SWEEP_MIN_CLASS_PORTS)
+    parser.add_argument("--sweep_direction", choices=sweep.SWEEP_DIRECTIONS + ["both"], default="both",
+                        help="direction of the sweep bursts. the default value is both")
+    parser.add_argument("-T", "--trace", metavar="PCAP",
+                        help="replay a TCP flow of a capture, by default the one with the most payload, as the third "
+                             "test of the three way testing, which it enables. the third test is skipped with the "
+                             "clients that do not replay the same flow")
+    parser.add_argument("--trace_port", type=int, help="replay the flow with the most payload on this port")
+    parser.add_argument("--trace_full_speed", action="store_true",
+                        help="send the downlink trace replays back to back instead of with the recorded pacing")
+    parser.add_argument("-a", "--bind_address", default=handlers.SERVER_BINDING_ADDRESS,
+                        help="address of the control, test and HTTP listeners. the default value is %s"
+                             % handlers.SERVER_BINDING_ADDRESS)
+    parser.add_argument("-H", "--http", action="store_true",
+                        help="serve the http test of the clients, a random object on every path")
+    parser.add_argument("--http_port", type=int, default=handlers.HTTP_PORT,
+                        help="port of the http test. the default value is %i" % handlers.HTTP_PORT)
+    parser.add_argument("-z", "--http_size", type=int, default=handlers.DEFAULT_HTTP_OBJECT_SIZE,
+                        help="size (in bytes) of the http test object. the default value is %i"
+                             % handlers.DEFAULT_HTTP_OBJECT_SIZE)
+    parser.add_argument("-Z", "--http_max_size", type=int, default=handlers.DEFAULT_HTTP_MAX_OBJECT_SIZE,
+                        help="maximum size (in bytes) of the http test object requested with the size query "
+                             "parameter. the default value is %i" % handlers.DEFAULT_HTTP_MAX_OBJECT_SIZE)
     parser.add_argument("-v", "--verbose", help="if set logs are also printed on the standard output",
                         action="store_true")
     args = parser.parse_args()
+    if args.max_bandwidth > 0 and not 0 < args.session_bandwidth <= args.max_bandwidth:
+        parser.error("the session bandwidth must be positive and not above the bandwidth cap")
+    if args.sweep is not None:
+        try:
+            args.sweep = sweep.parse_port_ranges(args.sweep)
+        except ValueError as ve:
+            parser.error(ve.message)
+        if args.sweep_concurrency < 2:
+            parser.error("the sweep concurrency must be at least 2")
+    if args.trace is not None:
+        try:
+            args.trace = traces.load_pcap_flow(args.trace, args.trace_port)
+        except (IOError, ValueError) as e:
+            parser.error("cannot load the trace: %s" % e)
+        args.three_way_test = True
     if args.log:
         if args.log == "DEBUG":
             log_level = logging.DEBUG
@@ -214,6 +743,8 @@ def main(argv):
         console_handler.setFormatter(log_formatter)
         logger.addHandler(console_handler)
     logger.info("Neutmon server started")
+    if args.trace is not None:
+        logger.info("P: Replaying trace %s in the third test" % args.trace.digest())
     if args.duration:
         duration = args.duration
     else:
@@ -222,32 +753,23 @@ def main(argv):
         three_way_test = True
     else:
         three_way_test = False
-    logger.info("P: Initializing listener")
-    listener = handlers.Listener()
-    while True:
-        logger.info("P: Accepting incoming connection")
-        client_socket, address = listener.accept_connection()
-        client_socket.settimeout(30)
-        client_id = str(uuid.uuid4())
-        client = Client(client_socket, address, client_id)
-        meta_data = dict()
-        error = dict()
-        results = []
-        meta_data["client_id"] = client_id
-        meta_data["client_ip"] = address
-        meta_data["start"] = time.time()
-        logger.info("P: Passing client connection to handler")
-        client_handler(client, meta_data, results, error, logger, three_way_test, duration)
-        meta_data["stop"] = time.time()
-        result = dict()
-        result["meta_data"] = meta_data
-        result["results"] = results
-        if error:
-            result["error"] = error
-        logger.info("P: Writing results on file")
-        with open("output-" + str(int(time.time())) + "-" + client_id + ".json", "w") as f:
-            f.write(json.dumps(result, indent=4))
-
+    http_responder = None
+    if args.http:
+        logger.info("P: Starting HTTP responder on port %i" % args.http_port)
+        http_responder = handlers.HTTPResponder(args.http_port, args.http_size, args.http_max_size, args.bind_address)
+        http_responder.start()
+    if args.workers > 1:
+        supervise(args.workers, args.stats, logger, three_way_test, duration, args)
+    else:
+        logger.info("P: Initializing listener")
+        listener = handlers.Listener(address=args.bind_address)
+        # Test listeners and ICMP sockets are kept open for the life of the server
+        pool = handlers.TesterPool(address=args.bind_address)
+        try:
+            serve(listener, pool, logger, three_way_test, duration, args)
+        finally:
+            pool.close()
+            listener.close_socket()
 
 if __name__ == "__main__":
     main(sys.argv)
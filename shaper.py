@@ -0,0 +1,274 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import Queue
+import sys
+import time
+
+import analyzer
+import benchmark
+from neutmon import analysis
+from neutmon import batchstats
+from neutmon import handlers
+from neutmon import shaper
+
+# The proxy and the server listen on the same ports of two loopback addresses
+DEFAULT_PROXY_ADDRESS = "127.0.0.2"
+DEFAULT_TARGET_ADDRESS = "127.0.0.1"
+DEFAULT_VALIDATION_DURATION = 5  # seconds
+DEFAULT_LINK_RATE = 40  # Mbps, bottleneck of every connection, so that unshaped classes get the same throughput
+DEFAULT_LINK_DELAY = 0.01  # seconds
+DEFAULT_SHAPED_RATE = 10  # Mbps
+DEFAULT_VALIDATION_INTERVAL = 0.1  # seconds, minimum interval of the throughput bins compared
+PROXY_SETUP_TIMEOUT = 10  # seconds
+COMPARISONS = ["btct", "bttt", "btht"]
+# Rules and expected verdicts of the analyzer. CT runs on the BT port: port based shaping slows it down as much as
+# BT and only the third test, on another port, and the HTTP test tell it apart.
+SCENARIOS = [("unshaped", [], {"btct": "SAME", "bttt": "SAME", "btht": "SAME"}),
+             ("bittorrent_signature", ["signature=bittorrent,rate=%(rate)s"],
+              {"btct": "DIFF", "bttt": "DIFF", "btht": "DIFF"}),
+             ("bittorrent_ports", ["ports=%i+%i,rate=%%(rate)s" % (handlers.BT_PORT, handlers.ALT_BT_PORT)],
+              {"btct": "SAME", "bttt": "DIFF", "btht": "DIFF"})]
+SCENARIO_NAMES = [name for name, rules, expected in SCENARIOS]
+
+
+def proxy_ports(http_port):
+    return [handlers.SERVER_PORT, handlers.BT_PORT, handlers.ALT_BT_PORT, handlers.TT_PORT, http_port]
+
+
+def run_proxy(proxy, ready, stop, results_queue):
+    # Proxy of a scenario, in its own process so that it does not compete with the client for the interpreter
+    try:
+        proxy.start()
+    except handlers.ListenerException as le:
+        results_queue.put({"error": le.message})
+        ready.set()
+        return
+    ready.set()
+    stop.wait()
+    proxy.stop()
+    results_queue.put({"statistics": proxy.statistics})
+
+
+def comparison_name(label):
+    # "<file>/uplink_btct" -> ("uplink", "btct")
+    direction, _, comparison = os.path.basename(label).partition("_")
+    return direction, comparison
+
+
+def comparison_speedtests(parsed, direction, comparison):
+    samples = [result for result in parsed["results"] if result["finished"]][0]["speedtests"]
+    if comparison == "btht":
+        other = parsed.get("http_test")
+    else:
+        other = samples.get((direction, "ct" if comparison == "btct" else "third"))
+    return samples[direction, "bt"], other
+
+
+def detection_time(first, second, min_interval, significance):
+    # Shortest time from the start of both tests after which the comparison of the bins received so far is always
+    # DIFF, None if the whole tests are not
+    bins = []
+    for speedtest in [first, second]:
+        start, end, throughput = analysis.throughput_bins(speedtest, min_interval)
+        if len(throughput) == 0:
+            return None
+        bins.append((end - start[0], throughput))
+    times = sorted(set(bins[0][0].tolist() + bins[1][0].tolist()))
+    pairs = [(bins[0][1][bins[0][0] <= t], bins[1][1][bins[1][0] <= t]) for t in times]
+    verdicts = [row[-1] for row in batchstats.compare_pairs(pairs, significance=significance, resamples=0,
+                                                            correction="none")]
+    if verdicts[-1] != "DIFF":
+        return None
+    detection = len(verdicts) - 1
+    while detection > 0 and verdicts[detection - 1] == "DIFF":
+        detection -= 1
+    return times[detection]
+
+
+def run_scenario(args, name, rules, expected, execution):
+    logger = logging.getLogger("neutmon")
+    proxy = shaper.ShapingProxy(args.proxy_address, args.target_address, proxy_ports(args.http_port), rules,
+                                args.link_rate, args.link_delay)
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    results_queue = multiprocessing.Queue()
+    proxy_process = multiprocessing.Process(target=run_proxy, args=(proxy, ready, stop, results_queue))
+    proxy_process.start()
+    session_args = argparse.Namespace(duration=args.duration, three_way_test=True, pipelined=False, traceroutes=False,
+                                      server_address=args.proxy_address, bind_address=args.target_address,
+                                      http_port=args.http_port, http_size=args.http_size)
+    try:
+        if not ready.wait(PROXY_SETUP_TIMEOUT):
+            raise RuntimeError("Proxy not ready after %i seconds" % PROXY_SETUP_TIMEOUT)
+        if not proxy_process.is_alive() or not results_queue.empty():
+            raise RuntimeError("Proxy failed: %s" % results_queue.get()["error"])
+        report, output, client_cpu = benchmark.loopback_session(session_args, execution)
+    finally:
+        stop.set()
+        try:
+            proxy_output = results_queue.get(timeout=PROXY_SETUP_TIMEOUT)
+        except Queue.Empty:
+            proxy_output = {"error": "No statistics from the proxy"}
+        proxy_process.join(PROXY_SETUP_TIMEOUT)
+        if proxy_process.is_alive():
+            proxy_process.terminate()
+    file_name = os.path.join(args.directory, "output-%s-%i.json" % (name, int(time.time())))
+    with open(file_name, "w") as f:
+        json.dump(output["result"], f, indent=4)
+    parsed = analysis.parse_result_file(file_name)
+    if "error" in parsed:
+        raise RuntimeError("Session failed: %s" % parsed["error"])
+    # the verdicts of the statistics table of the analyzer for this file
+    labelled_pairs = analyzer.comparison_pairs(file_name, args.interval, None)
+    table = batchstats.compare_pairs([pair for label, pair in labelled_pairs],
+                                     [label for label, pair in labelled_pairs], args.significance, resamples=0)
+    rows = []
+    for row in table:
+        direction, comparison = comparison_name(row[0])
+        first, second = comparison_speedtests(parsed, direction, comparison)
+        detection = detection_time(first, second, args.interval, args.significance)
+        rows.append({"direction": direction, "comparison": comparison, "median_bt": row[3], "median_other": row[4],
+                     "p_adjusted": row[-2], "verdict": row[-1], "expected": expected.get(comparison),
+                     "detection_time": detection if row[-1] == "DIFF" else None})
+        logger.info("S: %s %s %s: %s, expected %s" % (name, direction, comparison, row[-1],
+                                                      expected.get(comparison)))
+    return {"scenario": name, "rules": [rule.name for rule in rules], "file": file_name, "comparisons": rows,
+            "session_time": report["end"] - report["start"], "proxy": proxy_output}
+
+
+def parse_expected(spec):
+    # "btct=SAME,bttt=DIFF" -> {"btct": "SAME", "bttt": "DIFF"}
+    expected = dict()
+    for part in spec.split(","):
+        comparison, _, verdict = part.partition("=")
+        if comparison.strip() not in COMPARISONS or verdict.strip() not in ["DIFF", "SAME"]:
+            raise ValueError("Invalid expected verdict %s" % part)
+        expected[comparison.strip()] = verdict.strip()
+    return expected
+
+
+def print_results(results):
+    print "scenario\tdirection\tcomparison\tverdict\texpected\tresult\tdetection_time"
+    failed = 0
+    for result in results:
+        for row in result["comparisons"]:
+            if row["expected"] is None:
+                outcome = "-"
+            elif row["verdict"] == row["expected"]:
+                outcome = "PASS"
+            else:
+                outcome = "FAIL"
+                failed += 1
+            print "%s\t%s\t%s\t%s\t%s\t%s\t%s" % (result["scenario"], row["direction"], row["comparison"],
+                                                  row["verdict"], row["expected"] or "-", outcome,
+                                                  "-" if row["detection_time"] is None else
+                                                  "%.2f" % row["detection_time"])
+    return failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="NeutMon shaper. Runs sessions over loopback through a proxy "
+                                                 "shaping some classes of traffic, as a differentiating ISP would, "
+                                                 "and checks that the analyzer tells the shaped classes apart and "
+                                                 "how fast. With -P only runs the proxy.")
+    parser.add_argument("-s", "--scenario", action="append", choices=SCENARIO_NAMES,
+                        help="scenario to run, can be repeated. all of them by default")
+    parser.add_argument("-R", "--rule", action="append",
+                        help="shaping rule of a custom scenario, can be repeated. e.g. signature=bittorrent,rate=10 "
+                             "or ports=6881-6889+51413,delay=0.05,loss=0.01,direction=downlink. signatures are %s or "
+                             "hex:<bytes>" % ", ".join(sorted(shaper.SIGNATURES)))
+    parser.add_argument("-e", "--expect", default="",
+                        help="expected verdicts of the custom scenario, e.g. btct=SAME,bttt=DIFF,btht=DIFF")
+    parser.add_argument("-r", "--rate", type=float, default=DEFAULT_SHAPED_RATE,
+                        help="rate limit (Mbps) of the shaped classes of the scenarios. the default value is %i"
+                             % DEFAULT_SHAPED_RATE)
+    parser.add_argument("-L", "--link_rate", type=float, default=DEFAULT_LINK_RATE,
+                        help="rate limit (Mbps) of all the traffic, 0 for none. the default value is %i"
+                             % DEFAULT_LINK_RATE)
+    parser.add_argument("--link_delay", type=float, default=DEFAULT_LINK_DELAY,
+                        help="delay (s) of all the traffic. the default value is %r" % DEFAULT_LINK_DELAY)
+    parser.add_argument("-d", "--duration", type=int, default=DEFAULT_VALIDATION_DURATION,
+                        help="speedtest duration (in seconds). the default value is %i" % DEFAULT_VALIDATION_DURATION)
+    parser.add_argument("-i", "--interval", type=float, default=DEFAULT_VALIDATION_INTERVAL,
+                        help="minimum interval for throughput calculation. the default value is %r"
+                             % DEFAULT_VALIDATION_INTERVAL)
+    parser.add_argument("--significance", type=float, default=0.05, help="significance level of KS test")
+    parser.add_argument("-a", "--proxy_address", default=DEFAULT_PROXY_ADDRESS,
+                        help="address of the proxy, the client connects to it. the default value is %s"
+                             % DEFAULT_PROXY_ADDRESS)
+    parser.add_argument("-b", "--target_address", default=DEFAULT_TARGET_ADDRESS,
+                        help="address of the server behind the proxy. the default value is %s"
+                             % DEFAULT_TARGET_ADDRESS)
+    parser.add_argument("--http_port", type=int, default=benchmark.DEFAULT_BENCHMARK_HTTP_PORT,
+                        help="port of the HTTP test. the default value is %i" % benchmark.DEFAULT_BENCHMARK_HTTP_PORT)
+    parser.add_argument("-z", "--http_size", type=int, default=handlers.DEFAULT_HTTP_OBJECT_SIZE,
+                        help="size in bytes of the HTTP test object. the default value is %i"
+                             % handlers.DEFAULT_HTTP_OBJECT_SIZE)
+    parser.add_argument("-P", "--proxy_only", action="store_true",
+                        help="only run the proxy with the custom rules, between a server listening on the target "
+                             "address and clients connecting to the proxy address, until interrupted")
+    parser.add_argument("-D", "--directory", default=".", help="directory of the output files of the sessions")
+    parser.add_argument("-o", "--output", default="neutmon_shaping.json",
+                        help="output file of the verdicts and detection times. the default value is "
+                             "neutmon_shaping.json")
+    parser.add_argument("-l", "--log", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                        help="set the logging level. the default value is WARNING")
+    parser.add_argument("-g", "--logfile", default="neutmon_shaper.log",
+                        help="set the output file for logs. the default value is neutmon_shaper.log")
+    args = parser.parse_args(argv[1:])
+    try:
+        custom_rules = [shaper.parse_rule(spec) for spec in args.rule or []]
+        custom_expected = parse_expected(args.expect) if args.expect else dict()
+    except ValueError as ve:
+        parser.error(ve.message)
+    logger = logging.getLogger("neutmon")
+    logger.setLevel(getattr(logging, args.log))
+    file_handler = logging.FileHandler(args.logfile)
+    file_handler.setFormatter(logging.Formatter('[%(asctime)s] [%(name)s] [%(levelname)s] \t%(message)s'))
+    logger.addHandler(file_handler)
+    if args.proxy_only:
+        proxy = shaper.ShapingProxy(args.proxy_address, args.target_address, proxy_ports(args.http_port),
+                                    custom_rules, args.link_rate, args.link_delay)
+        try:
+            proxy.start()
+        except handlers.ListenerException as le:
+            parser.error(le.message)
+        print "Proxy listening on %s, interrupt to stop" % args.proxy_address
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            proxy.stop()
+        print json.dumps(proxy.statistics, indent=4)
+        return
+    scenarios = []
+    for name, specs, expected in SCENARIOS:
+        if args.scenario is None and not custom_rules or args.scenario is not None and name in args.scenario:
+            scenarios.append((name, [shaper.parse_rule(spec % {"rate": args.rate}) for spec in specs], expected))
+    if custom_rules:
+        scenarios.append(("custom", custom_rules, custom_expected))
+    results = []
+    errors = []
+    for execution, (name, rules, expected) in enumerate(scenarios):
+        try:
+            results.append(run_scenario(args, name, rules, expected, execution))
+        except (RuntimeError, handlers.ListenerException) as e:
+            logger.error("S: Scenario %s failed: %s" % (name, e))
+            errors.append({"scenario": name, "error": str(e)})
+            sys.stderr.write("Scenario %s failed: %s\n" % (name, e))
+    parameters = {"duration": args.duration, "rate": args.rate, "link_rate": args.link_rate,
+                  "link_delay": args.link_delay, "interval": args.interval, "significance": args.significance}
+    with open(args.output, "w") as f:
+        json.dump({"parameters": parameters, "scenarios": results, "errors": errors}, f, indent=4)
+    failed = print_results(results)
+    if failed or errors:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+
+import argparse
+import sys
+import time
+import numpy as np
+from neutmon import batchstats
+
+
+def random_pairs(pairs_number, min_size, max_size, random_state):
+    # Throughput-like samples with ties, the second sample of every other pair shifted
+    pairs = []
+    for i in range(pairs_number):
+        sizes = random_state.randint(min_size, max_size + 1, 2)
+        first = np.round(random_state.gamma(4, 5, sizes[0]), 1)
+        second = np.round(random_state.gamma(4, 5, sizes[1]) + (i % 2) * 2, 1)
+        pairs.append((first, second))
+    return pairs
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Times compare_pairs on random sample pairs")
+    parser.add_argument("-n", "--pairs", type=int, default=10000, help="number of pairs. the default value is 10000")
+    parser.add_argument("-m", "--min_size", type=int, default=50, help="minimum sample size. the default value is 50")
+    parser.add_argument("-M", "--max_size", type=int, default=400, help="maximum sample size. the default value is 400")
+    parser.add_argument("-r", "--resamples", type=int, default=batchstats.DEFAULT_RESAMPLES,
+                        help="bootstrap resamples. the default value is %i" % batchstats.DEFAULT_RESAMPLES)
+    parser.add_argument("-s", "--seed", type=int, default=0, help="random seed. the default value is 0")
+    args = parser.parse_args(argv[1:])
+    pairs = random_pairs(args.pairs, args.min_size, args.max_size, np.random.RandomState(args.seed))
+    start = time.time()
+    rows = batchstats.compare_pairs(pairs, resamples=0)
+    tests_time = time.time() - start
+    start = time.time()
+    rows = batchstats.compare_pairs(pairs, resamples=args.resamples, seed=args.seed)
+    total_time = time.time() - start
+    print "%i pairs of %i-%i samples" % (args.pairs, args.min_size, args.max_size)
+    print "tests and corrections: %.2f s" % tests_time
+    print "with %i bootstrap resamples: %.2f s" % (args.resamples, total_time)
+    print "DIFF verdicts: %i" % sum(row[-1] == "DIFF" for row in rows)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,20 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ResultFilesTestCase(unittest.TestCase):
+    # Empty output files in a temporary directory, the incremental states only read their mtime and size
+    files_count = 2
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = [os.path.join(self.directory, "output-%i.json" % i) for i in range(self.files_count)]
+        for file_name in self.files:
+            open(file_name, "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from neutmon import analysis
+from neutmon import stream
+from tests import fixtures
+
+# Speedtest as stored in the result files: timestamp -> bytes received. Intervals never end exactly on a min_interval
+# boundary, where the rounding of the accumulated differences of the original implementation is arbitrary.
+SPEEDTEST = {"1500000000.00": 500, "1500000000.04": 1000, "1500000000.13": 2000, "1500000000.30": 1500,
+             "1500000000.36": 500, "1500000000.52": 3000, "1500000000.90": 250}
+
+
+class ThroughputCDFTest(unittest.TestCase):
+    # Expected values of the original, loop based, implementation. Timestamps near 1.5e9 are rounded to about 1e-7 s.
+    def test_min_interval(self):
+        x, y = analysis.throughput_cdf(SPEEDTEST, 0.1)
+        np.testing.assert_allclose(x, [2000 / 0.38e6, 12000 / 0.17e6, 28000 / 0.22e6, 24000 / 0.13e6], rtol=1e-5)
+        np.testing.assert_allclose(y, [0, 1 / 3.0, 2 / 3.0, 1])
+
+    def test_every_sample(self):
+        x, y = analysis.throughput_cdf(SPEEDTEST)
+        np.testing.assert_allclose(x, [2000 / 0.38e6, 4000 / 0.06e6, 12000 / 0.17e6, 24000 / 0.16e6,
+                                       16000 / 0.09e6, 8000 / 0.04e6], rtol=1e-5)
+        np.testing.assert_allclose(y, [0, 0.2, 0.4, 0.6, 0.8, 1])
+
+    def test_single_interval(self):
+        x, y = analysis.throughput_cdf({"10.0": 100, "10.5": 1000, "10.7": 3000}, 0.5)
+        np.testing.assert_allclose(x, [32000 / 0.7e6] * 2)
+        self.assertEqual(list(y), [0, 1])
+
+    def test_transfer_cumulative(self):
+        times, cumulative, throughput = analysis.transfer_cumulative(SPEEDTEST)
+        np.testing.assert_allclose(times, [0, 0.04, 0.13, 0.3, 0.36, 0.52, 0.9], atol=1e-6)
+        self.assertEqual(list(cumulative), [500, 1500, 3500, 5000, 5500, 8500, 8750])
+        self.assertAlmostEqual(throughput, 70000 / 0.9e6, places=5)
+
+
+def parsed_traceroutes(hop_1, hop_2, probes=True):
+    # Parsed file whose traceroutes all have the given interfaces at hops 1 and 2, without the paris and tracebox
+    # probes unless probes
+    traceroute = {1: hop_1, 2: hop_2}
+    directions = [("uplink", "bt"), ("uplink", "ct"), ("downlink", "bt"), ("downlink", "ct")]
+    parsed = {"results": [{"traceroutes": dict((direction, traceroute) for direction in directions)}]}
+    if probes:
+        parsed.update({"paris": {1: [hop_1], 2: [hop_2]}, "tracebox_6881": (traceroute, {1: set(["TTL"])}),
+                       "tracebox_53674": (traceroute, {})})
+    return parsed
+
+
+class TraceroutesStateTest(fixtures.ResultFilesTestCase):
+    def interfaces(self, state, aggregate, key):
+        return state["interners"][key].addresses_of(state[aggregate][key])
+
+    def test_changed_file_replaces_its_contribution(self):
+        state = analysis.new_traceroutes_state()
+        analysis.update_traceroutes_state(state, self.files[0], parsed_traceroutes("10.0.0.1", "10.0.1.1"), 0)
+        analysis.update_traceroutes_state(state, self.files[1], parsed_traceroutes("10.0.0.2", "10.0.1.1"), 0)
+        self.assertEqual(self.interfaces(state, "bt_ul", 1), set(["10.0.0.1", "10.0.0.2"]))
+        # the first file is rewritten with other interfaces, then fails
+        analysis.update_traceroutes_state(state, self.files[0], parsed_traceroutes("10.0.0.3", "10.0.1.3"), 0)
+        self.assertEqual(self.interfaces(state, "bt_ul", 1), set(["10.0.0.2", "10.0.0.3"]))
+        self.assertEqual(self.interfaces(state, "paris", 2), set(["10.0.1.1", "10.0.1.3"]))
+        analysis.update_traceroutes_state(state, self.files[0], None, None)
+        self.assertEqual(self.interfaces(state, "ct_dl", 1), set(["10.0.0.2"]))
+        self.assertEqual(self.interfaces(state, "tracebox_6881", 2), set(["10.0.1.1"]))
+        self.assertEqual(state["tracebox_6881_mods"], {1: set(["TTL"])})
+        analysis.update_traceroutes_state(state, self.files[1], None, None)
+        self.assertEqual(state["bt_ul"], {})
+        self.assertEqual(state["tracebox_6881_mods"], {})
+
+    def test_file_without_probes(self):
+        state = analysis.new_traceroutes_state()
+        analysis.update_traceroutes_state(state, self.files[0], parsed_traceroutes("10.0.0.1", "10.0.1.1"), 0)
+        analysis.update_traceroutes_state(state, self.files[1],
+                                          parsed_traceroutes("10.0.0.2", "10.0.1.2", probes=False), 0)
+        self.assertEqual(self.interfaces(state, "bt_ul", 1), set(["10.0.0.1", "10.0.0.2"]))
+        self.assertEqual(self.interfaces(state, "paris", 2), set(["10.0.1.1"]))
+        self.assertEqual(self.interfaces(state, "tracebox_53674", 1), set(["10.0.0.1"]))
+        analysis.update_traceroutes_state(state, self.files[0], None, None)
+        self.assertEqual(state["paris"], {})
+        self.assertEqual(state["tracebox_6881_mods"], {})
+        self.assertEqual(self.interfaces(state, "ct_dl", 2), set(["10.0.1.2"]))
+
+
+class ParseResultTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "output-1.json")
+        self.udp = {"interval": 1.0, "times": [1500000000.0], "goodput": [0.1], "received": [7], "lost": [1],
+                    "reordered": [2], "duplicated": [0], "jitter": [0.002],
+                    "totals": {"sent": 8, "received": 7, "lost": 1, "reordered": 2, "duplicated": 0, "jitter": 0.002}}
+        result = {"port": 6881, "finished": True, "uplink": {"udp_bt": {"speedtest": SPEEDTEST, "udp": self.udp}},
+                  "downlink": {"bt": {"speedtest": SPEEDTEST}}}
+        with open(self.file_name, "w") as f:
+            json.dump({"meta_data": {}, "results": [result]}, f)
+        self.ijson = stream.ijson
+
+    def tearDown(self):
+        stream.ijson = self.ijson
+        shutil.rmtree(self.directory)
+
+    def check_udp(self):
+        parsed = analysis.parse_result_file(self.file_name)["results"][0]
+        self.assertEqual(parsed["udp"], {("uplink", "udp_bt"): self.udp})
+        times, sizes = parsed["speedtests"]["uplink", "udp_bt"]
+        self.assertEqual(sizes.tolist(), analysis.speedtest_arrays(SPEEDTEST)[1].tolist())
+        self.assertEqual(len(parsed["speedtests"]["downlink", "bt"]), 2)
+
+    def test_udp_statistics(self):
+        self.check_udp()
+
+    def test_udp_statistics_without_ijson(self):
+        stream.ijson = None
+        self.check_udp()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+import math
+import unittest
+import numpy as np
+from neutmon import batchstats
+
+
+class RankStatisticsTest(unittest.TestCase):
+    def test_ks_with_ties(self):
+        # ECDFs at 1, 2, 3, 4: 0.25, 0.75, 1, 1 and 0, 0.25, 0.75, 1
+        n1, n2, medians1, medians2, d, p, delta = batchstats.rank_statistics([([1, 2, 2, 3], [2, 3, 3, 4])])
+        self.assertEqual(d[0], 0.5)
+        # kstwobign.sf((sqrt(2) + 0.12 + 0.11 / sqrt(2)) * 0.5), the asymptotic p-value of stats.ks_2samp
+        self.assertAlmostEqual(p[0], 0.534415719, places=6)
+        self.assertEqual(delta[0], -0.625)
+        self.assertEqual((medians1[0], medians2[0]), (2, 3))
+
+    def test_pairs_are_independent(self):
+        pairs = [([1, 2, 3, 4], [5, 6, 7, 8, 9]), ([3, 1, 2], [2, 3, 1]), ([1, 2, 2, 3], [2, 3, 3, 4])]
+        n1, n2, medians1, medians2, d, p, delta = batchstats.rank_statistics(pairs)
+        self.assertEqual(list(n1), [4, 3, 4])
+        self.assertEqual(list(n2), [5, 3, 4])
+        self.assertEqual(list(d), [1, 0, 0.5])
+        self.assertAlmostEqual(p[0], 0.006860682, places=6)
+        self.assertEqual(p[1], 1)
+        self.assertEqual(list(delta), [-1, 0, -0.625])
+        self.assertEqual(list(medians1), [2.5, 2, 2])
+        self.assertEqual(list(medians2), [7, 2, 3])
+
+
+class CorrectionTest(unittest.TestCase):
+    # Values of p.adjust of R
+    def test_benjamini_hochberg(self):
+        np.testing.assert_allclose(batchstats.benjamini_hochberg([0.01, 0.04, 0.03, 0.005]), [0.02, 0.04, 0.04, 0.02])
+        np.testing.assert_allclose(batchstats.benjamini_hochberg([0.05, 0.01, 0.03, 0.04, 0.02]), [0.05] * 5)
+        np.testing.assert_allclose(batchstats.benjamini_hochberg([0.9, 0.6]), [0.9, 0.9])
+
+    def test_holm(self):
+        np.testing.assert_allclose(batchstats.holm([0.05, 0.01, 0.03, 0.04, 0.02]), [0.09, 0.05, 0.09, 0.09, 0.08])
+        np.testing.assert_allclose(batchstats.holm([0.01, 0.04, 0.03, 0.005]), [0.03, 0.06, 0.06, 0.02])
+        np.testing.assert_allclose(batchstats.holm([0.9, 0.6]), [1, 1])
+
+
+class ComparePairsTest(unittest.TestCase):
+    def test_rows(self):
+        pairs = [([1, 2, 3, 4], [5, 6, 7, 8, 9]), ([], [1, 2]), ([3, 1, 2], [2, 3, 1])]
+        rows = batchstats.compare_pairs(pairs, ["a", "b", "c"], resamples=0, correction="holm")
+        self.assertEqual([row[0] for row in rows], ["a", "b", "c"])
+        self.assertEqual([len(row) for row in rows], [len(batchstats.TABLE_COLUMNS)] * 3)
+        # the empty pair is left out of the correction
+        self.assertAlmostEqual(rows[0][11], 2 * rows[0][10])
+        self.assertEqual([row[-1] for row in rows], ["DIFF", "-", "SAME"])
+        self.assertEqual(rows[0][5], 4.5)
+        self.assertTrue(math.isnan(rows[0][6]) and math.isnan(rows[1][3]))
+
+    def test_bootstrap_interval(self):
+        first = np.arange(100.0)
+        rows = batchstats.compare_pairs([(first, first + 10)], resamples=2000, seed=1)
+        self.assertTrue(rows[0][6] <= 10 <= rows[0][7])
+        self.assertTrue(rows[0][7] - rows[0][6] < 40)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from neutmon import handlers
+from neutmon import pathprobes
+
+PARIS_OUTPUT = """traceroute [(10.0.0.2:33457) -> (192.0.2.1:33457)], protocol udp, algo hopbyhop, duration 3 s
+ 1  P(6, 6) 10.0.0.1 (10.0.0.1)  0.500/0.600/0.700/0.100 ms
+ 2  P(0, 6)
+ 3  P(6, 6) 192.0.2.1 (192.0.2.1)  5.000/5.100/5.200/0.100 ms
+"""
+TRACEBOX_OUTPUT = ('{"addr": "192.0.2.1", "Hops": [{"hop": 1, "from": "10.0.0.1", "Modifications": [{"IP::TTL": "1"}]},'
+                   ' {"hop": 2, "from": "192.0.2.1", "Modifications": []}]}')
+ROUTES = """Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT
+wwan0\t00000000\t010200C0\t0003\t0\t0\t600\t00000000\t0\t0\t0
+eth0\t00000000\t010200C0\t0003\t0\t0\t100\t00000000\t0\t0\t0
+eth0\t000200C0\t00000000\t0001\t0\t0\t0\t00FFFFFF\t0\t0\t0
+"""
+
+
+class PathProbesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def stub(self, name, script):
+        # Executable that records its arguments in <name>.args and runs script
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\necho \"$@\" >> %s.args\n%s\n" % (path, script))
+        os.chmod(path, stat.S_IRWXU)
+        return path
+
+    def output_stub(self, name, output):
+        with open(os.path.join(self.directory, name + ".out"), "w") as f:
+            f.write(output)
+        return self.stub(name, "cat %s.out" % os.path.join(self.directory, name))
+
+    def probes(self, paris, tracebox, interface="", timeout=10):
+        probes = pathprobes.PathProbes("192.0.2.1", interface, paris, tracebox, timeout)
+        probes.start()
+        probes.wait_port_probes()
+        probes.results()
+        return probes
+
+    def test_default_route_interface(self):
+        route_table = os.path.join(self.directory, "route")
+        with open(route_table, "w") as f:
+            f.write(ROUTES)
+        self.assertEqual(pathprobes.default_route_interface(route_table), "eth0")
+        with open(route_table, "w") as f:
+            f.write(ROUTES.splitlines()[0] + "\n" + ROUTES.splitlines()[3] + "\n")
+        self.assertIsNone(pathprobes.default_route_interface(route_table))
+        self.assertIsNone(pathprobes.default_route_interface(os.path.join(self.directory, "missing")))
+
+    def test_commands(self):
+        commands = dict(pathprobes.probe_commands("192.0.2.1", "", "paris", "tracebox"))
+        self.assertEqual(commands["paris"], ["paris", "-n", "192.0.2.1"])
+        self.assertEqual(commands["tracebox_%i" % handlers.BT_PORT],
+                         ["tracebox", "-j", "-n", "-p", "IP/TCP{dst=%i}" % handlers.BT_PORT, "192.0.2.1"])
+        commands = dict(pathprobes.probe_commands("192.0.2.1", "wwan0", "paris", "tracebox", "eth0"))
+        self.assertNotIn("paris", commands)
+        self.assertEqual(commands["tracebox_%i" % handlers.ALT_BT_PORT],
+                         ["tracebox", "-j", "-n", "-p", "IP/TCP{dst=%i}" % handlers.ALT_BT_PORT, "-i", "wwan0",
+                          "192.0.2.1"])
+        commands = dict(pathprobes.probe_commands("192.0.2.1", "eth0", "paris", "tracebox", "eth0"))
+        self.assertEqual(commands["paris"], ["paris", "-n", "192.0.2.1"])
+
+    def test_outputs(self):
+        probes = self.probes(self.output_stub("paris", PARIS_OUTPUT), self.output_stub("tracebox", TRACEBOX_OUTPUT))
+        self.assertEqual(probes.meta_data["paris"], PARIS_OUTPUT)
+        self.assertEqual(probes.report["paris"]["hops"], 3)
+        for port in pathprobes.TRACEBOX_PORTS:
+            name = "tracebox_%i" % port
+            self.assertEqual(probes.meta_data[name]["Hops"][0]["from"], "10.0.0.1")
+            self.assertEqual(probes.report[name]["hops"], 2)
+            self.assertEqual(probes.report[name]["returncode"], 0)
+            self.assertIsNone(probes.report[name]["error"])
+        with open(os.path.join(self.directory, "tracebox.args")) as f:
+            self.assertEqual(sorted(f.read().splitlines()),
+                             sorted("-j -n -p IP/TCP{dst=%i} 192.0.2.1" % port for port in pathprobes.TRACEBOX_PORTS))
+
+    def test_interface(self):
+        probes = self.probes(self.output_stub("paris", PARIS_OUTPUT), self.output_stub("tracebox", TRACEBOX_OUTPUT),
+                             "neutmon-test0")
+        self.assertNotIn("paris", probes.meta_data)
+        self.assertIn("neutmon-test0", probes.report["paris"]["error"])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "paris.args")))
+        with open(os.path.join(self.directory, "tracebox.args")) as f:
+            self.assertTrue(all("-i neutmon-test0" in args for args in f.read().splitlines()))
+
+    def test_failures(self):
+        probes = self.probes(self.stub("paris", "exec sleep 30"), self.stub("tracebox", "echo garbage"), timeout=1)
+        self.assertTrue(probes.report["paris"]["killed"])
+        self.assertNotIn("paris", probes.meta_data)
+        for port in pathprobes.TRACEBOX_PORTS:
+            self.assertIn("Cannot parse", probes.report["tracebox_%i" % port]["error"])
+        probes = self.probes(os.path.join(self.directory, "missing"), self.output_stub("tracebox", TRACEBOX_OUTPUT))
+        self.assertIn("Cannot run", probes.report["paris"]["error"])
+        self.assertEqual(len(probes.meta_data), len(pathprobes.TRACEBOX_PORTS))
+
+
+if __name__ == "__main__":
+    unittest.main()
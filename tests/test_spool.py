@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+import glob
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import uuid
+import client
+import server
+from neutmon import handlers
+
+logger = logging.getLogger(__name__)
+
+
+class FakeClient(object):
+    def __init__(self, control_socket, address):
+        self.control_socket = control_socket
+        self.address = address
+        self.id = str(uuid.uuid4())
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.spool = handlers.ResultSpool(os.path.join(self.directory, "spool"))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def spool_session(self, session):
+        self.spool.open_session(session)
+        self.spool.store(handlers.CONTROLLER_START_UB_MSG, handlers.BT_PORT, handlers.CONTROLLER_OK_MSG, {"1.0": 10})
+        self.spool.close_session()
+
+    def output(self, session, address):
+        result = {"meta_data": {"client_id": session, "client_ip": address},
+                  "results": [server.init_current_test(handlers.BT_PORT)]}
+        server.write_json_file("output-1-%s.json" % session, result)
+
+    def upload(self, address, client_messages=None):
+        # Runs the spool exchange of a session on a socket pair, returns the exception raised on the server
+        server_socket, client_socket = socket.socketpair()
+        server_socket.settimeout(5)
+        client_socket.settimeout(5)
+        server_controller = handlers.Controller(server_socket)
+        client_controller = handlers.Controller(client_socket, handlers.ROLE_CLIENT)
+        errors = []
+
+        def receive():
+            try:
+                server.receive_spooled_sessions(server_controller, FakeClient(server_socket, address),
+                                                handlers.Deadline("session", 5), logger)
+            except handlers.ControllerException as ce:
+                errors.append(ce)
+        thread = threading.Thread(target=receive)
+        thread.start()
+        client_controller.recv_control_msg()
+        if client_messages is None:
+            uploaded = client.upload_spooled_sessions(client_controller, self.spool, logger)
+            client_controller.send_control_msg(handlers.CONTROLLER_OK_MSG)
+        else:
+            for msg in client_messages:
+                client_controller.send_control_msg(msg)
+            uploaded = None
+        thread.join()
+        server_socket.close()
+        client_socket.close()
+        return uploaded, errors
+
+    def test_merge(self):
+        session = str(uuid.uuid4())
+        self.output(session, ["192.0.2.1", 40000])
+        self.spool_session(session)
+        self.assertEqual(self.upload(("192.0.2.1", 40001)), (1, []))
+        with open("output-1-%s.json" % session) as f:
+            result = json.load(f)
+        self.assertEqual(result["results"][0]["uplink"]["bt"]["client_status"], handlers.CONTROLLER_OK_MSG)
+        self.assertEqual(self.spool.pending(), [])
+
+    def test_other_address(self):
+        # a reconnected mobile client uploads from another address, the session id authenticates it
+        session = str(uuid.uuid4())
+        self.output(session, ["192.0.2.1", 40000])
+        self.spool_session(session)
+        self.assertEqual(self.upload(("198.51.100.1", 40000)), (1, []))
+        with open("output-1-%s.json" % session) as f:
+            result = json.load(f)
+        self.assertEqual(result["results"][0]["uplink"]["bt"]["client_status"], handlers.CONTROLLER_OK_MSG)
+        self.assertEqual(self.spool.pending(), [])
+
+    def test_rejected_session(self):
+        self.spool_session("not-a-session")
+        self.assertEqual(self.upload(("192.0.2.1", 40000)), (0, []))
+        self.assertEqual(glob.glob("spooled-*.json"), [])
+        # a refused session stays in the spool
+        self.assertEqual([spooled["session"] for spooled in self.spool.pending()], ["not-a-session"])
+
+    def test_running_session(self):
+        session = str(uuid.uuid4())
+        self.spool_session(session)
+        self.assertEqual(self.upload(("192.0.2.1", 40000)), (1, []))
+        with open(server.SPOOLED_FILE % session) as f:
+            spooled = json.load(f)
+        self.assertEqual(spooled["session"], session)
+        self.assertEqual(spooled["phases"][0]["status"], handlers.CONTROLLER_OK_MSG)
+
+    def test_terminator(self):
+        uploaded, errors = self.upload(("192.0.2.1", 40000), [handlers.CONTROLLER_CLIENT_TEST_GENERIC_ERROR])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(glob.glob("spooled-*.json"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
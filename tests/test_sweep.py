@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+import unittest
+import numpy as np
+from neutmon import handlers
+from neutmon import sweep
+
+REFERENCE = str(sweep.DEFAULT_SWEEP_REFERENCE_PORT)
+
+
+def burst(rate, seed, bins=50):
+    # Speedtest of a burst of bins of 0.1 s of about rate Mbps
+    sizes = np.random.RandomState(seed).poisson(rate * 1e5 / 8, bins)
+    return dict(("%.1f" % (1000 + i * 0.1), int(size)) for i, size in enumerate(sizes))
+
+
+def entry(rate=None, seed=0, server_status=handlers.TESTER_OK, client_status=handlers.CONTROLLER_OK_MSG, bins=50):
+    return {"server_status": server_status, "client_status": client_status,
+            "speedtest": burst(rate, seed, bins) if rate is not None else dict()}
+
+
+class PortSweepTest(unittest.TestCase):
+    def sweep(self, ports, min_class_ports=0, concurrency=3):
+        return sweep.PortSweep(ports, "uplink", concurrency=concurrency, min_class_ports=min_class_ports)
+
+    def test_failures(self):
+        port_sweep = self.sweep(range(7000, 7004))
+        port_sweep.next_batch()
+        port_sweep.record({REFERENCE: entry(10), "7000": entry(server_status=handlers.TESTER_INIT_SERVER_ERROR),
+                           "7002": entry(server_status=handlers.TESTER_ACCEPT_TIMEOUT_ERROR,
+                                         client_status=handlers.CONTROLLER_CLIENT_CONNECT_TIMEOUT_ERROR)})
+        port_sweep.next_batch()
+        port_sweep.record({REFERENCE: entry(server_status=handlers.TESTER_ACCEPT_TIMEOUT_ERROR),
+                           "7001": entry(server_status=handlers.TESTER_ACCEPT_TIMEOUT_ERROR), "7003": entry(10)})
+        classes = dict((port, value["class"]) for port, value in port_sweep.port_map.items())
+        self.assertEqual(classes, {"7000": sweep.ERROR, "7002": sweep.BLOCKED, "7001": sweep.ERROR,
+                                   "7003": sweep.UNBLOCKED})
+        report = port_sweep.report()
+        self.assertEqual((report["blocked"], report["unblocked"], report["errors"]), (1, 1, 2))
+
+    def test_verdicts_are_final(self):
+        port_sweep = self.sweep(range(7000, 7010), concurrency=2)
+        # a short throttled burst, just significant alone, then ports like the reference that raise its adjusted
+        # p-value above the significance
+        port = str(port_sweep.next_batch()[1])
+        port_sweep.record({REFERENCE: entry(10, 1, bins=8), port: entry(4, 2, bins=8)})
+        first = dict(port_sweep.port_map[port])
+        self.assertEqual(first["class"], sweep.BLOCKED)
+        seed = 3
+        while True:
+            ports = port_sweep.next_batch()
+            if ports is None:
+                break
+            port_sweep.record({REFERENCE: entry(10, seed), str(ports[1]): entry(10, seed + 1)})
+            seed += 2
+        self.assertEqual(port_sweep.port_map[port], first)
+        self.assertEqual(len(port_sweep.port_map), 10)
+
+    def test_early_termination(self):
+        port_sweep = self.sweep(range(7000, 7010), min_class_ports=1)
+        error = entry(server_status=handlers.TESTER_INIT_SERVER_ERROR)
+        ports = port_sweep.next_batch()
+        port_sweep.record({REFERENCE: entry(10, 1), str(ports[1]): error,
+                           str(ports[2]): entry(10, 2)})
+        # errors do not count towards the classes
+        ports = port_sweep.next_batch()
+        self.assertIsNotNone(ports)
+        refused = entry(server_status=handlers.TESTER_ACCEPT_TIMEOUT_ERROR,
+                        client_status=handlers.CONTROLLER_CLIENT_CONNECT_REFUSED_ERROR)
+        port_sweep.record({REFERENCE: entry(10, 3), str(ports[1]): refused, str(ports[2]): entry(10, 4)})
+        self.assertIsNone(port_sweep.next_batch())
+        self.assertTrue(port_sweep.report()["early_termination"])
+
+
+if __name__ == "__main__":
+    unittest.main()
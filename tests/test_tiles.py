@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+import unittest
+import numpy as np
+from neutmon import analysis
+from neutmon import tiles
+from tests import fixtures
+
+
+def parsed_result(latitude, longitude, rate):
+    # BT and CT uplink speedtests of 10 s with bins of about rate Mbps, all located at one GPS fix
+    random_state = np.random.RandomState(int(rate))
+    speedtests = dict()
+    for test, scale in [("bt", 1), ("ct", 2)]:
+        times = 1000 + np.arange(100) * 0.1
+        sizes = random_state.poisson(rate * scale * 1e5 / 8, 100)
+        speedtests["uplink", test] = dict(("%.1f" % t, int(s)) for t, s in zip(times, sizes))
+    gps = analysis.metadata_arrays({"999.0": {"Latitude": latitude, "Longitude": longitude}}, analysis.GPS_FIELDS)
+    return {"gps": gps, "results": [{"finished": True, "speedtests": speedtests}]}
+
+
+class TilesStateTest(fixtures.ResultFilesTestCase):
+    def assert_same_tiles(self, state, expected):
+        for level in [10, 3]:
+            rows = tiles.query_tiles(state, level)
+            expected_rows = tiles.query_tiles(expected, level)
+            self.assertEqual([row[:6] for row in rows], [row[:6] for row in expected_rows])
+            np.testing.assert_allclose([row[6:-2] for row in rows], [row[6:-2] for row in expected_rows])
+            self.assertEqual([row[-2:] for row in rows], [row[-2:] for row in expected_rows])
+
+    def test_min_max_restored_after_rewrite(self):
+        # min and max can not be subtracted, the tile is rebuilt without the slowest file
+        state = tiles.new_tiles_state(level=10)
+        tiles.update_tiles_state(state, self.files[0], parsed_result(45.0, 9.0, 5), 0)
+        tiles.update_tiles_state(state, self.files[1], parsed_result(45.0, 9.0, 20), 0)
+        tiles.update_tiles_state(state, self.files[0], parsed_result(45.0, 9.0, 30), 0)
+        expected = tiles.new_tiles_state(level=10)
+        tiles.update_tiles_state(expected, self.files[1], parsed_result(45.0, 9.0, 20), 0)
+        tiles.update_tiles_state(expected, self.files[0], parsed_result(45.0, 9.0, 30), 0)
+        self.assert_same_tiles(state, expected)
+        minimum = dict((tuple(row[3:5]), row[8]) for row in tiles.query_tiles(state, 10))
+        self.assertGreater(minimum["uplink", "bt"], 10)
+
+    def test_verdicts_not_double_counted(self):
+        state = tiles.new_tiles_state(level=10)
+        for file_name in self.files:
+            tiles.update_tiles_state(state, file_name, parsed_result(45.0, 9.0, 10), 0)
+        tiles.update_tiles_state(state, self.files[0], parsed_result(45.0, 9.0, 10), 0)
+        self.assertEqual(sum(row[5] for row in tiles.query_tiles(state, 0)), 2 * 2 * 99)
+        for level in range(11):
+            self.assertEqual(sum(sum(counts) for (verdict_level, key, direction), counts in state["verdicts"].items()
+                                 if verdict_level == level), 2)
+
+    def test_moved_file_leaves_its_tile(self):
+        state = tiles.new_tiles_state(level=10)
+        tiles.update_tiles_state(state, self.files[0], parsed_result(45.0, 9.0, 10), 0)
+        tiles.update_tiles_state(state, self.files[1], parsed_result(45.0, 9.0, 20), 0)
+        tiles.update_tiles_state(state, self.files[0], parsed_result(46.0, 9.0, 30), 0)
+        expected = tiles.new_tiles_state(level=10)
+        tiles.update_tiles_state(expected, self.files[1], parsed_result(45.0, 9.0, 20), 0)
+        tiles.update_tiles_state(expected, self.files[0], parsed_result(46.0, 9.0, 30), 0)
+        self.assert_same_tiles(state, expected)
+
+    def test_failed_files_leave_nothing(self):
+        state = tiles.new_tiles_state(level=10)
+        for file_name in self.files:
+            tiles.update_tiles_state(state, file_name, parsed_result(45.0, 9.0, 10), 0)
+        for file_name in self.files:
+            tiles.update_tiles_state(state, file_name, parsed_result(45.0, 9.0, 10), None)
+        self.assertEqual(state["throughput"], {})
+        self.assertEqual(state["verdicts"], {})
+
+
+if __name__ == "__main__":
+    unittest.main()
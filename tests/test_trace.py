@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+import logging
+import socket
+import threading
+import unittest
+import client
+import server
+from neutmon import handlers
+from neutmon import test
+from neutmon import traces
+
+logger = logging.getLogger(__name__)
+
+
+def flow(data):
+    return traces.Trace(traces.TraceDirection(data, [0.0, 0.1], [1, len(data) - 1]),
+                        traces.TraceDirection("ok", [0.05], [2]), 0.2, (("10.0.0.1", 40000), ("10.0.0.2", 80)))
+
+
+class TraceAgreementTest(unittest.TestCase):
+    def exchange(self, server_trace, client_trace):
+        # Trace exchange of a session on a socket pair, returns the server metadata and the client report
+        server_socket, client_socket = socket.socketpair()
+        server_socket.settimeout(5)
+        client_socket.settimeout(5)
+        server_controller = handlers.Controller(server_socket)
+        meta_data = dict()
+
+        def agree():
+            server.agree_trace(server_controller, server_trace, meta_data, handlers.Deadline("session", 5), logger)
+            server_controller.finish_measure()
+        thread = threading.Thread(target=agree)
+        thread.start()
+        report = dict()
+        client.control_session(handlers.Controller(client_socket, handlers.ROLE_CLIENT), "", "127.0.0.1",
+                               test.TCPBTTest(), test.TCPRandomTest(), dict(), [], 0, logger, report=report,
+                               third_test=None if client_trace is None else test.TCPTraceTest(client_trace))
+        thread.join()
+        server_socket.close()
+        client_socket.close()
+        return meta_data, report
+
+    def test_digest(self):
+        self.assertEqual(flow("GET / HTTP/1.1").digest(), flow("GET / HTTP/1.1").digest())
+        self.assertNotEqual(flow("GET / HTTP/1.1").digest(), flow("GET /a HTTP/1.1").digest())
+
+    def test_same_trace(self):
+        meta_data, report = self.exchange(flow("GET / HTTP/1.1"), flow("GET / HTTP/1.1"))
+        self.assertTrue(meta_data["trace"]["replayed"])
+        self.assertTrue(report["trace_replayed"])
+        self.assertEqual(report["outcome"], client.SESSION_FINISHED)
+
+    def test_mismatch(self):
+        server_trace = flow("GET / HTTP/1.1")
+        client_trace = flow("GET /a HTTP/1.1")
+        meta_data, report = self.exchange(server_trace, client_trace)
+        self.assertEqual(meta_data["trace"], {"digest": server_trace.digest(), "client_digest": client_trace.digest(),
+                                              "replayed": False})
+        self.assertFalse(report["trace_replayed"])
+        self.assertEqual(report["outcome"], client.SESSION_FINISHED)
+        meta_data, report = self.exchange(server_trace, None)
+        self.assertIsNone(meta_data["trace"]["client_digest"])
+        self.assertFalse(meta_data["trace"]["replayed"])
+
+
+if __name__ == "__main__":
+    unittest.main()
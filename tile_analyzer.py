@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+import argparse
+from neutmon import analysis
+from neutmon import cache
+from neutmon import tiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NeutMon spatial analyzer. Aggregates the throughput and the BT/CT "
+                                                 "verdicts of GPS-tagged NeutMon output files by map tile.")
+    parser.add_argument("-a", "--state", required=True,
+                        help="tiles state file, loaded if it exists, updated with the files not yet in it and saved")
+    parser.add_argument("-l", "--level", type=int, default=tiles.DEFAULT_TILE_LEVEL,
+                        help="tile level of a new state file")
+    parser.add_argument("-i", "--interval", type=float, default=0,
+                        help="minimum interval for throughput calculation of a new state file")
+    parser.add_argument("-s", "--significance", type=float, default=0.05,
+                        help="significance level of the per tile KS tests of a new state file")
+    parser.add_argument("-g", "--max_age", type=float, default=analysis.DEFAULT_METADATA_MAX_AGE,
+                        help="maximum age (s) of the GPS fix joined with a throughput bin of a new state file")
+    parser.add_argument("-q", "--query_level", type=int, help="tile level of the output, by default the state one")
+    parser.add_argument("-b", "--bounds", type=float, nargs=4, metavar=("SOUTH", "WEST", "NORTH", "EAST"),
+                        help="output only the tiles within these latitudes and longitudes")
+    parser.add_argument("-k", "--quadkey", help="output only the tiles inside this quadkey tile")
+    parser.add_argument("-o", "--output", help="Output file name. If not specified, the output file will be "
+                                               "tiles.dat")
+    parser.add_argument("-c", "--cache", default=cache.DEFAULT_CACHE_DIRECTORY,
+                        help="directory of the cache of parsed files")
+    parser.add_argument("-C", "--cache_size", type=int, default=cache.DEFAULT_CACHE_SIZE,
+                        help="maximum size of the cache of parsed files in MB")
+    parser.add_argument("-n", "--no_cache", action="store_true", help="do not cache parsed files")
+    parser.add_argument("neutmon_files", metavar="FILE", type=str, nargs="*", help="NeutMon output file(s)")
+    args = parser.parse_args()
+    if not args.output:
+        output_file = "tiles.dat"
+    else:
+        output_file = args.output
+
+    state = tiles.load_tiles_state(args.state, args.level, args.interval, args.significance, args.max_age)
+    result_cache = None if args.no_cache else cache.ResultCache(args.cache, args.cache_size)
+    new_files = 0
+    for file_name in args.neutmon_files:
+        if tiles.tiles_state_contains(state, file_name):
+            continue
+        new_files += 1
+        parsed = analysis.load_result(file_name, result_cache)
+        finished = [i for i, result in enumerate(parsed.get("results", [])) if result["finished"]]
+        if len(finished) == 0:
+            print "%s Test failed" % file_name
+        tiles.update_tiles_state(state, file_name, parsed, finished[0] if finished else None)
+    if new_files > 0:
+        tiles.save_tiles_state(state, args.state)
+    print "%i new files, %i files in %s" % (new_files, len(state["files"]), args.state)
+
+    rows = tiles.query_tiles(state, args.query_level, args.bounds, args.quadkey)
+    tiles.write_tiles(output_file, rows)
+    print "%i tiles of level %i in %s" % (len(set(row[0] for row in rows)),
+                                          state["level"] if args.query_level is None else args.query_level, output_file)
+
+
+if __name__ == "__main__":
+    main()